@@ -0,0 +1,403 @@
+"""
+Optional acquisition server (start main.py with --server).
+
+A separate process owns the Keithley, relay card, SuSi and temperature sensor, and writes every measured point
+into a shared-memory ring buffer. Acquisition timing is then independent of the GUI (plotting, GIL), and further
+viewers can follow a running measurement with: python acquisition.py <ring name>
+"""
+__author__ = "Edgar R. Nandayapa"
+
+import sys
+import queue
+import pickle
+import itertools
+import threading
+import multiprocessing as mp
+from multiprocessing import shared_memory
+from collections import defaultdict
+from time import time, sleep
+import numpy as np
+import sweeps
+import instruments
+
+RING_FIELDS = ["Time (s)", "Sweep", "Voltage (V)", "Current (A)", "Std Dev (A)"]
+RING_CAPACITY = 100000  # Samples kept before the oldest ones are overwritten
+HEADER = ["Written", "Capacity", "Temperature (°C)"]  # 8 bytes each: two int64 counts and a float64
+
+
+class SampleRing:
+    """
+    Ring buffer of timestamped samples in shared memory, written by one process and read by any number of others.
+
+    read() returns numpy views of the shared memory, nothing is copied until the reader does it. The writer stores
+    every sample before it increments the written count, and readers take the count before they look at the
+    samples, so all samples below the count are complete: readers never see half a sample as long as this order
+    is kept on both sides.
+    """
+    def __init__(self, name=None, capacity=RING_CAPACITY):
+        if name is None:  # New ring, owned (and removed) by the creating process
+            size = (len(HEADER) + capacity * len(RING_FIELDS)) * 8
+            self.memory = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        self.counts = np.ndarray((2,), dtype=np.int64, buffer=self.memory.buf)  # Written, capacity
+        self.header = np.ndarray((1,), dtype=np.float64, buffer=self.memory.buf, offset=16)  # Temperature
+        if name is None:
+            self.counts[:] = [0, capacity]
+            self.header[0] = np.nan
+
+        self.name = self.memory.name
+        self.capacity = int(self.counts[1])
+        self.samples = np.ndarray((self.capacity, len(RING_FIELDS)), dtype=np.float64, buffer=self.memory.buf,
+                                  offset=len(HEADER) * 8)
+
+    @property
+    def written(self):
+        return int(self.counts[0])
+
+    @property
+    def temperature(self):
+        return float(self.header[0])
+
+    def set_temperature(self, value):
+        self.header[0] = value
+
+    def write(self, *values):
+        written = int(self.counts[0])
+        self.samples[written % self.capacity] = values
+        self.counts[0] = written + 1  # Only after the sample, see the class docstring
+
+    def read(self, since):
+        """
+        Samples written after "since" (a previous written count), as views: two of them when the ring wrapped.
+
+        Returns the views and the present written count. Samples older than the capacity are lost.
+        """
+        written = self.written
+        start = max(since, written - self.capacity)
+        first, last = start % self.capacity, written % self.capacity
+
+        if written == start:
+            return [], written
+        if first < last:
+            return [self.samples[first:last]], written
+        return [self.samples[first:], self.samples[:last]], written
+
+    def close(self, unlink=False):
+        self.counts = self.header = self.samples = None  # Views must be gone before the memory is released
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+
+class AcquisitionServer(mp.Process):
+    """
+    Process that owns the instruments, see AcquisitionClient for the GUI side.
+
+    Requests are single instrument accesses (RemoteInstrument) and whole sweeps, which run here and write every
+    point to the ring. The requests of one device are handled one at a time, but a busy device (e.g. the Keithley
+    during a sweep) does not hold up the requests of the others. Every reply carries the id of its request.
+    """
+    def __init__(self, ports, ring_name):
+        super(AcquisitionServer, self).__init__(daemon=True)
+        self.ports = ports  # Device name: VISA resource or serial port
+        self.ring_name = ring_name
+        self.requests = mp.Queue()
+        self.replies = mp.Queue()
+        self.stop = mp.Event()
+
+    def run(self):
+        self.ring = SampleRing(self.ring_name)
+        self.devices = {}
+        self.locks = defaultdict(threading.Lock)  # Device name: held while the device is in use
+        self.threads = []
+        for name, port in self.ports.items():
+            if port is None:
+                continue
+            try:
+                self.devices[name] = instruments.DEVICE_OPENERS[name](port)
+            except:
+                print("Acquisition server: " + name + " not found")
+
+        while True:
+            try:
+                request = self.requests.get(timeout=1)
+            except queue.Empty:
+                self.update_temperature()
+                continue
+            if request[1] == "quit":
+                break
+            self.handle(request)
+
+        for thread in self.threads:
+            thread.join(5)
+        for name in ("susi", "temperature"):
+            if name in self.devices:
+                self.devices[name].close()
+        self.ring.close()
+
+    def handle(self, request):
+        # Answered here if the device is free, otherwise on a thread that waits for it. Sweeps always get a thread
+        _, kind, name = request[:3]
+        lock = self.locks["keithley" if kind == "sweep" else name[0] if isinstance(name, tuple) else name]
+        if kind != "sweep" and lock.acquire(blocking=False):
+            try:
+                self.answer(request)
+            finally:
+                lock.release()
+            return
+        self.threads = [thread for thread in self.threads if thread.is_alive()]
+        self.threads.append(threading.Thread(target=self.answer, args=(request, lock), daemon=True))
+        self.threads[-1].start()
+
+    def answer(self, request, lock=None):
+        if lock is not None:  # Waits for the device first
+            with lock:
+                return self.answer(request)
+        request_id, kind = request[:2]
+        try:
+            reply = (request_id, True, getattr(self, "do_" + kind)(*request[2:]))
+            pickle.dumps(reply)
+        except Exception as error:
+            reply = (request_id, False, sendable_error(error))
+        self.replies.put(reply)
+
+    def device(self, name):
+        if isinstance(name, tuple):  # Item of a device list, e.g. ("relays", 3)
+            return self.devices[name[0]][name[1]]
+        return self.devices[name]
+
+    def update_temperature(self):
+        if "temperature" in self.devices and self.locks["temperature"].acquire(blocking=False):
+            try:
+                self.ring.set_temperature(float(self.devices["temperature"].readline().strip()[-5:]))
+            except ValueError:
+                pass
+            finally:
+                self.locks["temperature"].release()
+
+    def do_open(self, name):
+        # Number of items for device lists, None for single devices
+        device = self.device(name)
+        return len(device) if isinstance(device, list) else None
+
+    def do_is_method(self, name, attr):
+        return callable(getattr(type(self.device(name)), attr, None))
+
+    def do_get(self, name, attr):
+        return getattr(self.device(name), attr)
+
+    def do_set(self, name, attr, value):
+        setattr(self.device(name), attr, value)
+
+    def do_call(self, name, attr, args, kwargs):
+        return getattr(self.device(name), attr)(*args, **kwargs)
+
+    def do_timeout(self, name, timeout=None):
+        # VISA timeout (ms) of the device, changed if "timeout" is given
+        connection = self.device(name).adapter.connection
+        if timeout is not None:
+            connection.timeout = timeout
+        return connection.timeout
+
+    def do_clear(self, name):
+        self.device(name).adapter.connection.clear()
+
+    def do_sweep(self, sweep_id, voltages, settle, average_points, stop_args):
+        """
+        Stepped sweep, every point goes to the ring as soon as it is measured.
+
+        "stop_args" are the cell area (cm²) and the sweeps.is_sweep_done arguments after the curve, or None.
+        Returns the number of measured points.
+        """
+        keithley = self.devices["keithley"]
+        self.update_temperature()
+        voltage, current = [], []
+
+        for v in voltages:
+            if self.stop.is_set():
+                break
+            keithley.source_voltage = v
+            self.stop.wait(settle)
+            readings = sweeps.read_currents([keithley], average_points, self.stop.is_set)[0]
+            self.ring.write(time(), sweep_id, v, readings.mean(), sweeps.sample_std(readings))
+
+            voltage.append(v)
+            current.append(readings.mean() * 1000 / stop_args[0] if stop_args else 0)
+            if stop_args and sweeps.is_sweep_done(voltage, current, *stop_args[1:]):
+                break
+
+        return len(voltage)
+
+
+class AcquisitionClient:
+    """
+    GUI side of the acquisition server: starts it, maps its ring and sends the requests.
+    """
+    def __init__(self, ports, capacity=RING_CAPACITY):
+        self.ring = SampleRing(capacity=capacity)
+        self.server = AcquisitionServer(ports, self.ring.name)
+        self.server.start()
+        self.lock = threading.Lock()  # Request ids in the order the requests are sent
+        self.request_ids = itertools.count()
+        self.answers = {}  # Request id: (ok, result), until the requesting thread takes it
+        self.answered = threading.Condition()
+        self.reader = threading.Thread(target=self.read_replies, daemon=True)
+        self.reader.start()
+        self.sweep_count = 0
+        self.methods = {}
+
+    def read_replies(self):
+        # Hands every reply to the thread waiting for it, any number of threads can wait at the same time
+        while True:
+            request_id, ok, result = self.server.replies.get()
+            if request_id is None:
+                break
+            with self.answered:
+                self.answers[request_id] = (ok, result)
+                self.answered.notify_all()
+
+    def send(self, *request):
+        with self.lock:
+            request_id = next(self.request_ids)
+            self.server.requests.put((request_id,) + request)
+        return request_id
+
+    def reply(self, request_id, timeout=None):
+        # (ok, result) of the request, None if it is not answered within the timeout
+        with self.answered:
+            if not self.answered.wait_for(lambda: request_id in self.answers, timeout):
+                return None
+            return self.answers.pop(request_id)
+
+    def request(self, *request):
+        ok, result = self.reply(self.send(*request))
+        if not ok:
+            raise result
+        return result
+
+    def instrument(self, name):
+        # Fails if the server could not open the device
+        size = self.request("open", name)
+        if size is None:
+            return RemoteInstrument(self, name)
+        return [RemoteInstrument(self, (name, n)) for n in range(size)]
+
+    def is_method(self, name, attr):
+        key = (name[0] if isinstance(name, tuple) else name, attr)
+        if key not in self.methods:
+            self.methods[key] = self.request("is_method", name, attr)
+        return self.methods[key]
+
+    def sweep(self, voltages, settle, average_points, stop_args=None, on_samples=None, poll_time=0.05):
+        """
+        Run a stepped sweep in the server (see AcquisitionServer.do_sweep).
+
+        "on_samples" gets every new block of samples of this sweep (rows as RING_FIELDS) as a view of the ring,
+        valid until the ring wraps. Returns a copy of all of them once the sweep is finished.
+        """
+        # Other threads keep sending requests meanwhile, only the sweeps write to the ring
+        self.sweep_count += 1
+        first = since = self.ring.written  # One sweep at a time (the measurement thread), so the rows are contiguous
+        request_id = self.send("sweep", self.sweep_count, list(voltages), settle, average_points, stop_args)
+
+        reply = None
+        while reply is None:
+            reply = self.reply(request_id, poll_time)
+            views, since = self.ring.read(since)
+            for view in views:
+                if on_samples is not None and len(view):
+                    on_samples(view)
+        views, _ = self.ring.read(first)
+
+        ok, result = reply
+        if not ok:
+            raise result
+        return np.concatenate(views) if views else np.zeros((0, len(RING_FIELDS)))
+
+    def stop(self):
+        self.server.stop.set()
+
+    def resume(self):
+        self.server.stop.clear()
+
+    def close(self):
+        self.stop()
+        self.server.requests.put((None, "quit"))
+        self.server.join(5)
+        self.server.replies.put((None, None, None))  # Ends read_replies
+        self.reader.join(5)
+        self.ring.close(unlink=True)
+
+
+class RemoteInstrument:
+    """
+    Instrument owned by the acquisition server, attributes and methods are forwarded to it.
+    """
+    def __init__(self, client, name):
+        object.__setattr__(self, "client", client)
+        object.__setattr__(self, "name", name)
+
+    @property
+    def adapter(self):
+        # Only the VISA connection settings used by the programs on the Keithley (see sweeps.stop_tsp_mpp)
+        return RemoteAdapter(self.client, self.name)
+
+    def __getattr__(self, attr):
+        if self.client.is_method(self.name, attr):
+            return lambda *args, **kwargs: self.client.request("call", self.name, attr, args, kwargs)
+        return self.client.request("get", self.name, attr)
+
+    def __setattr__(self, attr, value):
+        self.client.request("set", self.name, attr, value)
+
+
+class RemoteAdapter:
+    """
+    VISA timeout and device clear of an instrument owned by the acquisition server.
+    """
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    @property
+    def connection(self):
+        return self
+
+    @property
+    def timeout(self):
+        return self.client.request("timeout", self.name)
+
+    @timeout.setter
+    def timeout(self, value):
+        self.client.request("timeout", self.name, value)
+
+    def clear(self):
+        self.client.request("clear", self.name)
+
+
+def sendable_error(error):
+    # Instrument exceptions (e.g. VISA timeouts) as they are, or as a plain error if they cannot be pickled
+    try:
+        pickle.loads(pickle.dumps(error))
+        return error
+    except Exception:
+        return RuntimeError("{}: {}".format(type(error).__name__, error))
+
+
+if __name__ == "__main__":
+    # Extra viewer of a running measurement, prints the samples as they arrive
+    ring = SampleRing(sys.argv[1])
+    try:  # Python < 3.13 would remove the memory of the running program when the viewer exits
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(ring.memory._name, "shared_memory")
+    except:
+        pass
+    print("\t".join(RING_FIELDS))
+    since = ring.written
+    while True:
+        views, since = ring.read(since)
+        for view in views:
+            for sample in view:
+                print("\t".join("{:.6g}".format(value) for value in sample))
+        sleep(0.2)
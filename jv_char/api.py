@@ -0,0 +1,392 @@
+"""
+Optional local API to control and follow the measurements from other programs (start main.py with --api).
+
+    GET  /status            State of the measurement and of the instruments
+    POST /start             {"measurement": "jv" or "mpp", "settings": {field name: value, ...}}
+    POST /recipe            {"recipe": "BL,FL,BD", "settings": {...}}
+    POST /stop
+    GET  /stream            Live events as WebSocket messages, or as server-sent events for plain HTTP clients
+
+Every event is a JSON object with a "type": "jv_points" (new points of a JV curve), "jv_chars" (parameters of
+a finished light curve), "mpp" (tracked point), "status" and "finished". Every client gets its own bounded
+queue: a client that reads too slowly loses the oldest events (and is told so), the measurement never waits.
+WebSocket clients are answered pings with pongs, and their close frames are echoed before the stream ends.
+"""
+__author__ = "Edgar R. Nandayapa"
+
+import json
+import math
+import base64
+import hashlib
+import threading
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from PyQt5.QtCore import QObject, Qt, pyqtSignal
+from PyQt5.QtWidgets import QLineEdit, QCheckBox, QComboBox
+
+DEFAULT_PORT = 8450
+QUEUE_SIZE = 2000  # Events kept for a client that reads slower than they come
+KEEPALIVE = 15  # s without events before a keep-alive is sent
+COMMAND_TIMEOUT = 5  # s for the window to carry out a command
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+TEXT, CLOSE, PING, PONG = 0x1, 0x8, 0x9, 0xA  # WebSocket opcodes
+JV_CHARS = ["Voc (V)", "Jsc (mA/cm²)", "FF (%)", "PCE (%)", "V_mpp (V)", "J_mpp (mA/cm²)", "P_mpp (mW/cm²)",
+            "R_series (Ωcm²)", "R_shunt (Ωcm²)", "Temperature (°C)", "Time"]
+
+
+class Subscriber:
+    """
+    Event queue of one client. Adding never blocks: when the queue is full the oldest event is dropped.
+    """
+    def __init__(self, size=QUEUE_SIZE):
+        self.events = deque(maxlen=size)
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.closed = False
+
+    def put(self, event):
+        with self.lock:
+            if len(self.events) == self.events.maxlen:
+                self.dropped += 1
+            self.events.append(event)
+        self.ready.set()
+
+    def take(self, timeout):
+        # All waiting events (empty after the timeout), led by a notice of the ones that were dropped
+        self.ready.wait(timeout)
+        self.ready.clear()
+        with self.lock:
+            events = list(self.events)
+            self.events.clear()
+            if self.dropped:
+                events.insert(0, {"type": "dropped", "count": self.dropped})
+                self.dropped = 0
+        return events
+
+    def close(self):
+        # The client went away, take returns at once
+        self.closed = True
+        self.ready.set()
+
+
+class RemoteApi(QObject):
+    """
+    HTTP server on its own threads, attached to one MainWindow.
+
+    Commands are handed to the GUI thread (command signal) and the engine signals of the window are turned
+    into events for the subscribers, so nothing here touches the instruments or waits for a client.
+    """
+    command = pyqtSignal(object)
+
+    def __init__(self, window, port=DEFAULT_PORT, host="127.0.0.1"):
+        super(RemoteApi, self).__init__(window)
+        self.window = window
+        self.subscribers = []
+        self.subscribers_lock = threading.Lock()
+        self.jobs_lock = threading.Lock()  # A command either runs or is cancelled after its timeout, not both
+        self.sent_points = {}  # (Curve mode, cell): points already published
+        self.chars_sent = 0
+        self.last_status = ""
+
+        self.command.connect(self.run_command)
+        # Straight from the worker thread: in order, and not held up by the plots or a popup of the window
+        window.engine.jv_curve.connect(self.publish_jv_points, Qt.DirectConnection)
+        window.engine.jv_chars.connect(self.publish_jv_chars, Qt.DirectConnection)
+        window.engine.mpp_curve.connect(self.publish_mpp, Qt.DirectConnection)
+        window.engine.finished.connect(self.publish_finished, Qt.DirectConnection)
+        window.statusBar().messageChanged.connect(self.publish_status)
+
+        handler = type("Handler", (ApiHandler,), {"api": self})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        print("Remote API on http://{}:{}".format(host, self.server.server_address[1]))
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # Events, only queued here (serialized by the thread of every client)
+    def publish(self, event):
+        with self.subscribers_lock:
+            for subscriber in self.subscribers:
+                subscriber.put(event)
+
+    def subscribe(self):
+        subscriber = Subscriber()
+        with self.subscribers_lock:
+            self.subscribers.append(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.subscribers_lock:
+            self.subscribers.remove(subscriber)
+
+    def publish_jv_points(self, voltage, current, mode, cell, first):
+        key = (mode, cell)
+        sent = 0 if first else self.sent_points.get(key, 0)
+        self.sent_points[key] = len(voltage)
+        if len(voltage) > sent:
+            self.publish({"type": "jv_points", "mode": mode, "cell": cell, "new_curve": sent == 0,
+                          "voltage": [number(v) for v in voltage[sent:]],
+                          "current": [number(c) for c in current[sent:]]})
+
+    def publish_jv_chars(self, results):
+        # The table grows by one column (curve) at a time, a repeated name replaces the last one
+        curves = list(results.columns)
+        for curve in curves[self.chars_sent:] or curves[-1:]:
+            values = [value if isinstance(value, str) else number(value) for value in results[curve]]
+            self.publish({"type": "jv_chars", "curve": curve, "values": dict(zip(JV_CHARS, values))})
+        self.chars_sent = len(results.columns)
+
+    def publish_mpp(self, times, power, cell, cell_name, first):
+        if times:
+            self.publish({"type": "mpp", "cell": cell_name, "new_curve": first, "time_min": number(times[-1]),
+                          "power": number(power[-1])})
+
+    def publish_status(self, text):
+        if text:
+            self.last_status = text
+            self.publish({"type": "status", "text": text})
+
+    def publish_finished(self):
+        self.sent_points = {}
+        self.chars_sent = 0
+        self.publish({"type": "finished", "stopped": self.window.stop_latency is not None,
+                      "stop_latency_ms": self.window.stop_latency,
+                      "error": str(self.window.measurement_error) if self.window.measurement_error else None})
+
+    # Commands, carried out on the GUI thread
+    def request(self, name, body):
+        # From a handler thread: returns (HTTP code, reply)
+        job = {"name": name, "body": body, "done": threading.Event(), "reply": None, "started": False,
+               "cancelled": False}
+        self.command.emit(job)
+        if not job["done"].wait(COMMAND_TIMEOUT):
+            with self.jobs_lock:
+                if not job["started"]:
+                    job["cancelled"] = True
+                    return 504, {"error": "The program did not answer, the command was cancelled"}
+            job["done"].wait()  # Already running, the client gets its reply
+        return job["reply"]
+
+    def run_command(self, job):
+        with self.jobs_lock:
+            if job["cancelled"]:  # The client was told it failed
+                return
+            job["started"] = True
+        try:
+            job["reply"] = getattr(self, "do_" + job["name"])(job["body"])
+        except Exception as error:
+            job["reply"] = 500, {"error": "{}: {}".format(type(error).__name__, error)}
+        job["done"].set()
+
+    def do_status(self, body):
+        window = self.window
+        if window.is_recipe:
+            measurement = "recipe"
+        elif window.is_mpp_measurement:
+            measurement = "mpp"
+        elif window.is_jv_measurement:
+            measurement = "jv"
+        else:
+            measurement = None
+        return 200, {"running": window.engine.isRunning(), "measurement": measurement,
+                     "connecting": window.is_connecting, "status": self.last_status,
+                     "instruments": {"keithley": window.keithley is not None, "relays": window.is_relay,
+                                     "susi": window.is_susi, "temperature": window.is_temperature_sensor},
+                     "lost": sorted(window.watcher.lost) if window.watcher else []}
+
+    def can_start(self, body):
+        if self.window.is_connecting:
+            return 409, {"error": "The instruments are not connected yet"}
+        if self.window.is_meas_live or self.window.engine.isRunning():
+            return 409, {"error": "A measurement is running"}
+        return self.apply_settings(body.get("settings", {}))
+
+    def apply_settings(self, settings):
+        # Fields of the window by name, as in the settings snapshot. Nothing changes if one of them is wrong
+        changes = []
+        for name, value in settings.items():
+            widget = getattr(self.window, name, None)
+            if isinstance(widget, QCheckBox):
+                changes.append((widget.setChecked, bool(value)))
+            elif isinstance(widget, QComboBox) and widget.findText(str(value)) >= 0:
+                changes.append((widget.setCurrentText, str(value)))
+            elif isinstance(widget, QLineEdit):
+                changes.append((widget.setText, str(value)))
+            else:
+                return 400, {"error": "Unknown setting or value: " + name}
+        for change, value in changes:
+            change(value)
+        return None
+
+    def do_start(self, body):
+        if body.get("measurement") not in ("jv", "mpp"):
+            return 400, {"error": 'measurement must be "jv" or "mpp"'}
+        refused = self.can_start(body)
+        if refused:
+            return refused
+        if body["measurement"] == "jv" and self.window.is_tsp:  # Instead of the popup of the window
+            return 409, {"error": "The Keithley is set to the TSP command set, only MPP tracking is possible"}
+        if body["measurement"] == "jv":
+            self.window.jv_start_stop()
+        else:
+            self.window.mpp_start_stop()
+        return 202, {"started": body["measurement"]}
+
+    def do_recipe(self, body):
+        if not body.get("recipe"):
+            return 400, {"error": "recipe missing"}
+        refused = self.can_start(body)
+        if refused:
+            return refused
+        self.window.is_meas_live = True  # As the recipe dialog does
+        self.window.is_recipe = True
+        self.window.measurement_process(body["recipe"].upper())
+        return 202, {"started": "recipe"}
+
+    def do_stop(self, body):
+        if not self.window.is_meas_live:
+            return 409, {"error": "No measurement is running"}
+        self.window.selected_start_stop()
+        return 202, {"stopping": True}
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    api = None  # Set for every server
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, code, content):
+        data = json.dumps(content).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/status":
+            self.reply(*self.api.request("status", {}))
+        elif self.path == "/stream":
+            self.stream()
+        else:
+            self.reply(404, {"error": "Not found"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            return self.reply(400, {"error": "The body must be JSON"})
+        name = self.path.strip("/")
+        if name in ("start", "recipe", "stop"):
+            self.reply(*self.api.request(name, body))
+        else:
+            self.reply(404, {"error": "Not found"})
+
+    def stream(self):
+        websocket = self.headers.get("Upgrade", "").lower() == "websocket"
+        if websocket and not self.headers.get("Sec-WebSocket-Key"):
+            return self.reply(400, {"error": "Sec-WebSocket-Key missing"})
+        if websocket:
+            key = self.headers["Sec-WebSocket-Key"] + WEBSOCKET_GUID
+            self.send_response(101)
+            self.send_header("Upgrade", "websocket")
+            self.send_header("Connection", "Upgrade")
+            self.send_header("Sec-WebSocket-Accept", base64.b64encode(hashlib.sha1(key.encode()).digest()).decode())
+        else:
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.close_connection = True
+
+        subscriber = self.api.subscribe()
+        send_lock = threading.Lock()
+
+        def send(data, closing=False):
+            # Events and the answers of the reader thread, nothing after the close frame
+            with send_lock:
+                if subscriber.closed:
+                    return
+                if closing:
+                    subscriber.close()
+                self.wfile.write(data)
+                self.wfile.flush()
+
+        if websocket:
+            threading.Thread(target=self.read_client, args=(subscriber, send), daemon=True).start()
+        try:
+            while not subscriber.closed:
+                events = subscriber.take(KEEPALIVE)
+                if websocket:
+                    frames = [websocket_frame(json.dumps(event)) for event in events] or [websocket_frame(b"", PING)]
+                else:
+                    frames = ["data: {}\n\n".format(json.dumps(event)).encode() for event in events] or [b": \n\n"]
+                send(b"".join(frames))
+        except OSError:  # The client went away
+            pass
+        finally:
+            subscriber.close()
+            self.api.unsubscribe(subscriber)
+
+    def read_client(self, subscriber, send):
+        # Frames of a WebSocket client: pings are answered, a close is echoed and ends the stream
+        try:
+            while not subscriber.closed:
+                frame = read_websocket_frame(self.rfile)
+                if frame is None:
+                    break
+                opcode, data = frame
+                if opcode == PING:
+                    send(websocket_frame(data, PONG))
+                elif opcode == CLOSE:
+                    send(websocket_frame(data[:2], CLOSE), closing=True)  # Status code of the client
+                    break
+        except OSError:
+            pass
+        finally:
+            subscriber.close()
+
+
+def number(value):
+    # NaN and infinity are not valid JSON
+    value = float(value)
+    return value if math.isfinite(value) else None
+
+
+def websocket_frame(data, opcode=TEXT):
+    # Unmasked frame, as servers send them
+    if isinstance(data, str):
+        data = data.encode()
+    first = 0x80 | opcode  # Final fragment
+    if len(data) < 126:
+        header = bytes([first, len(data)])
+    elif len(data) < 65536:
+        header = bytes([first, 126]) + len(data).to_bytes(2, "big")
+    else:
+        header = bytes([first, 127]) + len(data).to_bytes(8, "big")
+    return header + data
+
+
+def read_websocket_frame(file):
+    # Next frame of a client (masked) as (opcode, data), None once the connection is closed
+    header = file.read(2)
+    if len(header) < 2:
+        return None
+    size = header[1] & 0x7F
+    if size == 126:
+        size = int.from_bytes(file.read(2), "big")
+    elif size == 127:
+        size = int.from_bytes(file.read(8), "big")
+    mask = file.read(4) if header[1] & 0x80 else b"\0\0\0\0"
+    data = file.read(size)
+    if len(data) < size:
+        return None
+    return header[0] & 0x0F, bytes(byte ^ mask[n % 4] for n, byte in enumerate(data))
@@ -0,0 +1,281 @@
+"""
+Unattended measurements without the GUI: python batch.py plan.json
+
+The plan is a JSON file with a list of runs, measured one after the other with the measurement code of the
+GUI (measurement.Station) on its worker thread, and saved as the usual JV_*.txt and MPP_*.txt files, e.g.:
+
+    {"folder": "C:/Data/overnight/",
+     "settings": {"curr_lim": "50", "sweep_mode": "Buffered"},
+     "metadata": {"User": "Edgar", "Material": "MAPbI3"},
+     "runs": [{"sample": "S1", "measurement": "jv", "cells": "abcdef"},
+              {"sample": "S1", "measurement": "recipe", "recipe": "BL,FL,BD", "cells": "ac"},
+              {"sample": "S1", "measurement": "mpp", "cells": "a", "settings": {"mpp_ttime": "60"}}]}
+
+The settings use the names of the GUI fields (see DEFAULT_SETTINGS); the plan settings apply to every run and
+the run settings only to that run. "cells" selects the relay channels, or the single cell without relay card.
+Ctrl+C stops the running measurement (the hardware is left safe) and the rest of the plan. With --simulate the
+plan is measured on simulated instruments, --record and --replay work as in main.py (see sessions.py).
+The exit code tells how the plan ended: 0 measured, 1 stopped (Ctrl+C), 2 a run ended by an error (e.g. a lost
+instrument) and 3 a replay that differs from the recorded session.
+"""
+__author__ = "Edgar R. Nandayapa"
+
+import os
+import re
+import sys
+import json
+import threading
+from time import time, strftime, localtime, sleep, perf_counter
+from types import MappingProxyType
+import numpy as np
+import pandas as pd
+from PyQt5.QtCore import QCoreApplication, Qt
+import engine
+import measurement
+import simulation
+import sessions
+
+MEASUREMENTS = ["jv", "mpp", "recipe"]
+DONE, STOPPED, FAILED, REPLAY_DIFFERS = range(4)  # Exit codes
+CELLS = "abcdef"
+# Same defaults as the fields of the GUI
+DEFAULT_SETTINGS = {"volt_start": "-0.2", "volt_end": "1.2", "volt_step": "0.02", "ave_pts": "3", "int_time": "0.1",
+                    "set_time": "0.1", "curr_lim": "100", "sam_area": "1.0", "pow_dens": "100", "light_soak": "0",
+                    "bias_soak": "0", "susi_intensity": "", "sweep_mode": "Stepped", "average_mode": "PC",
+                    "settle_mode": "Fixed", "settle_tol": "0.5", "ave_target": "0.01", "early_stop": False,
+                    "voc_margin": "0.1", "speed_profile": "Standard", "loop_count": "1", "for_bmL": True,
+                    "rev_bmL": True, "for_bmD": False, "rev_bmD": False, "four_wire": False, "multiplex": True,
+                    "cell_a": True, "cell_b": True, "cell_c": True, "cell_d": True, "cell_e": True, "cell_f": True,
+                    "cell_g": True, "area_a": "0.16", "area_b": "0.16", "area_c": "0.16", "area_d": "0.16",
+                    "area_e": "0.16", "area_f": "0.16", "area_g": "1", "smu_cells": "abcdef", "mpp_ttime": "1",
+                    "mpp_inttime": "100", "mpp_stepSize": "0.001", "mpp_voltage": "0.45", "mpp_mode": "PC"}
+# Metadata labels of the GUI, so the files read the same
+JV_LABELS = {"volt_start": "Voltage_start (V)", "volt_end": "Voltage_end (V)", "volt_step": "Voltage_step (V)",
+             "ave_pts": "Averaged Points", "int_time": "Integration time(s)", "set_time": "Setting time (s)",
+             "curr_lim": "Current limit (mA)", "sam_area": "Cell area(cm²)", "light_soak": "Light soaking (s)",
+             "bias_soak": "Soaking bias (V)", "pow_dens": "Power Density (mW/cm²)"}
+MPP_LABELS = {"mpp_ttime": "Total time (s)", "mpp_inttime": "Integration time (ms)",
+              "mpp_stepSize": "Voltage_step (V)", "mpp_voltage": "Starting Voltage (V)"}
+SUSI_LOG = "C:\\Data\\susi_log.txt"
+
+
+def load_plan(path):
+    """
+    Read and check a plan file, returns it with the settings of every run filled in.
+    """
+    with open(path) as file:
+        plan = json.load(file)
+
+    common = dict(DEFAULT_SETTINGS)
+    common.update(plan.get("settings", {}))
+    runs = []
+    for number, run in enumerate(plan["runs"], 1):
+        if run.get("measurement") not in MEASUREMENTS:
+            raise ValueError("Run {}: measurement must be one of {}".format(number, ", ".join(MEASUREMENTS)))
+        if run["measurement"] == "recipe" and not run.get("recipe"):
+            raise ValueError("Run {}: recipe missing".format(number))
+
+        settings = dict(common)
+        settings.update(run.get("settings", {}))
+        if "cells" in run:
+            settings.update({"cell_" + c: c in run["cells"].lower() for c in CELLS})
+        unknown = set(settings) - set(DEFAULT_SETTINGS)
+        if unknown:
+            raise ValueError("Run {}: unknown settings {}".format(number, ", ".join(sorted(unknown))))
+
+        metadata = dict(plan.get("metadata", {}))
+        metadata.update(run.get("metadata", {}))
+        runs.append({"sample": run.get("sample", ""), "measurement": run["measurement"],
+                     "recipe": run.get("recipe", ""), "settings": settings, "metadata": metadata})
+
+    return {"folder": plan.get("folder", "C:/Data/"), "runs": runs}
+
+
+class BatchRunner(measurement.Station):
+    """
+    Station without widgets: opens the instruments like the GUI and measures the runs of a plan.
+
+    The measurement methods are those of measurement.Station, shared with the GUI, only the state and the
+    metadata that come from the widgets there are set up here.
+    """
+    def __init__(self, ports=None):
+        self.station = None
+        self.station_ports = ports
+        self.acquisition = None
+        self.discovery_thread = None
+        self.watcher = None
+        self.susi_intensity_message = None
+        self.temperature_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.stop_time = None
+        self.stop_latency = None
+        self.measurement_error = None
+
+        self.sample = ""
+        self.metadata = {}
+        self.is_meas_live = False
+        self.is_first_plot = True
+        self.is_recipe = False
+        self.is_jv_measurement = False
+        self.is_mpp_measurement = False
+        self.is_multiplex = False
+        self.real_area = np.nan
+        self.curve_extras = {}
+        self.speed_settings = {}
+        self.last_current_span = {}
+        self.is_loop = False
+        self.settings = MappingProxyType(dict(DEFAULT_SETTINGS))
+
+        # Handlers run on the worker thread, there is no GUI waiting for them
+        self.engine = engine.MeasurementEngine()
+        self.engine.status.connect(self.print_status, Qt.DirectConnection)
+        self.engine.mpp_done.connect(self.save_mpp, Qt.DirectConnection)
+        self.actions = engine.DeviceActions()
+
+        self.open_devices()
+        if self.discovery_thread:
+            self.discovery_thread.start()
+        if not self.acquisition:  # The acquisition server keeps its own connections
+            self.start_watcher()
+        found = {"Keithley": self.keithley is not None, "relay card": self.is_relay, "SuSi": self.is_susi,
+                 "temperature sensor": self.is_temperature_sensor}
+        print("Instruments: " + (", ".join(name for name, ok in found.items() if ok) or "none found"))
+        if self.is_susi:
+            self.susi_startup()
+
+    def print_status(self, text, timeout=0):
+        if text:
+            print(strftime("%H:%M:%S ", localtime()) + text.strip(" #"))
+
+    def susi_startup(self):
+        # Lamp on, at the last intensity logged by the GUI (runs can set their own)
+        self.susi.write(b'C1')  # Enable cooling
+        sleep(1)
+        for i in range(4):  # Because just once does not work
+            self.susi.write(b'L1')  # Light On
+        sleep(2)
+        try:
+            intensity = pd.read_csv(SUSI_LOG, sep="\t")["Lamp Power(%)"].iloc[-1]
+        except:
+            intensity = 90.5
+        self.set_intensity_susim(float(intensity))
+        sleep(1)
+
+    def run_plan(self, plan):
+        """
+        Measure the runs of the plan one after the other, returns the exit code (see the top of this file).
+        """
+        for number, run in enumerate(plan["runs"], 1):
+            self.print_status("Run {} of {}: {} {}".format(number, len(plan["runs"]), run["measurement"].upper(),
+                                                         run["sample"]))
+            if not self.run(plan["folder"], run):
+                if isinstance(self.measurement_error, sessions.ReplayError):
+                    self.print_status("Plan stopped, the replay differs from the recorded session")
+                    return REPLAY_DIFFERS
+                if self.measurement_error:
+                    self.print_status("Plan stopped by an error")
+                    return FAILED
+                self.print_status("Plan stopped")
+                return STOPPED
+        return DONE
+
+    def run(self, folder, run):
+        """
+        Measure one run of the plan and save it, returns False when it was stopped or ended by an error.
+        """
+        settings = dict(run["settings"])
+        if self.is_susi and settings["susi_intensity"] and \
+                "P={:04d}".format(int(float(settings["susi_intensity"]) * 10)).encode() != self.susi_intensity_message:
+            self.set_intensity_susim(float(settings["susi_intensity"]))
+        self.settings = MappingProxyType(settings)
+        self.is_multiplex = settings["multiplex"] and self.is_relay
+        self.sample = run["sample"]
+        self.metadata = run["metadata"]
+        self.folder = folder if folder.endswith("/") else folder + "/"
+        os.makedirs(self.folder, exist_ok=True)
+
+        self.is_jv_measurement = run["measurement"] == "jv"
+        self.is_mpp_measurement = run["measurement"] == "mpp"
+        self.is_recipe = run["measurement"] == "recipe"
+        self.recipe_list = re.split(',| |-|_|;', run["recipe"].upper())  # As typed in the recipe dialog
+        self.start_time = time()
+        self.stop_event.clear()
+        self.is_meas_live = True
+
+        self.engine.start_job(self.measurement_job)
+        try:
+            while not self.engine.wait(200):  # Short waits, so Ctrl+C gets through
+                pass
+        except KeyboardInterrupt:
+            self.stop_time = perf_counter()
+            self.is_meas_live = False
+            self.stop_event.set()
+            self.engine.wait()
+        stopped = self.stop_event.is_set()
+
+        if self.is_jv_measurement or self.is_recipe:
+            try:
+                self.fix_jv_chars_for_save()
+            except:
+                pass
+            self.save_jv()
+        self.is_meas_live = False
+        self.is_jv_measurement = self.is_mpp_measurement = self.is_recipe = False
+
+        return not stopped and self.measurement_error is None
+
+    def gather_all_metadata(self):
+        self.meta_dict = {"Sample": self.sample, "User": self.metadata.get("User", ""), "Folder": self.folder}
+        labels = MPP_LABELS if self.is_mpp_measurement else JV_LABELS
+        for name, label in labels.items():
+            self.meta_dict[label] = self.settings[name]
+
+        self.meta_dict["Date"] = strftime("%H:%M:%S - %d.%m.%Y", localtime(self.start_time))
+        self.meta_dict["Location"] = os.environ.get("COMPUTERNAME", "")
+        for label, value in self.metadata.items():
+            if label not in ("User", "Comments"):
+                self.meta_dict[label] = value
+
+        self.meta_dict["Cell area(cm²)"] = self.real_area
+        if self.is_susi and self.susi_intensity_message:
+            self.meta_dict["SuSi Intensity (%)"] = int(self.susi_intensity_message[2:]) / 10
+        if not self.is_mpp_measurement:
+            for name in ["sweep_mode", "average_mode", "settle_mode", "settle_tol", "ave_target", "early_stop",
+                         "voc_margin", "speed_profile", "loop_count"]:
+                self.meta_dict[name] = self.settings[name]
+        for label, value in self.speed_settings.items():  # Keithley settings actually used
+            self.meta_dict[label] = value
+        if self.is_mpp_measurement:
+            self.meta_dict["MPP tracking"] = self.settings["mpp_mode"]
+        self.meta_dict["Comments"] = self.metadata.get("Comments", "Batch measurement")
+
+    def close(self):
+        # Every device on its own, a lost one must not keep the others open
+        if self.watcher:
+            self.watcher.stop()
+        for keithley in self.keithleys:
+            try:
+                keithley.disable_source()
+            except Exception as error:
+                print("Keithley could not be switched off: {}".format(error))
+        if self.acquisition:
+            self.acquisition.close()
+        elif self.is_susi:
+            try:
+                self.susi.close()
+            except Exception as error:
+                print("SuSi could not be closed: {}".format(error))
+
+
+if __name__ == "__main__":
+    app = QCoreApplication(sys.argv)  # No display needed
+    if "--simulate" in sys.argv:
+        simulation.from_arguments(sys.argv)
+    sessions.from_arguments(sys.argv)
+    plan = load_plan(sys.argv[1])
+    runner = BatchRunner()
+    try:
+        code = runner.run_plan(plan)
+    finally:
+        runner.close()
+    sys.exit(code)
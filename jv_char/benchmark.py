@@ -0,0 +1,281 @@
+"""
+Performance benchmark of the measurement pipeline on simulated instruments: python benchmark.py
+
+Every scenario (full JV sweeps, a multi-cell recipe, MPP tracking) is measured by the GUI (off screen) in a
+process of its own, and reported with its wall time, points per second, wall time per curve, peak memory and the
+time spent in every stage of the pipeline (summed over the threads):
+
+    acquire  accesses to the instruments            analyse  JV parameters and result tables
+    plot     curves and drawing of the canvas       table    table of JV parameters in the window
+    save     writing the data files                 wait     settling, soaking and shutter waits
+
+The results are written as JSON (--output, benchmark.json by default). With --compare old.json the results are
+checked against an earlier run: every metric that got worse by more than --tolerance (10 % by default), and
+every scenario of the earlier run that failed now, is reported as a regression, and the exit code is then 1.
+Other options: --latency <s per Keithley command>, --simulation <file> (see simulation.py) and
+--scenarios jv_stepped,mpp,...
+"""
+__author__ = "Edgar R. Nandayapa"
+
+import os
+import sys
+import json
+import tempfile
+import threading
+import subprocess
+from time import perf_counter, strftime, localtime
+
+SCENARIOS = {"jv_stepped": {"measurement": "jv", "settings": {"sweep_mode": "Stepped"}},
+             "jv_buffered": {"measurement": "jv", "settings": {"sweep_mode": "Buffered"}},
+             "recipe": {"measurement": "recipe", "recipe": "BL,FL,BD,FD", "settings": {"sweep_mode": "Buffered"}},
+             "mpp": {"measurement": "mpp", "settings": {"mpp_ttime": "0.1", "mpp_inttime": "50", "cell_c": False,
+                                                        "cell_d": False, "cell_e": False, "cell_f": False}}}
+# On top of the batch defaults (not the saved settings of the GUI), so runs of different versions compare
+SETTINGS = {"LEsample": "benchmark", "set_time": "0.01", "speed_profile": "Fast", "susi_intensity": "100"}
+STAGES = {"analyse": ["jv_chars_calculation", "store_curve_results", "store_loop_results", "fix_jv_chars_for_save",
+                      "mpp_data"],
+          "plot": ["plot_jv", "plot_mpp", "plot_loop_trend", "reset_plot_jv", "reset_plot_mpp"],
+          "table": ["show_jv_chars"],
+          "save": ["save_jv", "save_mpp"],
+          "wait": ["pause"]}
+HIGHER_IS_BETTER = ["points_per_s"]
+TOLERANCE = 0.1
+MIN_CHANGE = {"s": 0.02, "mb": 2.0}  # Smaller changes are noise, whatever their fraction
+
+
+class StageTimes:
+    """
+    Time per stage. Only the outermost stage of a thread is counted, so nested stages are not counted twice.
+    """
+    def __init__(self):
+        self.seconds = {stage: 0.0 for stage in ["acquire"] + list(STAGES)}
+        self.lock = threading.Lock()
+        self.depth = threading.local()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.seconds[stage] += seconds
+
+    def timed(self, stage, function):
+        def timed_function(*args, **kwargs):
+            if getattr(self.depth, "level", 0):
+                return function(*args, **kwargs)
+            self.depth.level = 1
+            start = perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.depth.level = 0
+                self.add(stage, perf_counter() - start)
+        return timed_function
+
+
+def peak_memory_mb():
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # kB (bytes on macOS)
+        return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+    except ImportError:  # Windows
+        import ctypes
+        from ctypes import wintypes
+
+        class Counters(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+        counters = Counters()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.psapi.GetProcessMemoryInfo(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters),
+                                                 counters.cb)
+        return counters.PeakWorkingSetSize / 1024 ** 2
+
+
+def run_scenario(name, latency=None):
+    """
+    Measure one scenario in this process (the window is created here), returns its metrics.
+    """
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    if "--simulate" not in sys.argv:
+        sys.argv.append("--simulate")  # The window searches simulated instruments
+    from PyQt5 import QtWidgets
+    import main
+    import batch
+    import sessions
+    import simulation
+
+    if "--simulation" in sys.argv:
+        simulation.configure(sys.argv[sys.argv.index("--simulation") + 1])
+    if latency is not None:
+        simulation.CONFIG["keithley"]["latency"] = latency
+
+    stages = StageTimes()
+    sessions.recorder = AcquireTimes(stages)
+    main.MplCanvas.draw = stages.timed("plot", main.MplCanvas.draw)
+    window_class = type("BenchmarkWindow", (main.MainWindow,),
+                        {method: stages.timed(stage, getattr(main.MainWindow, method))
+                         for stage, methods in STAGES.items() for method in methods})
+    window_class.popup_message = lambda self, text: None  # Nobody to close them
+
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication(sys.argv)
+    window = window_class()
+    while not window.BStart.isEnabled():  # Instruments connected
+        app.processEvents()
+        window.engine.msleep(5)
+
+    scenario = SCENARIOS[name]
+    settings = dict(batch.DEFAULT_SETTINGS, **SETTINGS)
+    settings.update(scenario["settings"])
+    settings["LEfolder"] = tempfile.mkdtemp(prefix="jv_benchmark_") + "/"
+    for field, value in settings.items():
+        window.set_widget_value(getattr(window, field), str(value))
+
+    counts = {"curves": 0, "points": 0, "last": 0}
+
+    def count(values, first):
+        if first:
+            counts["curves"] += 1
+            counts["last"] = 0
+        counts["points"] += len(values) - counts["last"]
+        counts["last"] = len(values)
+    window.engine.jv_curve.connect(lambda voltage, current, mode, counter, first: count(voltage, first))
+    window.engine.mpp_curve.connect(lambda times, power, counter, cell, first: count(times, first))
+    finished = []
+    window.engine.finished.connect(lambda: finished.append(perf_counter()))  # After the window saved the data
+
+    for stage in stages.seconds:  # Only the measurement
+        stages.seconds[stage] = 0.0
+    start = perf_counter()
+    if scenario["measurement"] == "jv":
+        window.jv_start_stop()
+    elif scenario["measurement"] == "mpp":
+        window.mpp_start_stop()
+    else:
+        window.is_meas_live = True
+        window.is_recipe = True
+        window.measurement_process(scenario["recipe"])
+    while not finished:
+        app.processEvents()
+        window.engine.msleep(1)
+    wall = finished[0] - start
+
+    return {"wall_s": wall, "curves": counts["curves"], "points": counts["points"],
+            "points_per_s": counts["points"] / wall, "wall_per_curve_s": wall / max(counts["curves"], 1),
+            "stages_s": stages.seconds, "peak_memory_mb": peak_memory_mb()}
+
+
+class AcquireTimes:
+    # Takes the place of the session recorder (sessions.py), which already sees every instrument access
+    def __init__(self, stages):
+        self.stages = stages
+
+    def wrap(self, kind, port, device):
+        import sessions
+        if isinstance(device, list):
+            return [self.wrap(kind, port, relay) for relay in device]
+        return sessions.RecordedDevice(self, kind, device)
+
+    def log(self, device, access, attribute, arguments, keywords, result, start, duration):
+        if not getattr(self.stages.depth, "level", 0):  # Already counted in the stage that accessed the instrument
+            self.stages.add("acquire", duration)
+
+
+def metrics(result):
+    # Flat {name: value} of the numbers that can be compared
+    flat = {}
+    for name, value in result.items():
+        if isinstance(value, dict):
+            flat.update({name + "." + stage: seconds for stage, seconds in value.items()})
+        elif isinstance(value, (int, float)) and name not in ("curves", "points"):
+            flat[name] = value
+    return flat
+
+
+def compare(old, new, tolerance=TOLERANCE):
+    """
+    Regressions of the new results against the old ones: [(scenario, metric, old value, new value)], a scenario
+    without new results (it failed) is [(scenario, None, None, None)]
+    """
+    regressions = [(scenario, None, None, None) for scenario in old["scenarios"]
+                   if scenario not in new["scenarios"] and scenario in new.get("requested", new["scenarios"])]
+    for scenario, result in new["scenarios"].items():
+        if scenario not in old["scenarios"]:
+            continue
+        before = metrics(old["scenarios"][scenario])
+        for metric, value in metrics(result).items():
+            if metric not in before:
+                continue
+            change = before[metric] - value if metric in HIGHER_IS_BETTER else value - before[metric]
+            minimum = MIN_CHANGE["mb"] if metric.endswith("_mb") else MIN_CHANGE["s"]
+            if metric in HIGHER_IS_BETTER:
+                minimum = 0
+            if change > tolerance * abs(before[metric]) and change > minimum:
+                regressions.append((scenario, metric, before[metric], value))
+    return regressions
+
+
+def version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=os.path.dirname(__file__) or ".",
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def option(name, default=None):
+    return sys.argv[sys.argv.index(name) + 1] if name in sys.argv else default
+
+
+def run_all():
+    names = option("--scenarios", ",".join(SCENARIOS)).split(",")
+    results = {"version": version(), "date": strftime("%Y-%m-%d %H:%M:%S", localtime()),
+               "python": sys.version.split()[0], "latency_s": float(option("--latency", 0)) or None,
+               "simulation": option("--simulation"),
+               "settings": SETTINGS, "requested": names, "scenarios": {}}
+
+    arguments = sys.argv[1:]
+    if "--simulation" in arguments:  # The scenarios run in another folder
+        position = arguments.index("--simulation") + 1
+        arguments[position] = os.path.abspath(arguments[position])
+    for name in names:
+        # Every scenario in a new process, so the peak memory is its own
+        command = [sys.executable, os.path.abspath(__file__), "--run", name] + arguments
+        process = subprocess.run(command, capture_output=True, text=True,
+                                 cwd=tempfile.mkdtemp(prefix="jv_benchmark_"))  # Files of the window, e.g. logs
+        lines = [line for line in process.stdout.splitlines() if line.startswith("{")]
+        if not lines:
+            print(name + " failed:\n" + process.stdout[-2000:] + process.stderr[-2000:])
+            continue
+        result = json.loads(lines[-1])
+        results["scenarios"][name] = result
+        stages = ", ".join("{} {:.2f}".format(stage, seconds) for stage, seconds in result["stages_s"].items())
+        print("{:<12}{:7.2f} s {:4d} curves {:6d} points {:8.1f} points/s {:6.2f} s/curve {:6.0f} MB  ({} s)".format(
+            name, result["wall_s"], result["curves"], result["points"], result["points_per_s"],
+            result["wall_per_curve_s"], result["peak_memory_mb"], stages))
+
+    with open(option("--output", "benchmark.json"), "w") as file:
+        json.dump(results, file, indent=1)
+
+    if "--compare" in sys.argv:
+        with open(option("--compare")) as file:
+            old = json.load(file)
+        regressions = compare(old, results, float(option("--tolerance", TOLERANCE)))
+        for scenario, metric, before, after in regressions:
+            if metric is None:
+                print("REGRESSION {}: failed".format(scenario))
+            else:
+                print("REGRESSION {} {}: {:.4g} -> {:.4g}".format(scenario, metric, before, after))
+        if not regressions:
+            print("No regressions against " + (old.get("version") or option("--compare")))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    if "--run" in sys.argv:
+        latency = option("--latency")
+        print(json.dumps(run_scenario(option("--run"), float(latency) if latency else None)))
+        sys.stdout.flush()
+        os._exit(0)  # Without the close dialog of the window
+    sys.exit(run_all())
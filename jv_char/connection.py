@@ -0,0 +1,103 @@
+"""
+Watcher of the instrument connections during a session.
+
+A device that drops off USB is noticed when its port disappears (or when the program reports a failed access)
+and is reopened as soon as it is back, on the same port or on a new one that answers its handshake.
+"""
+__author__ = "Edgar R. Nandayapa"
+
+import threading
+import serial.tools.list_ports
+import discovery
+import simulation
+import sessions
+
+CHECK_INTERVAL = 2  # s between two looks at the ports
+WAIT_POLL = 0.05  # s, how often a paused measurement checks for STOP
+
+
+class ConnectionWatcher(threading.Thread):
+    """
+    Reopens the lost instruments once they are back.
+
+    "reconnect(name, port)" must reopen the device and restore its configuration; when it fails, it is tried
+    again at the next check. "on_change(name, connected)" is called on this thread, for every loss and every
+    reconnection.
+    """
+    def __init__(self, ports, reconnect, on_change):
+        super(ConnectionWatcher, self).__init__(daemon=True)
+        self.ports = dict(ports)  # Device name: VISA resource or serial port
+        self.reconnect = reconnect
+        self.on_change = on_change
+        self.lost = {}  # Device name: ports present when it was lost
+        self.present = set()
+        self.quit = threading.Event()
+        self.rm = None
+
+    def run(self):
+        if "keithley" in self.ports:
+            try:
+                import pyvisa as visa
+                self.rm = visa.ResourceManager()
+            except:
+                pass
+        self.present = self.present_ports()
+
+        while not self.quit.wait(CHECK_INTERVAL):
+            self.present = self.present_ports()
+            for name, port in self.ports.items():
+                if port not in self.present:
+                    self.mark_lost(name)
+
+            for name in list(self.lost):
+                port = self.ports[name]
+                if port not in self.present:
+                    port = self.find(name)
+                if port is None:
+                    continue
+                try:
+                    self.reconnect(name, port)
+                except Exception:
+                    continue
+                self.ports[name] = port
+                self.lost.pop(name, None)
+                self.on_change(name, True)
+
+    def present_ports(self):
+        ports = {port.device for port in serial.tools.list_ports.comports()}
+        ports |= simulation.present_ports() | sessions.present_ports()
+        if self.rm is not None:
+            try:
+                ports.update(self.rm.list_resources())
+            except:
+                pass
+        return ports
+
+    def find(self, name):
+        # Handshake on the ports that appeared since the device was lost (and belong to no other device)
+        for port in sorted(self.present - self.lost[name] - set(self.ports.values())):
+            is_visa = "::" in port
+            if name == "keithley":
+                if is_visa and not port.startswith("ASRL") and discovery.probe_keithley(self.rm, port):
+                    return port
+            elif not is_visa and discovery.probe(name, port):
+                return port
+        return None
+
+    def mark_lost(self, name):
+        # Also called by the measurement when an access fails before the port is seen missing
+        if name in self.ports and name not in self.lost:
+            self.lost[name] = set(self.present)
+            self.on_change(name, False)
+
+    def is_lost(self, name):
+        return name in self.lost
+
+    def wait_reconnected(self, name, stop_event):
+        # Blocks until the device is back (True) or STOP is pressed (False)
+        while name in self.lost and not stop_event.wait(WAIT_POLL):
+            pass
+        return name not in self.lost
+
+    def stop(self):
+        self.quit.set()
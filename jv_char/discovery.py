@@ -0,0 +1,154 @@
+"""
+Discovery of the instruments at start-up.
+
+Every VISA resource and serial port is probed at the same time with short timeouts, and the devices are
+recognised by their answer to a handshake instead of the port description. The port map is cached, so the
+next start-up only has to check the known ports.
+"""
+__author__ = "Edgar R. Nandayapa"
+
+import os
+import re
+import json
+from time import perf_counter
+from concurrent.futures import ThreadPoolExecutor
+import serial
+import serial.tools.list_ports
+
+CACHE_FILE = "C:\\Data\\device_ports.json"
+PROBE_TIMEOUT = 0.5  # s, for devices that answer a request
+TEMPERATURE_TIMEOUT = 3  # s, the Arduino restarts when the port is opened and then prints a line every second
+TEMPERATURE_LINE = re.compile(rb"-?\d+\.\d+\s*$")
+RELAY_QUERY = bytes([0x04, 0x18, 0x00, 0x00, 0x00, 0xE4, 0x0F])  # K8090 "query relay status" packet
+SERIAL_DEVICES = ["susi", "relays", "temperature"]  # Order of the handshakes on an unknown port
+DESCRIPTIONS = {"relays": "USB Serial Device", "susi": "USB Serial Port", "temperature": "USB-SERIAL CH340"}
+
+
+def probe_keithley(rm, resource):
+    try:
+        instrument = rm.open_resource(resource, open_timeout=int(PROBE_TIMEOUT * 1000))
+        instrument.timeout = int(PROBE_TIMEOUT * 1000)
+        try:
+            return "2450" in instrument.query("*IDN?")
+        finally:
+            instrument.close()
+    except:
+        return False
+
+
+def probe_susi(port):
+    with serial.Serial(port, 9600, timeout=PROBE_TIMEOUT) as connection:
+        connection.write(b'FS')  # Status
+        return b"SHUTTER" in connection.read_until(b"END\r\n")
+
+
+def probe_relays(port):
+    with serial.Serial(port, 19200, timeout=PROBE_TIMEOUT) as connection:
+        connection.write(RELAY_QUERY)
+        answer = connection.read(7)
+        return len(answer) == 7 and answer[:2] == b"\x04\x51" and answer[-1:] == b"\x0f"
+
+
+def probe_temperature(port):
+    # Only listens, the sensor prints its readings by itself (the first line can be cut)
+    with serial.Serial(port, 9600, timeout=TEMPERATURE_TIMEOUT) as connection:
+        start = perf_counter()
+        while perf_counter() - start < TEMPERATURE_TIMEOUT:
+            if TEMPERATURE_LINE.search(connection.readline()):
+                return True
+    return False
+
+
+PROBES = {"susi": probe_susi, "relays": probe_relays, "temperature": probe_temperature}
+
+
+def probe(name, port):
+    try:
+        return PROBES[name](port)
+    except:  # Busy, missing or not answering
+        return False
+
+
+def identify_port(port, description=""):
+    # Handshakes one after another, starting with the device the description points to
+    order = sorted(SERIAL_DEVICES, key=lambda name: DESCRIPTIONS[name] != description.split(" (")[0])
+    for name in order:
+        if probe(name, port):
+            return name
+    return None
+
+
+def discover(skip=()):
+    """
+    Probe all VISA resources and serial ports (except "skip") at the same time.
+
+    Returns the port map: the Keithley resources as a list, and the serial port of every other device (or None).
+    """
+    try:
+        import pyvisa as visa  # Not needed before the search
+        rm = visa.ResourceManager()
+        resources = [r for r in rm.list_resources() if not r.startswith("ASRL") and r not in skip]
+    except:
+        rm, resources = None, []
+    ports = [port for port in serial.tools.list_ports.comports() if port.device not in skip]
+
+    with ThreadPoolExecutor(max_workers=max(len(resources) + len(ports), 1)) as pool:
+        keithleys = [pool.submit(probe_keithley, rm, resource) for resource in resources]
+        serials = [pool.submit(identify_port, port.device, port.description) for port in ports]
+
+        found = {"keithley": [resource for resource, ok in zip(resources, keithleys) if ok.result()]}
+        for name in SERIAL_DEVICES:
+            found[name] = None
+        for port, name in zip(ports, serials):
+            if name.result() and found[name.result()] is None:
+                found[name.result()] = port.device
+
+    return found
+
+
+def verify(cached):
+    """
+    Check the cached port map with one handshake per device, all at the same time.
+
+    The temperature sensor is not checked here, since listening to it takes seconds (see the caller).
+    Returns the port map with None (or fewer Keithleys) for the devices that did not answer.
+    """
+    try:
+        import pyvisa as visa
+        rm = visa.ResourceManager()
+    except:
+        rm = None
+    resources = cached.get("keithley", [])
+    checks = [name for name in ("susi", "relays") if cached.get(name)]
+
+    with ThreadPoolExecutor(max_workers=len(resources) + len(checks) + 1) as pool:
+        keithleys = [pool.submit(probe_keithley, rm, resource) for resource in resources]
+        serials = [pool.submit(probe, name, cached[name]) for name in checks]
+
+        verified = {"keithley": [resource for resource, ok in zip(resources, keithleys) if ok.result()],
+                    "temperature": cached.get("temperature")}
+        for name in ("susi", "relays"):
+            verified[name] = None
+        for name, ok in zip(checks, serials):
+            if ok.result():
+                verified[name] = cached[name]
+
+    return verified
+
+
+def load_cache():
+    try:
+        with open(CACHE_FILE) as file:
+            return json.load(file)
+    except:
+        return None
+
+
+def save_cache(ports):
+    if not os.path.isdir(os.path.dirname(CACHE_FILE)):  # Data folder of this PC
+        return
+    try:
+        with open(CACHE_FILE, "w") as file:
+            json.dump(ports, file, indent=1)
+    except:
+        print("Device ports could not be cached in " + CACHE_FILE)
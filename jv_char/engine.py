@@ -0,0 +1,82 @@
+"""
+Worker thread that runs the measurements, so the GUI stays responsive while the instruments are busy.
+"""
+__author__ = "Edgar R. Nandayapa"
+
+import threading
+import traceback
+from PyQt5.QtCore import QThread, pyqtSignal
+
+
+class MeasurementEngine(QThread):
+    """
+    Runs a measurement job outside of the GUI thread.
+
+    The job must not touch any widget. Everything the GUI has to show (status messages, live values, curves,
+    results) is sent through the signals below, which Qt delivers to the GUI thread.
+    """
+    status = pyqtSignal(str, int)  # Message, timeout (ms)
+    live_voltage = pyqtSignal(float, bool)  # Value, live
+    live_current = pyqtSignal(float, bool)
+    jv_curve = pyqtSignal(list, list, str, int, bool)  # Voltage, current, mode, cell number, first curve
+    mpp_curve = pyqtSignal(list, list, int, str, bool)  # Time, power, cell number, cell name, first curve
+    loop_trend = pyqtSignal(int, str, int, float)  # Cell number, direction, loop, PCE
+    jv_chars = pyqtSignal(object)  # Copy of the JV parameters table
+    shutter = pyqtSignal(str)  # Text of the shutter button
+    mpp_done = pyqtSignal(str, object)  # Cell name and tracked data, saved by the GUI
+
+    def __init__(self, parent=None):
+        super(MeasurementEngine, self).__init__(parent)
+        self.job = None
+
+    def start_job(self, job):
+        self.job = job
+        self.start()
+
+    def run(self):
+        try:
+            self.job()
+        except:
+            traceback.print_exc()
+
+
+class DeviceActions:
+    """
+    Hardware actions (shutter moves, relay switching...) that run in the background of the measurement.
+
+    Every action runs on its own thread, after the actions named in "after" are finished, and only one action
+    per name (device) runs at a time. wait() is the interlock: the measurement calls it before anything that
+    needs a device in its final state, e.g. no sweep until the shutter is in place.
+    """
+    def __init__(self):
+        self.threads = {}
+        self.errors = {}
+
+    def start(self, name, action, *args, after=()):
+        self.join(name)
+        required = [self.threads[n] for n in after if n in self.threads]
+        self.errors.pop(name, None)
+
+        def run():
+            for thread in required:
+                thread.join()
+            try:
+                action(*args)
+            except Exception as error:
+                self.errors[name] = error
+
+        thread = threading.Thread(target=run, name=name, daemon=True)
+        self.threads[name] = thread
+        thread.start()
+
+    def join(self, name):
+        thread = self.threads.get(name)
+        if thread is not None:
+            thread.join()
+
+    def wait(self, *names):
+        # Block until the named actions (all if none given) are finished, their errors are raised here
+        for name in names or list(self.threads):
+            self.join(name)
+            if name in self.errors:
+                raise self.errors.pop(name)
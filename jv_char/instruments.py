@@ -0,0 +1,219 @@
+"""
+Instrument helpers shared by the JV characteristics program.
+"""
+__author__ = "Edgar R. Nandayapa"
+
+import functools
+import serial
+import simulation
+import sessions
+
+
+class ShadowKeithley:
+    """
+    Mirror of the settings applied to a Keithley2450, so that only settings that change are sent.
+
+    Configuration properties and commands are remembered after they are written, and writing the same value
+    again is skipped (and counted). Command headers are compared without the leading colon and in upper case.
+    Buffer and trigger commands pass through without touching the mirror (list sweeps only forget the source
+    voltage they change), while any other command (resets, scripts...) clears it, since the instrument state is
+    then unknown. Everything else is forwarded to the wrapped instrument.
+    """
+    # Property name: mirror key. Properties and commands sharing a key overwrite each other
+    CACHED_PROPERTIES = {"source_mode": "SOUR:FUNC", "source_voltage": "SOUR:VOLT", "source_voltage_range":
+                         "SOUR:VOLT:RANG", "compliance_current": "SOUR:VOLT:ILIM", "current_range": "SENS:CURR:RANG",
+                         "current_nplc": "SENS:CURR:NPLC", "wires": "SENS:RES:RSEN"}
+    # Command header (see header): mirror key
+    CONFIG_COMMANDS = {"SENS:FUNC": "SENS:FUNC", "SENS:CURR:NPLC": "SENS:CURR:NPLC", "SENS:CURR:RANG:AUTO":
+                       "SENS:CURR:RANG", "SOUR:VOLT:RANG:AUTO": "SOUR:VOLT:RANG", "SENS:CURR:RSEN": "SENS:CURR:RSEN",
+                       "SENS:COUN": "SENS:COUN", "SENS:CURR:AZER": "SENS:CURR:AZER", "OUTPUT": "OUTPUT"}
+    NEUTRAL_COMMANDS = ("TRAC:CLE", "TRAC:TRIG", "TRAC:DATA?", "TRAC:ACT?", "SOUR:LIST:VOLT", "AZER:ONCE", "ABOR",
+                        "TRIG:STAT?", "*WAI", "READ?")
+    SWEEP_COMMANDS = ("SOUR:SWE:VOLT:LIST", "INIT")  # Leave the source at another voltage
+
+    def __init__(self, instrument):
+        object.__setattr__(self, "instrument", instrument)
+        object.__setattr__(self, "state", {})
+        object.__setattr__(self, "origins", {})  # Mirror key: property or command header that set it
+        object.__setattr__(self, "sent_writes", 0)
+        object.__setattr__(self, "skipped_writes", 0)
+
+    def __getattr__(self, name):
+        return getattr(self.instrument, name)
+
+    def __setattr__(self, name, value):
+        if name in self.CACHED_PROPERTIES:
+            if self.is_applied(self.CACHED_PROPERTIES[name], value, name):
+                return
+            setattr(self.instrument, name, value)
+        else:
+            object.__setattr__(self, name, value)
+
+    def is_applied(self, key, value, origin):
+        # True if the value is already set (write skipped), otherwise remember it so the caller sends it
+        if key in self.state and self.state[key] == value:
+            object.__setattr__(self, "skipped_writes", self.skipped_writes + 1)
+            return True
+        self.state[key] = value
+        self.origins[key] = origin
+        object.__setattr__(self, "sent_writes", self.sent_writes + 1)
+        return False
+
+    def forget(self, *keys):
+        # Use when the instrument may have been changed behind the mirror (only "keys" if given)
+        if keys:
+            for key in keys:
+                self.state.pop(key, None)
+                self.origins.pop(key, None)
+        else:
+            self.state.clear()
+            self.origins.clear()
+
+    @staticmethod
+    def header(command):
+        # SCPI headers are not case sensitive, and the leading colon is optional
+        return command.upper().lstrip(":")
+
+    def write(self, command, **kwargs):
+        settings = []
+        for part in command.split(";"):
+            header, _, value = part.strip().partition(" ")
+            if self.header(header) in self.CONFIG_COMMANDS:
+                try:
+                    value = float(value)
+                except ValueError:
+                    value = value.strip().upper()
+                settings.append((self.CONFIG_COMMANDS[self.header(header)], value, header))
+            elif self.header(header).startswith(self.SWEEP_COMMANDS):
+                self.forget("SOUR:VOLT")
+            elif not self.header(header).startswith(self.NEUTRAL_COMMANDS):
+                # Unknown effect on the instrument, trust nothing after it
+                self.forget()
+                settings = []
+                break
+
+        if len(settings) == 1 and ";" not in command:
+            if self.is_applied(*settings[0]):
+                return
+        else:
+            for key, value, origin in settings:
+                self.state[key] = value
+                self.origins[key] = origin
+            object.__setattr__(self, "sent_writes", self.sent_writes + 1)
+
+        self.instrument.write(command, **kwargs)
+
+    def reconnect(self, instrument):
+        """
+        Wrap a reopened instrument and send it the remembered settings again (the output is switched last).
+        """
+        settings = sorted(self.state.items(), key=lambda item: item[0] == "OUTPUT")
+        origins = dict(self.origins)
+        object.__setattr__(self, "instrument", instrument)
+        self.forget()
+
+        for key, value in settings:
+            if origins[key] in self.CACHED_PROPERTIES:
+                setattr(self, origins[key], value)
+            else:
+                self.write("{} {}".format(origins[key], "{:g}".format(value) if isinstance(value, float) else value))
+
+    # Same configuration as the pymeasure methods, but split into mirrored settings
+    def apply_voltage(self, voltage_range=None, compliance_current=0.1):
+        self.source_mode = "voltage"
+        if voltage_range is None:
+            self.write(":SOUR:VOLT:RANG:AUTO 1")
+        else:
+            self.source_voltage_range = voltage_range
+        self.compliance_current = compliance_current
+
+    def measure_current(self, nplc=1, current=1.05e-4, auto_range=True):
+        self.write(":SENS:FUNC 'CURR'")
+        self.write(":SENS:CURR:NPLC {:g}".format(nplc))
+        if auto_range:
+            self.write(":SENS:CURR:RANG:AUTO 1")
+        else:
+            self.current_range = current
+
+    def enable_source(self):
+        self.write("OUTPUT ON")
+
+    def disable_source(self):
+        self.write("OUTPUT OFF")
+
+
+class ShadowRelay:
+    """
+    Relay of the relay card that remembers whether it is on, so it can be switched back after a reconnection.
+    """
+    def __init__(self, relay):
+        self.relay = relay
+        self.is_on = False
+
+    def on(self):
+        self.relay.on()
+        self.is_on = True
+
+    def off(self):
+        self.relay.off()
+        self.is_on = False
+
+    def reconnect(self, relay):
+        self.relay = relay
+        if self.is_on:
+            self.relay.on()
+
+
+def opener(kind):
+    # Replayed, simulated or real device, wrapped by the recorder when the session is recorded
+    def decorator(open_real):
+        @functools.wraps(open_real)
+        def open_device(port):
+            if sessions.player:
+                return sessions.player.open_device(kind, port)
+            if simulation.is_simulated(port):
+                device = simulation.open_device(kind, port)
+            else:
+                device = open_real(port)
+            if sessions.recorder:
+                device = sessions.recorder.wrap(kind, port, device)
+            return device
+        return open_device
+    return decorator
+
+
+@opener("keithley")
+def open_keithley(resource):
+    # PyMeasure (and PyVISA) are only imported once a Keithley is opened
+    from pymeasure.instruments.keithley import Keithley2450
+    return Keithley2450(resource)
+
+
+@opener("relays")
+def open_relays(port):
+    from k8090 import relay_card
+    relaycard = relay_card.connect(port)
+    relaycard.factory_reset()
+
+    return [relaycard.relays[r] for r in range(8)]
+
+
+@opener("susi")
+def open_susi(port):
+    susi = serial.Serial(port)
+    susi.baudrate = 9600
+    susi.bytesize = 8
+    susi.parity = 'N'
+    susi.stopbits = 1
+    susi.timeout = 5
+
+    return susi
+
+
+@opener("temperature")
+def open_temperature_sensor(port):
+    return serial.Serial(port, 9600, timeout=1)
+
+
+DEVICE_OPENERS = {"keithley": open_keithley, "relays": open_relays, "susi": open_susi,
+                  "temperature": open_temperature_sensor}
@@ -2,30 +2,32 @@ __author__ = "Edgar R. Nandayapa"
 __version__ = "1.1"
 
 import sys
+import startup  # Times the imports below
+startup.time_imports()
 import matplotlib
 from PyQt5 import QtWidgets, QtGui, QtTest
 from PyQt5.QtWidgets import QWidget, QLineEdit, QFormLayout, QHBoxLayout, QVBoxLayout, QSpacerItem, QGridLayout
 from PyQt5.QtWidgets import QFrame, QPushButton, QCheckBox, QLabel, QToolButton, QTextEdit, QTextBrowser
-from PyQt5.QtWidgets import QSizePolicy, QMessageBox, QDialog,QInputDialog
+from PyQt5.QtWidgets import QSizePolicy, QMessageBox, QDialog,QInputDialog, QComboBox
 from PyQt5.QtGui import QFont, QColor, QPixmap
 from PyQt5.QtWidgets import QTableView
-from PyQt5.QtCore import QAbstractTableModel, Qt, QTimer
+from PyQt5.QtCore import QAbstractTableModel, Qt, QTimer, pyqtSignal
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg, NavigationToolbar2QT as NavigationToolbar
 from matplotlib.figure import Figure
 from matplotlib import rcParams
 from glob import glob
-from pymeasure.instruments.keithley import Keithley2450
-from sklearn.linear_model import LinearRegression
-import pyvisa as visa
 import pandas as pd
 import numpy as np
 import os
 import re
-from k8090 import relay_card
-import serial.tools.list_ports
-import serial
-from time import time, strftime, localtime, gmtime
+from time import time, strftime, localtime, perf_counter
 from datetime import datetime
+from types import MappingProxyType
+import threading
+import multiprocessing
+import engine
+import measurement
+startup.end_imports()
 
 rcParams.update({'figure.autolayout': True})
 matplotlib.use('Qt5Agg')
@@ -112,14 +114,18 @@ class MplCanvas(FigureCanvasQTAgg):
         super(MplCanvas, self).__init__(fig)
 
 
-class MainWindow(QtWidgets.QMainWindow):
+class MainWindow(QtWidgets.QMainWindow, measurement.Station):
+    devices_ready = pyqtSignal()  # The instruments are connected (or not found)
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, station=None, ports=None, **kwargs):
+        # "station" and its "ports" are given when several stations run from this program (see stations.py)
         super(MainWindow, self).__init__(*args, **kwargs)
 
         # Initialize parameters
+        self.station = station
+        self.station_ports = ports
         self.gui_temp_timer = QTimer(self)
-        self.setWindowTitle("JV Characteristics")
+        self.setWindowTitle("JV Characteristics" + (" - " + station if station else ""))
         # folder = os.path.abspath(os.getcwd()) + "\\"
         self.setWindowIcon(QtGui.QIcon(os.path.join(EXE_LOCATION, "..", "Resources", "solar.ico")))
         np.seterr(divide='ignore', invalid='ignore')
@@ -127,71 +133,61 @@ class MainWindow(QtWidgets.QMainWindow):
 
         self.statusBar().showMessage("Starting up, please wait", 10000)
 
-        #  Keithley configuration
-        try:
-            rm = visa.ResourceManager()  # Load piVisa
-            device = rm.list_resources()[0]  # Get the first keithley on the list
-            self.keithley = Keithley2450(device)
-            self.keithley.wires = 4
-        except:
-            device = None
-            self.keithley = None
-            self.statusBar().showMessage("##    Keithley not found    ##")
-
-        port_list = self.list_com_ports()  # Get all the devices names
-
-        # Relay card configuration
-        try:
-            relay_port_name = "USB Serial Device"
-            self.relaycard = relay_card.connect(port_list[relay_port_name])
-            self.relaycard.factory_reset()
-            self.is_relay = True
-
-            self.relays = []
-            for r in range(8):
-                self.relays.append(self.relaycard.relays[r])
-        except:
-            ports = serial.tools.list_ports.comports()
-            self.is_relay = False
-            print("relay not found")
-
-        # SUSI configuration
-        try:
-            susi_port_name = "USB Serial Port"
-            self.susi = serial.Serial(port_list[susi_port_name])
-            self.susi.baudrate = 9600
-            self.susi.bytesize = 8
-            self.susi.parity = 'N'
-            self.susi.stopbits = 1
-            self.susi.timeout = 5
-            self.is_susi = True
-            self.is_shutter_open = False
-
-        except:
-            self.is_susi = False
-            self.is_shutter_open = False
-
-            if not self.keithley:
-                self.statusBar().showMessage("##    Keithley and susi not found    ##")
-                self.popup_message("  Keithley and SuSim\n"
-                                   "were not found")
-            else:
-                self.statusBar().showMessage("##    susi not found    ##")
-                self.popup_message("    SuSim\n"
-                                   "was not found")
-
-        # Arduino temperature sensor configuration
-        try:
-            susi_port_name = "USB-SERIAL CH340"
-            self.senseTemp = serial.Serial(port_list[susi_port_name], 9600, timeout=1)
-            self.is_temperature_sensor = True
-        except:
-            self.is_temperature_sensor = False
+        # The window is shown first, the instruments are connected afterwards (see connect_devices)
+        self.ports = {"keithley": [], "relays": None, "susi": None, "temperature": None}
+        self.acquisition = None
+        self.discovery_thread = None
+        self.keithley = None
+        self.keithleys = []
+        self.is_tsp = False
+        self.is_relay = False
+        self.is_susi = False
+        self.is_shutter_open = False
+        self.is_temperature_sensor = False
+        self.is_connecting = True  # Until devices_connected
+        self.watcher = None  # Reconnects the instruments that drop off USB
+        self.susi_intensity_message = None  # Last intensity sent to the SuSi
+
+        self.temperature_lock = threading.Lock()  # The sensor is read by the GUI timer and the measurements
+        self.stop_event = threading.Event()  # Set by STOP, wakes up every wait of the measurement at once
+        self.stop_time = None
+        self.stop_latency = None
+        self.measurement_error = None  # Error that ended the last measurement
 
         self.create_widgets()
+        if self.station:
+            import stations
+            self.LEfolder.setText(stations.DATA_FOLDER + self.station + "/")
+        startup.lap("Widgets")
 
         self.button_actions()  # Set button actions
 
+        # Measurements run on a worker thread, which reports back to the GUI through signals
+        self.engine = engine.MeasurementEngine(self)
+        self.engine.status.connect(self.statusBar().showMessage)
+        self.engine.live_voltage.connect(self.display_live_voltage)
+        self.engine.live_current.connect(self.display_live_current)
+        self.engine.jv_curve.connect(self.plot_jv)
+        self.engine.mpp_curve.connect(self.plot_mpp)
+        self.engine.loop_trend.connect(self.plot_loop_trend)
+        self.engine.jv_chars.connect(self.show_jv_chars)
+        self.engine.shutter.connect(self.susiShutter.setText)
+        self.engine.mpp_done.connect(self.save_mpp)  # Saved while the next cell is tracked
+        self.actions = engine.DeviceActions()  # Background hardware actions of the measurement
+        self.engine.finished.connect(self.measurement_finished)
+
+        self.settings = self.settings_snapshot()
+        startup.lap("Engine")
+
+        # No measurement until the instruments are connected
+        self.BStart.setEnabled(False)
+        self.mppStart.setEnabled(False)
+        QtWidgets.QApplication.processEvents()  # Draw the window
+        startup.lap("Window shown")
+
+        self.devices_ready.connect(self.devices_connected)
+        threading.Thread(target=self.connect_devices, daemon=True).start()
+
     def create_widgets(self):
         widget = QWidget()
         layH1 = QHBoxLayout()  # Main (horizontal) Layout
@@ -208,6 +204,13 @@ class MainWindow(QtWidgets.QMainWindow):
         self.is_jv_measurement = False
         self.is_mpp_measurement = False
         self.real_area = np.nan
+        self.curve_extras = {}
+        self.speed_settings = {}
+        self.last_current_span = {}
+        self.is_loop = False
+        self.loop_lines = {}
+        self.trend_lines = {}
+        self.trend_axes = None
 
         # Add a toolbar to control plotting area
         toolbar = NavigationToolbar(self.canvas, self)
@@ -280,6 +283,15 @@ class MainWindow(QtWidgets.QMainWindow):
         self.light_soak = QLineEdit()
         self.bias_soak = QLineEdit()
         self.susi_intensity = QLineEdit() #This is needed for susi popup (repeated)
+        self.sweep_mode = QComboBox()
+        self.average_mode = QComboBox()
+        self.settle_mode = QComboBox()
+        self.settle_tol = QLineEdit()
+        self.ave_target = QLineEdit()
+        self.early_stop = QCheckBox()
+        self.voc_margin = QLineEdit()
+        self.speed_profile = QComboBox()
+        self.loop_count = QLineEdit()
         # self.sun_ref = QLineEdit()
         self.curr_ref = QLabel("0\n0%")
 
@@ -297,6 +309,14 @@ class MainWindow(QtWidgets.QMainWindow):
         self.cell_num.setMaximumWidth(sMW)
         self.light_soak.setMaximumWidth(sMW)
         self.bias_soak.setMaximumWidth(sMW)
+        self.sweep_mode.setMaximumWidth(sMW * 2)
+        self.average_mode.setMaximumWidth(sMW * 2)
+        self.settle_mode.setMaximumWidth(sMW * 2)
+        self.settle_tol.setMaximumWidth(sMW)
+        self.ave_target.setMaximumWidth(sMW)
+        self.voc_margin.setMaximumWidth(sMW)
+        self.speed_profile.setMaximumWidth(sMW * 2)
+        self.loop_count.setMaximumWidth(sMW)
 
         # Set widget texts
         self.volt_start.setText("-0.2")
@@ -310,6 +330,35 @@ class MainWindow(QtWidgets.QMainWindow):
         self.pow_dens.setText("100")
         self.light_soak.setText("0")
         self.bias_soak.setText("0")
+        self.sweep_mode.addItems(["Stepped", "Buffered", "Buffered dual", "Adaptive grid"])
+        self.sweep_mode.setToolTip("Stepped: every point is set and read from the PC\n"
+                                   "Buffered: the whole sweep runs on the Keithley and is read at once\n"
+                                   "Buffered dual: forward and reverse run as one buffered sweep\n"
+                                   "Adaptive grid: coarse steps in flat regions, step size around MPP and Voc")
+        self.average_mode.addItems(["PC", "Keithley", "Sequential"])
+        self.average_mode.setToolTip("PC: one current query per averaging point\n"
+                                     "Keithley: the points are taken by the Keithley and read with one query\n"
+                                     "Sequential: read until the target error is reached\n"
+                                     "(the averaging points are then the maximum)")
+        self.settle_mode.addItems(["Fixed", "Adaptive"])
+        self.settle_mode.setToolTip("Fixed: always wait the settling time\n"
+                                    "Adaptive: continue as soon as the current stops drifting\n"
+                                    "(the settling time is then the maximum wait)")
+        self.settle_tol.setText("0.5")
+        self.ave_target.setText("0.01")
+        self.early_stop.setToolTip("Stop light sweeps once they are past Voc by the Voc margin,\n"
+                                   "start reverse sweeps just above the Voc of the previous sweep\n"
+                                   "and stop sweeps that stay in compliance")
+        self.voc_margin.setText("0.1")
+        self.speed_profile.addItems(["Standard", "Fast", "Precise", "Manual", "Auto"])
+        self.speed_profile.setToolTip("Keithley integration time (NPLC), current range and auto zero\n"
+                                      "Standard: NPLC 5, auto zero once | Fast: NPLC 0.1, no auto zero\n"
+                                      "Precise: NPLC 10, auto zero always | Manual: uses the integration time\n"
+                                      "Auto: fastest NPLC and auto zero meeting the target error,\n"
+                                      "range from the previous sweep")
+        self.loop_count.setText("1")
+        self.loop_count.setToolTip("Number of times the selected sweeps are repeated on every cell\n"
+                                   "(the parameters of every loop and the mean curves are saved)")
 
         # Position labels and field in a grid
         LsetParameters.addWidget(QLabel(" "), 0, 0)
@@ -333,6 +382,26 @@ class MainWindow(QtWidgets.QMainWindow):
         LsetParameters.addWidget(self.pow_dens, 5, 1, Qt.AlignLeft)
         LsetParameters.addWidget(QLabel("Current Limit (mA)"), 5, 2, Qt.AlignRight)
         LsetParameters.addWidget(self.curr_lim, 5, 3, Qt.AlignLeft)
+        LsetParameters.addWidget(QLabel("Sweep mode"), 6, 0, Qt.AlignRight)
+        LsetParameters.addWidget(self.sweep_mode, 6, 1, Qt.AlignLeft)
+        LsetParameters.addWidget(QLabel("Averaging"), 6, 2, Qt.AlignRight)
+        LsetParameters.addWidget(self.average_mode, 6, 3, Qt.AlignLeft)
+        LsetParameters.addWidget(QLabel("Settling"), 7, 0, Qt.AlignRight)
+        LsetParameters.addWidget(self.settle_mode, 7, 1, Qt.AlignLeft)
+        LsetParameters.addWidget(QLabel("Drift tolerance (%)"), 7, 2, Qt.AlignRight)
+        LsetParameters.addWidget(self.settle_tol, 7, 3, Qt.AlignLeft)
+        LsetParameters.addWidget(QLabel("Target error (mA/cm²)"), 8, 2, Qt.AlignRight)
+        LsetParameters.addWidget(self.ave_target, 8, 3, Qt.AlignLeft)
+        LsetParameters.addWidget(QLabel("Stop past Voc"), 8, 0, Qt.AlignRight)
+        LsetParameters.addWidget(self.early_stop, 8, 1, Qt.AlignLeft)
+        LsetParameters.addWidget(QLabel("Voc margin (V)"), 9, 0, Qt.AlignRight)
+        LsetParameters.addWidget(self.voc_margin, 9, 1, Qt.AlignLeft)
+        LsetParameters.addWidget(QLabel("Integration time (s)"), 9, 2, Qt.AlignRight)
+        LsetParameters.addWidget(self.int_time, 9, 3, Qt.AlignLeft)
+        LsetParameters.addWidget(QLabel("Speed profile"), 10, 0, Qt.AlignRight)
+        LsetParameters.addWidget(self.speed_profile, 10, 1, Qt.AlignLeft)
+        LsetParameters.addWidget(QLabel("Repeated sweeps"), 10, 2, Qt.AlignRight)
+        LsetParameters.addWidget(self.loop_count, 10, 3, Qt.AlignLeft)
 
         # Third set of setup values
         sbb = 15
@@ -419,6 +488,12 @@ class MainWindow(QtWidgets.QMainWindow):
 
         self.area_g.setText("1")
 
+        self.smu_cells = QLineEdit()
+        self.smu_cells.setMaximumWidth(70)
+        self.smu_cells.setText("abcdef")
+        self.smu_cells.setToolTip("Cells wired to each Keithley, one group per Keithley separated by commas\n"
+                                  "(e.g. abc,def). The groups are measured at the same time")
+
         sample_design = QLabel(self)
         pixmap = QPixmap("../Resources/cell_layout.png")
         pixmap = pixmap.scaledToHeight(100)
@@ -427,6 +502,8 @@ class MainWindow(QtWidgets.QMainWindow):
         LsetCells.addWidget(QLabel(" "), 0, 0)
         LsetCells.addWidget(QLabel("Multiplexing"), 1, 0, Qt.AlignRight)
         LsetCells.addWidget(self.multiplex, 1, 1, Qt.AlignLeft)
+        LsetCells.addWidget(QLabel("Cells per SMU"), 1, 3, 1, 2, Qt.AlignRight)
+        LsetCells.addWidget(self.smu_cells, 1, 5, 1, 2, Qt.AlignLeft)
         LsetCells.addWidget(QLabel("Area(cm²)"), 2, 1, Qt.AlignRight)
         LsetCells.addWidget(QLabel("Area(cm²)"), 2, 5, Qt.AlignRight)
         LsetCells.addWidget(QLabel("B"), 4, 0, Qt.AlignRight)
@@ -472,6 +549,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self.mpp_inttime = QLineEdit()
         self.mpp_stepSize = QLineEdit()
         self.mpp_voltage = QLineEdit()
+        self.mpp_mode = QComboBox()
 
         self.mpp_ttime.setMaximumWidth(sMW)
         self.mpp_inttime.setMaximumWidth(sMW)
@@ -482,6 +560,10 @@ class MainWindow(QtWidgets.QMainWindow):
         self.mpp_inttime.setText("100")
         self.mpp_stepSize.setText("0.001")
         self.mpp_voltage.setText("0.45")
+        self.mpp_mode.addItems(["PC", "Keithley (TSP)"])
+        self.mpp_mode.setToolTip("PC: every perturb and observe step is driven from the PC\n"
+                                 "Keithley (TSP): the tracking runs as a script on the Keithley,\n"
+                                 "which must be set to the TSP command set")
 
         LsetMPP.addWidget(self.mpptitle, 0, 0, 1, 3)
         LsetMPP.addWidget(QLabel("Total time (min)  "), 1, 0, Qt.AlignRight)
@@ -492,10 +574,12 @@ class MainWindow(QtWidgets.QMainWindow):
         LsetMPP.addWidget(self.mpp_stepSize, 2, 1)
         LsetMPP.addWidget(QLabel("Voltage (V)  "), 2, 2, Qt.AlignRight)
         LsetMPP.addWidget(self.mpp_voltage, 2, 3)
+        LsetMPP.addWidget(QLabel("Tracking  "), 3, 0, Qt.AlignRight)
+        LsetMPP.addWidget(self.mpp_mode, 3, 1, 1, 3)
         self.mppStart = QPushButton("START")
         self.mppStart.setFont(QFont("Arial", 10, QFont.Bold))
         self.mppStart.setStyleSheet("color : blue;")
-        LsetMPP.addWidget(self.mppStart, 3, 0, 1, 4)
+        LsetMPP.addWidget(self.mppStart, 4, 0, 1, 4)
 
         # Position all these sets into the second layout V2
         layV2.addItem(verticalSpacerV2)
@@ -536,6 +620,14 @@ class MainWindow(QtWidgets.QMainWindow):
                                "Starting Voltage (V)", ]
         self.setup_vals_mpp = [self.LEsample, self.LEuser, self.LEfolder, self.mpp_ttime,
                                self.mpp_inttime, self.mpp_stepSize, self.mpp_voltage,]
+        self.other_buttons_mpp = [self.mpp_mode]
+        # Sweep options, saved with the JV metadata but optional when loading older files
+        self.setup_labs_opt = ["Sweep mode", "Averaging mode", "Settling mode", "Drift tolerance (%)",
+                               "Target error (mA/cm²)", "Stop past Voc", "Voc margin (V)", "Speed profile",
+                               "Cells per SMU", "Repeated sweeps"]
+        self.setup_vals_opt = [self.sweep_mode, self.average_mode, self.settle_mode, self.settle_tol,
+                               self.ave_target, self.early_stop, self.voc_margin, self.speed_profile,
+                               self.smu_cells, self.loop_count]
 
         # Make a new layout and position relevant values
         LmetaSample = QFormLayout()
@@ -616,7 +708,33 @@ class MainWindow(QtWidgets.QMainWindow):
         self.other_buttons = [self.for_bmL, self.rev_bmL, self.for_bmD, self.rev_bmD, self.four_wire,  # self.logyaxis,
                               self.BsaveM, self.BloadM, self.Bsusi_intensity]
 
+    def button_actions(self):
+        self.folder = self.LEfolder.text()
+        self.Bfolder.clicked.connect(self.select_folder)
+        self.Bpath.clicked.connect(self.automatic_folder)
+        self.BsaveM.clicked.connect(self.save_meta)
+        self.BloadM.clicked.connect(self.load_meta)
+        self.susiShutter.clicked.connect(self.susi_button)
+        self.Bsusi_intensity.clicked.connect(self.susi_intensity_fix)
+        self.BStart.clicked.connect(self.jv_start_stop)
+        self.mppStart.clicked.connect(self.mpp_start_stop)
+        self.logyaxis.stateChanged.connect(self.yaxis_to_log)
+        self.four_wire.stateChanged.connect(lambda: self.set_four_wire(self.four_wire.isChecked()))
+        self.Bsusi_off.clicked.connect(self.susi_shutdown)
+        self.Bsusi_on.clicked.connect(self.susi_startup)
+        self.Brecipe.clicked.connect(self.recipe_popup)
+        self.Binfo.clicked.connect(self.show_manual)
+        self.multiplex.stateChanged.connect(self.multiplexing_allow)
+
+    def connect_devices(self):
+        # Runs on a thread, so the window can be used while the instruments are searched and opened
+        try:
+            self.open_devices()
+        finally:
+            self.devices_ready.emit()
 
+    def devices_connected(self):
+        self.is_connecting = False
         if not self.is_relay:
             self.multiplex.setChecked(False)
             self.multiplexing_allow()
@@ -641,31 +759,29 @@ class MainWindow(QtWidgets.QMainWindow):
         else:
             self.label_tempsens.setText("-- °C")
 
-    def button_actions(self):
-        self.folder = self.LEfolder.text()
-        self.Bfolder.clicked.connect(self.select_folder)
-        self.Bpath.clicked.connect(self.automatic_folder)
-        self.BsaveM.clicked.connect(self.save_meta)
-        self.BloadM.clicked.connect(self.load_meta)
-        self.susiShutter.clicked.connect(self.susi_button)
-        self.Bsusi_intensity.clicked.connect(self.susi_intensity_fix)
-        self.BStart.clicked.connect(self.jv_start_stop)
-        self.mppStart.clicked.connect(self.mpp_start_stop)
-        self.logyaxis.stateChanged.connect(self.yaxis_to_log)
-        self.four_wire.stateChanged.connect(self.two_four_wires_measurement)
-        self.Bsusi_off.clicked.connect(self.susi_shutdown)
-        self.Bsusi_on.clicked.connect(self.susi_startup)
-        self.Brecipe.clicked.connect(self.recipe_popup)
-        self.Binfo.clicked.connect(self.show_manual)
-        self.multiplex.stateChanged.connect(self.multiplexing_allow)
-
-    def list_com_ports(self):
-        ports = serial.tools.list_ports.comports()
-        port_dict = {}
-        for port in ports:
-            port_dict[port.description.split(' (')[0]] = port.name
-            # print(f"Port: {port.device}, Name: {port.name}, Description: {port.description}")
-        return port_dict
+        if self.discovery_thread:
+            self.discovery_thread.start()
+        if not self.acquisition:  # The acquisition server keeps its own connections
+            self.start_watcher()
+
+        startup.lap("Devices")
+        timing = startup.report()
+        if timing and "--startup-check" in sys.argv:  # Start-up regression check, quits with the result
+            sys.stdout.flush()
+            os._exit(startup.exit_code(timing[0]))  # Without the close dialog of the window
+
+        if not self.keithley and not self.is_susi:
+            self.statusBar().showMessage("##    Keithley and susi not found    ##")
+            self.popup_message("  Keithley and SuSim\n"
+                               "were not found")
+        elif not self.is_susi:
+            self.statusBar().showMessage("##    susi not found    ##")
+            self.popup_message("    SuSim\n"
+                               "was not found")
+        elif not self.keithley:
+            self.statusBar().showMessage("##    Keithley not found    ##")
+        else:
+            self.statusBar().showMessage("Ready", 5000)
 
     def popup_message(self, text):
         qmes = QMessageBox.about(self, "Something happened...", text)
@@ -788,6 +904,10 @@ class MainWindow(QtWidgets.QMainWindow):
                     # print(metadata.loc[labels[cc]])
                     oo.setText(str(metadata.loc[labels[cc]][1]))
 
+            for cc, oo in enumerate(self.setup_vals_opt):
+                if self.setup_labs_opt[cc] in metadata.index:
+                    self.set_widget_value(oo, str(metadata.loc[self.setup_labs_opt[cc]][1]))
+
             self.statusBar().showMessage("Metadata successfully loaded", 5000)
         except:
             self.statusBar().showMessage("Metadata file not compatible", 5000)
@@ -833,7 +953,9 @@ class MainWindow(QtWidgets.QMainWindow):
             self.meta_dict["Date"] = strftime("%H:%M:%S - %d.%m.%Y", localtime(self.start_time))
         except:
             self.meta_dict["Date"] = strftime("%H:%M:%S - %d.%m.%Y", localtime(time()))
-        self.meta_dict["Location"] = os.environ['COMPUTERNAME']
+        self.meta_dict["Location"] = os.environ.get('COMPUTERNAME', '')
+        if self.station:
+            self.meta_dict["Station"] = self.station
         try:
             self.meta_dict["Device"] = (self.spec.model + " - Serial No.:" + self.spec.serial_number)
         except:
@@ -849,18 +971,60 @@ class MainWindow(QtWidgets.QMainWindow):
         if self.is_susi:
             self.meta_dict["SuSi Intensity (%)"] = float(self.susi_intensity.text())
 
+        if not self.is_mpp_measurement:
+            for cc, oo in enumerate(self.setup_vals_opt):
+                self.meta_dict[self.setup_labs_opt[cc]] = self.widget_value(oo)
+
+        for label, value in self.speed_settings.items():  # Keithley settings actually used
+            self.meta_dict[label] = value
+
+        if self.is_mpp_measurement:
+            self.meta_dict["MPP tracking"] = self.mpp_mode.currentText()
+
         self.meta_dict[
             "Comments"] = self.com_labels.toPlainText()  # This field has a diffferent format than the others
 
-    def two_four_wires_measurement(self):
-        if self.four_wire.isChecked():
-            self.keithley.write("SENS:CURR:RSEN ON")
+    def widget_value(self, widget):
+        if isinstance(widget, QComboBox):
+            return widget.currentText()
+        elif isinstance(widget, QCheckBox):
+            return str(widget.isChecked())
+        else:
+            return widget.text()
+
+    def set_widget_value(self, widget, value):
+        if isinstance(widget, QComboBox):
+            widget.setCurrentText(value)
+        elif isinstance(widget, QCheckBox):
+            widget.setChecked(value == "True")
         else:
-            self.keithley.write("SENS:CURR:RSEN OFF")
+            widget.setText(value)
+
+    def settings_snapshot(self):
+        # Read-only copy of every field, the worker thread reads its settings from here instead of the widgets
+        values = {}
+        for name, widget in vars(self).items():
+            if isinstance(widget, QCheckBox):
+                values[name] = widget.isChecked()
+            elif isinstance(widget, QComboBox):
+                values[name] = widget.currentText()
+            elif isinstance(widget, QLineEdit):
+                values[name] = widget.text()
+
+        return MappingProxyType(values)
+
+    def pause(self, seconds, stoppable=True):
+        # Keeps the GUI alive when waiting on the GUI thread, see Station.pause for the worker thread
+        if threading.current_thread() is not threading.main_thread():
+            return super(MainWindow, self).pause(seconds, stoppable)
+        import sessions
+        if sessions.player:
+            seconds = sessions.player.scaled(seconds)
+        QtTest.QTest.qWait(int(seconds * 1000))
 
     def multiplexing_allow(self):
         fields = [self.area_a, self.area_b, self.area_c, self.area_d, self.area_e, self.area_f,
-                  self.cell_a, self.cell_b, self.cell_c, self.cell_d, self.cell_e, self.cell_f]
+                  self.cell_a, self.cell_b, self.cell_c, self.cell_d, self.cell_e, self.cell_f, self.smu_cells]
 
         if self.multiplex.isChecked():
             self.is_multiplex = True
@@ -883,7 +1047,8 @@ class MainWindow(QtWidgets.QMainWindow):
                  self.cell_a, self.cell_b, self.cell_c, self.cell_d, self.cell_e, self.cell_f, self.cell_g,
                  self.multiplex]
 
-        wi_dis = self.setup_vals_jv + self.setup_vals_mpp + self.other_buttons + multiplex + \
+        wi_dis = self.setup_vals_jv + self.setup_vals_mpp + self.setup_vals_opt + self.other_buttons + \
+                 self.other_buttons_mpp + multiplex + \
                  [self.Bfolder, self.Bpath, self.susiShutter]#, self.refCurrent]
 
         self.dis_enable_starts(status, process)
@@ -916,60 +1081,33 @@ class MainWindow(QtWidgets.QMainWindow):
             self.mppStart.setText("START")
             self.mppStart.setStyleSheet("color : Blue;")
 
-    def fix_jv_chars_for_save(self):
-        names = ["Voc (V)", "Jsc (mA/cm2)", "FF (%)", "PCE (%)", "V_mpp (V)", "J_mpp (mA/cm2)", "P_mpp (mW/cm2)",
-                 "R_series (Ohm cm2)", "R_shunt (Ohm cm2)", "Temperature (°C)", "Time"]
-        names_f = [na.replace(" ", "") for na in names]
-        # names_t = [na.replace(" ","\n") for na in names]
-        # empty = ["","","","","","","","",""]
-
-        self.jv_chars_results = self.jv_chars_results.T
-        self.jv_chars_results.columns = names_f
+    def show_jv_chars(self, results):
+        self.jv_char_qtabledisplay(results)
+        try:
+            self.vmpp_value_to_tracking(results)
+        except:
+            pass
 
-    def jv_char_qtabledisplay(self):
+    def jv_char_qtabledisplay(self, results):
         names = ["Voc (V)", "Jsc (mA/cm²)", "FF (%)", "PCE (%)", "V_mpp (V)", "J_mpp (mA/cm²)", "P_mpp (mW/cm²)",
                  "R_series (\U00002126cm²)", "R_shunt (\U00002126cm²)", "Temperature (°C)",  "Time"]
         # names_f = [na.replace(" ","") for na in names] 
         names_t = [na.replace(" ", "\n") for na in names]
-        values = self.jv_chars_results.T.copy()
+        values = results.T.copy()
         # print(values)
         values.columns = names_t
         for v in values.index:
             if "Dark" in v:
                 values = values.drop(index=v, axis=1)
-                self.jv_chars_results = self.jv_chars_results.drop(columns=v, axis=0)
             else:
                 values.rename(index={v: v[:-6]}, inplace=True)
         self.model = TableModel(values)
         self.Lqtable.setModel(self.model)
 
-    def vmpp_value_to_tracking(self):
-        vmpp = round(self.jv_chars_results["V_mpp(V)"].iat[-1], 3)
+    def vmpp_value_to_tracking(self, results):
+        vmpp = round(results["V_mpp(V)"].iat[-1], 3)
         self.mpp_voltage.setText(str(vmpp))
 
-    def check_filename(self, type, name="", count=0):
-        if type == "jv":
-            tag = "JV_"
-        elif type == "mpp":
-            tag = "MPP_"
-        else:
-            tag = "Recipe_"
-        if self.is_jv_measurement:
-            file_name = self.folder + tag + self.sample + ".txt"
-        elif self.is_mpp_measurement:
-            file_name = self.folder + tag + self.sample + "_" + name + ".txt"
-        else:
-            file_name = file_name = self.folder + "test_" + self.sample + ".txt"
-
-        while os.path.exists(file_name):
-            count += 1
-            if self.is_mpp_measurement:
-                file_name = self.folder + tag + self.sample + "_" + name + "-" + str(count) + ".txt"
-            else:
-                file_name = self.folder + tag + self.sample + "-" + str(count) + ".txt"
-        else:
-            return file_name
-
     def save_data(self):
         if self.is_jv_measurement or self.is_recipe:
             self.save_jv()
@@ -978,50 +1116,8 @@ class MainWindow(QtWidgets.QMainWindow):
         else:
             print("Nothing to save here")
 
-    def save_jv(self):
-        #self.is_mpp_bool = False
-        self.gather_all_metadata()
-
-        metadata = pd.DataFrame.from_dict(self.meta_dict, orient='index')
-        empty = pd.DataFrame(data={"": ["--"]})
-        filename = self.check_filename("jv")
-        # print("  " + filename)
-        metadata.to_csv(filename, index=True, header=False, sep="\t")
-        empty.to_csv(filename, mode="a", index=False, header=False, lineterminator='\n', sep="\t")
-        try:
-            self.jv_chars_results.T.to_csv(filename, mode="a", index=True, header=True, sep="\t")
-            empty.to_csv(filename, mode="a", index=False, header=False, lineterminator='\n', sep="\t")
-        except:
-            pass
-        self.curr_volt_results.to_csv(filename, mode="a", index=False, header=True, sep="\t")
-        self.statusBar().showMessage("Data saved successfully to " + filename)
-
-    def save_mpp(self, cell):
-        #self.is_mpp_bool = True
-        sample = self.LEsample.text()
-        self.gather_all_metadata()
-        metadata = pd.DataFrame.from_dict(self.meta_dict, orient='index')
-        mpp_data = pd.DataFrame({"Elapsed (min)": self.mpp_time, "Date/Time":self.mpp_zeit, "Voltage (V)": self.res_mpp_voltage,
-                                 "Current (mA/cm²)": self.mpp_current, "Power (mW/cm²)": self.mpp_power})
-
-        filename = self.check_filename("mpp", cell)
-
-        metadata.to_csv(filename, header=False, sep="\t")
-        mpp_data.to_csv(filename, mode="a", index=False, sep="\t")
-
-        self.statusBar().showMessage("Data saved successfully", 5000)
-
-
-    def keithley_startup_setup(self): # TODO keithley configuration
-        self.two_four_wires_measurement()
-        curr_limit = float(self.curr_lim.text())
-        self.keithley.apply_voltage(compliance_current = curr_limit / 1000)
-        # self.keithley.apply_voltage(voltage_range=2, compliance_current = curr_limit / 1000)
-        self.keithley.measure_current(nplc=5, current=curr_limit / 1000, auto_range=False)
-        self.keithley.auto_zero = "ONCE"
-        #self.keithley.current_filter_count = int(self.ave_pts.text())
-
     def test_actual_current(self):
+        self.settings = self.settings_snapshot()
         self.keithley_startup_setup()
         ref = float(self.sun_ref.text())
 
@@ -1043,95 +1139,13 @@ class MainWindow(QtWidgets.QMainWindow):
             self.is_recipe = True
             self.measurement_process(text.upper())
 
-    def find_nearest(self, array, value):
-        array = np.asarray(array)
-        idx = (np.abs(array - value)).argmin()
-        return idx
-
-
-    def jv_chars_calculation(self, volt, curr):
-        # Find Isc (find voltage value closest to 0 Volts)
-        volt = np.array(volt)
-        curr = np.array(curr)
-
-        # if reverse measurement, flip it around
-        if volt[0] > volt[-1]:
-            volt = np.flip(volt)
-            curr = np.flip(curr)
-
-        v0 = np.argmin(abs(volt))  # Find voltage closest to zero
-
-        # Fit datapoint around Jsc to get Shunt(parallel) resistance
-        reg_par = LinearRegression()
-        lr_volt = 0.2
-        p_pos = int(self.find_nearest(volt, value=lr_volt))
-        n_pos = int(self.find_nearest(volt, value=-lr_volt))
-        v_par = volt[n_pos: p_pos].reshape(-1, 1)
-        c_par = curr[n_pos: p_pos].reshape(-1, 1)
-
-        reg_par.fit(v_par, c_par)
-        m_i = reg_par.coef_[0][0]
-
-        if volt[v0] <= 0.0001:  # If voltage is equal to zero
-            isc = curr[v0]
-        else:  # Otherwise calculate from slope
-            b_i = -curr[v0] - m_i * volt[v0]
-            isc = -b_i
-
-        # For Voc, find closest current values to 0
-        i1 = np.where(curr < 0, curr, -np.inf).argmax()
-        i2 = np.where(curr > 0, curr, np.inf).argmin()
-
-        c1 = curr[i1]
-        c2 = curr[i2]
-
-        # Get Voc by finding x-intercept (y=mx+b)
-        v1 = volt[i1]
-        v2 = volt[i2]
-        m_v = (c2 - c1) / (v2 - v1)
-        b_v = c1 - m_v * v1
-        voc = -b_v / m_v
-
-        # Calculate resistances, parallel and series
-        r_par = abs(1 / m_i) * 1000 # 1000 factor to make it Ohms (since using mA)
-        r_ser = abs(1 / m_v) * 1000
-
-        # Find mpp values
-        mpp = np.argmax(-volt * curr)
-
-        mpp_v = volt[mpp]
-        mpp_c = curr[mpp]
-        mpp_p = mpp_v * mpp_c
-
-        # Calculate FF
-        ff = mpp_v * mpp_c / (voc * isc) * 100
-
-        # Calculate PCE (this is wrong, it needs correct P_in)
-        # pin = 75#mW/cm²
-        pin = float(self.pow_dens.text())  # mW/cm²
-        pce = abs(voc * isc * ff) / pin
-
-        uhrzeit = strftime("%d.%m.%Y %H:%M:%S", gmtime())
-
-        temper = self.read_temperature_sensor()
-
-        jv_char = [voc, isc, ff, pce, mpp_v, mpp_c, mpp_p, r_ser, r_par, temper, uhrzeit]
-
-        return jv_char
-
     def update_gui_temperature(self):
+        if self.watcher and self.watcher.is_lost("temperature"):
+            self.label_tempsens.setText("-- °C")
+            return
         temperature = self.read_temperature_sensor()
         self.label_tempsens.setText(str(temperature) + " °C")
 
-    def read_temperature_sensor(self):
-        if self.is_temperature_sensor:
-            temp_bin = self.senseTemp.readline().strip()   # read a byte
-            temp_sensor = float(temp_bin[-5:])
-        else:
-            temp_sensor = np.nan
-
-        return temp_sensor
-
     def susi_button(self):
         if self.is_susi:
             answer = self.susim_check()
@@ -1320,17 +1334,6 @@ class MainWindow(QtWidgets.QMainWindow):
 
         QtTest.QTest.qWait(int(3 * 1000))
 
-    def set_intensity_susim(self, intensity):
-
-        # print(intensity)
-        # self.susi_start_intensity = int(intensity)
-        intensity = int(intensity * 10)
-        value = "{:04d}".format(intensity)
-        message = "P=" + value
-        # print(message)
-
-        self.susi.write(message.encode('utf-8'))  # Set light intensity
-
     def dialog_test_current(self):
         self.four_wire.setChecked(self.four_wire_pop.isChecked()) # TODO clean this
         self.curr_lim.setText(self.curr_lim_pop.text())
@@ -1345,305 +1348,17 @@ class MainWindow(QtWidgets.QMainWindow):
 
         self.pow_dens.setText(str(power))
 
-    def susim_check(self):
-        if self.is_susi:
-            self.susi.write(b'FS')  # Read data
-            susi_ans = self.susi.read_until(b"END\r\n")
-
-            return susi_ans
-
     def susi_shutter_open(self):
         if self.is_susi:
-            self.susi.write(b'S0')  # Shutter Open
-            self.susiShutter.setText("SuSi Shutter (Opened)")
-            QtTest.QTest.qWait(int(3 * 1000))
-            self.is_shutter_open = True
+            self.move_shutter(True)
 
     def susi_shutter_close(self):
         if self.is_susi:
-            self.susi.write(b'S1')  # Shutter Closed
-            self.susiShutter.setText("SuSi Shutter (Closed)")
-            QtTest.QTest.qWait(int(3 * 1000))
-            self.is_shutter_open = False
+            self.move_shutter(False)
 
     def namestr(self, obj, namespace):
         return [name for name in namespace if namespace[name] is obj]
 
-    def read_measurement_variables(self):
-        # area = float(self.sam_area.text())
-        area = self.get_areas()
-
-        # JV variables
-        volt_begin = float(self.volt_start.text())
-        volt_end = float(self.volt_end.text())
-        volt_step = float(self.volt_step.text())
-        ap = int(self.ave_pts.text())
-        time = float(self.set_time.text())
-
-        # MPP Variables
-        mpp_total_time = float(self.mpp_ttime.text()) * 60
-        mpp_int_time = float(self.mpp_inttime.text())
-        mpp_step = float(self.mpp_stepSize.text())
-        mpp_voltage = float(self.mpp_voltage.text())
-
-        jv_variables = [volt_begin, volt_end, volt_step, ap, time, area]
-        mpp_variables = [mpp_total_time, mpp_int_time, mpp_step, mpp_voltage, area]
-
-        return jv_variables, mpp_variables
-
-    def empty_results_arrays(self):
-        if self.is_jv_measurement or self.is_recipe:
-            self.res_fwd_curr = []
-            self.res_fwd_volt = []
-            self.res_bkw_curr = []
-            self.res_bkw_volt = []
-            self.jv_chars_results = pd.DataFrame()
-            self.curr_volt_results = pd.DataFrame()
-        elif self.is_mpp_measurement:
-            self.mpp_current = []
-            self.res_mpp_voltage = []
-            self.mpp_power = []
-            self.mpp_time = []
-            self.mpp_zeit = []
-        else:
-            pass
-
-
-    def get_areas(self):
-        if self.is_multiplex:
-            area = []
-            multi = [self.area_a,self.area_b,self.area_c,self.area_d,self.area_e,self.area_f]
-
-            for m in multi:
-                area.append(float(m.text()))
-
-        else:
-            area = float(self.sam_area.text())
-
-        self.real_area = area
-
-        return area
-
-    def read_measurement_type(self):
-        self.empty_results_arrays()
-        self.soaking_process()
-
-        if self.is_recipe:
-            meas_process = self.recipe_list
-            self.jv_multiplex_setup(meas_process)
-        elif self.is_jv_measurement:
-            check_box_buttons = [self.for_bmD, self.rev_bmD, self.for_bmL, self.rev_bmL]
-
-            meas_process = []
-            for ck, cbb in enumerate(check_box_buttons):
-                if cbb.isChecked():
-                    if ck == 0:
-                        meas_process.append("FD")
-                    elif ck == 1:
-                        meas_process.append("RD")
-                    elif ck == 2:
-                        meas_process.append("FL")
-                    elif ck == 3:
-                        meas_process.append("RL")
-                    else:
-                        pass
-            self.jv_multiplex_setup(meas_process)
-        elif self.is_mpp_measurement:
-            self.mpp_multiplex_setup()
-        else:
-            print("read_measurement_type not found")
-
-    def jv_multiplex_setup(self, meas_process):
-        jv_variables, _ = self.read_measurement_variables()
-        volt_begin, volt_end, volt_step, ap, time, area = jv_variables
-
-        forwa_vars = [volt_begin, volt_end + volt_step * 0.95, volt_step]
-        rever_vars = [volt_end, volt_begin - volt_step * 0.95, -volt_step]
-        fixed_vars = [time, ap, area]
-
-        if self.is_multiplex:
-            cell_list = [self.cell_a, self.cell_b, self.cell_c, self.cell_d, self.cell_e, self.cell_f]
-            cell_name = ["a", "b", "c", "d", "e", "f"]
-        else:
-            cell_list = [self.cell_g]
-            cell_name = [""]
-
-        if self.is_multiplex:
-            areas = self.get_areas()
-            for cn, cell in enumerate(cell_list):
-                fixed_vars[-1] = areas[cn]
-                if cell.isChecked() and self.is_meas_live:
-                    self.relays[cn].on()
-                    self.jv_perform_measurement(meas_process, forwa_vars, rever_vars, fixed_vars, cell_name, cn, cell)
-                    self.relays[cn].off()
-                elif not self.is_meas_live:
-                    self.relays[cn].off()
-                    break
-            self.is_meas_live = False
-
-        else:
-            self.jv_perform_measurement(meas_process, forwa_vars, rever_vars, fixed_vars, cell_name)
-            self.is_meas_live = False
-
-
-    def mpp_multiplex_setup(self):
-        self.statusBar().showMessage("Tracking Maximum Power Point")
-        # self.reset_plot_mpp()
-        _, mpp_variables = self.read_measurement_variables()
-        areas = self.get_areas()
-
-        if self.is_multiplex:
-            cell_list = [self.cell_a, self.cell_b, self.cell_c, self.cell_d, self.cell_e, self.cell_f]
-            cell_name = ["a", "b", "c", "d", "e", "f"]
-        else:
-            cell_list = [self.cell_g]
-            cell_name = [""]
-
-        self.susi_shutter_open()
-
-        while self.is_meas_live:
-            if self.is_multiplex:
-                for cn, cell in enumerate(cell_list):
-                    mpp_variables[-1] = areas[cn]
-                    self.mpp_time = []
-                    self.mpp_zeit = []
-                    self.mpp_current = []
-                    self.res_mpp_voltage = []
-                    self.mpp_power = []
-
-                    if cell.isChecked():
-                        #print(cn, cell_name[cn])
-                        self.relays[cn].on()
-                        self.mpp_perform_measurement(mpp_variables, cell_name, cn, cell)
-                        self.relays[cn].off()
-                        self.save_mpp(cell_name[cn])
-            else:
-                self.mpp_perform_measurement(mpp_variables, cell_name)
-                self.save_mpp('')
-
-            self.is_meas_live = False
-        self.susi_shutter_close()
-
-
-    def soaking_process(self):
-        light = int(self.light_soak.text())  # Read values
-        bias = float(self.bias_soak.text())
-        self.keithley.source_voltage = 0  # Set to zero
-        self.susi_shutter_open()
-        self.keithley.source_voltage = bias  # Set the wanted bias
-        QtTest.QTest.qWait(int(light * 1000))
-
-
-    def jv_perform_measurement(self, meas_process, forwa_vars, rever_vars, fixed_vars, cell_name, cn=0, cell=""):
-        #self.soaking_process()
-        for ck, mpr in enumerate(meas_process):
-            # print(mpr)
-            self.is_first_plot = True
-            if "D" in mpr:  # if it is a dark measurement
-                if self.is_susi and self.is_shutter_open and self.is_meas_live:
-                    self.susi_shutter_close()
-                ilum = "Dark"
-            else:
-                if self.is_susi and not self.is_shutter_open:
-                    self.susi_shutter_open()
-                ilum = "Light"
-
-            if "F" in mpr:  # if it is forward
-                direc = "Forward"
-                all_vars = forwa_vars + fixed_vars + [ilum + direc]
-            else:
-                direc = "Reverse"
-                all_vars = rever_vars + fixed_vars + [ilum + direc]
-
-            volt, curr = self.curr_volt_measurement(all_vars, cn)
-
-            if self.is_recipe:
-                if not self.is_multiplex:
-                    m_name = str(ck)
-                else:
-                    m_name = cell_name[cn] + "-" + str(ck)
-                # rep_count += 1
-            else:
-                m_name = cell_name[cn]
-
-            if self.is_meas_live and ilum == "Light":
-                chars = self.jv_chars_calculation(volt, curr)
-                self.jv_chars_results["{0}_{1}_{2}".format(m_name, direc, ilum)] = chars
-                self.jv_char_qtabledisplay()
-                try:
-                    self.vmpp_value_to_tracking()
-                except:
-                    pass
-            try:
-                self.curr_volt_results["Voltage (V)_" + m_name + "_" + direc + "_" + ilum] = volt
-                self.curr_volt_results["Current Density(mA/cm²)_" + m_name + "_" + direc + "_" + ilum] = curr
-            except:
-                pass
-
-
-    def mpp_perform_measurement(self, mpp_variables,cell_name, cn=0, cell=''):
-        self.is_first_plot = True
-        mpp_total_time, mpp_int_time, mpp_step, mpp_voltage, area = mpp_variables
-
-        # areas = self.get_areas()
-        max_voltage = mpp_voltage
-        time_c = time()
-        tc = 0
-
-        #print(0, mpp_total_time / 3, mpp_int_time / 1000)
-        for i in np.arange(0, mpp_total_time / 3, mpp_int_time / 1000):
-            voltage_test = [max_voltage - mpp_step, max_voltage, max_voltage + mpp_step]
-            # print(voltage_test)
-            mpp_test_current = []
-            mpp_test_voltage = []
-            mpp_test_power = []
-
-            for v in voltage_test:
-                if self.is_meas_live:
-
-                    self.keithley.source_voltage = v
-                    # Wait for stabilized measurement
-                    QtTest.QTest.qWait(int(mpp_int_time))
-                    # Measure current & voltage
-                    m_current = self.keithley.current * 1000 / area
-                    m_voltage = v  # self.keithley.voltage
-
-                    mpp_test_current.append(m_current)
-                    mpp_test_voltage.append(m_voltage)
-                    mpp_test_power.append(abs(m_voltage * m_current))
-                else:
-                    mpp_test_current.append(np.nan)
-                    mpp_test_voltage.append(np.nan)
-                    mpp_test_power.append(np.nan)
-                    break
-
-            index_max = mpp_test_power.index(max(mpp_test_power))
-            self.mpp_current.append(mpp_test_current[index_max])
-            max_voltage = mpp_test_voltage[index_max]
-            self.res_mpp_voltage.append(max_voltage)
-
-            self.display_live_voltage(max_voltage)
-            self.display_live_current(mpp_test_current[index_max])
-
-            self.mpp_power.append(mpp_test_power[index_max])
-
-            if i == 0:
-                tc = time() - time_c
-                elapsed_t = 0
-            else:
-                elapsed_t = (time() - time_c - tc)
-
-            self.mpp_time.append(elapsed_t / 60)
-            uhrzeit = strftime("%d.%m.%Y %H:%M:%S", gmtime())
-            self.mpp_zeit.append(uhrzeit)
-            self.plot_mpp(cn, cell_name[cn])
-
-            if elapsed_t > mpp_total_time:
-                break
-
-        self.display_live_current(0, False)
-        self.display_live_voltage(0, False)
-
     def display_live_voltage(self, value, live=True):
         if live:
             if abs(value) < 0.01:
@@ -1668,45 +1383,11 @@ class MainWindow(QtWidgets.QMainWindow):
         else:
             self.label_currcurr.setText("")
 
-    def curr_volt_measurement(self, variables, counter):
-        volt_0, volt_f, step, time_s, average_points, area, mode = variables
-
-        current = []
-        voltage = []
-        ave_curr = 0
-
-        for i in np.arange(volt_0, volt_f, step):
-            if self.is_meas_live:
-                meas_currents = []
-                meas_voltages = []
-
-                self.keithley.source_voltage = i
-                QtTest.QTest.qWait(int(time_s * 1000)) #Settling time
-                for t in range(average_points):
-                    # if self.is_meas_live:
-                    meas_voltages.append(i)
-                    meas_currents.append(self.keithley.current * 1000 / area)
-                    # else:
-                    #     meas_voltages.append(np.nan)
-                    #     meas_currents.append(np.nan)
-                        # pass
-
-                ave_curr = np.mean(np.array(meas_currents))
-                self.display_live_current(ave_curr)
-                self.display_live_voltage(i)
-                current.append(ave_curr)
-                voltage.append(np.mean(meas_voltages))
-
-                self.plot_jv(voltage, current, mode, counter)
-            else:
-                break
-
-        self.display_live_current(ave_curr, False)
-        self.display_live_voltage(0, False)
-
-        return voltage, current
-
     def jv_start_stop(self):
+        if self.is_tsp:
+            self.popup_message("The Keithley is set to the TSP command set,\n"
+                               "only MPP tracking on the Keithley is possible")
+            return
         self.is_jv_measurement = True
 
         self.selected_start_stop()
@@ -1721,59 +1402,74 @@ class MainWindow(QtWidgets.QMainWindow):
         self.selected_start_stop()
 
     def selected_start_stop(self):
-        self.keithley_startup_setup()
         # toggle live
         if not self.is_meas_live:
             self.is_meas_live = True
             self.measurement_process()
         else:
+            self.stop_time = perf_counter()
             self.is_meas_live=False
+            self.stop_event.set()
+            if self.acquisition:
+                self.acquisition.stop()
 
     def measurement_process(self, recipe_text=""):
-        # Reset values
-        while self.is_meas_live:
-            self.create_folder(False)
-            self.keithley.enable_source()
-            if self.is_jv_measurement:
-                self.reset_plot_jv()
-                self.dis_enable_widgets(True, "jv")
-                self.statusBar().showMessage("Measuring JV curve")
-            elif self.is_mpp_measurement:
-                self.reset_plot_mpp()
-                self.dis_enable_widgets(True, "mpp")
-                self.statusBar().showMessage("Measuring MPP curve")
-            elif self.is_recipe:
-                self.reset_plot_jv()
-                self.recipe_list = re.split(',| |-|_|;',recipe_text)
-                self.dis_enable_widgets(True, "jv")
-                self.statusBar().showMessage("Measuring Recipe of " + str(len(self.recipe_list)) + " steps: " + recipe_text)
-            else:
-                print("No measurement_process")
-                self.is_meas_live = False
+        if self.engine.isRunning():
+            return
+        self.settings = self.settings_snapshot()  # Fixed for the whole measurement
+        self.stop_event.clear()
+        if self.acquisition:
+            self.acquisition.resume()
+        self.create_folder(False)
+        if self.is_jv_measurement:
+            self.reset_plot_jv()
+            self.dis_enable_widgets(True, "jv")
+            self.statusBar().showMessage("Measuring JV curve")
+        elif self.is_mpp_measurement:
+            self.reset_plot_mpp()
+            self.dis_enable_widgets(True, "mpp")
+            self.statusBar().showMessage("Measuring MPP curve")
+        elif self.is_recipe:
+            self.reset_plot_jv()
+            self.recipe_list = re.split(',| |-|_|;',recipe_text)
+            self.dis_enable_widgets(True, "jv")
+            self.statusBar().showMessage("Measuring Recipe of " + str(len(self.recipe_list)) + " steps: " + recipe_text)
+        else:
+            print("No measurement_process")
+            self.is_meas_live = False
+            return
 
-            self.read_measurement_type() #This starts the measurement process
+        self.engine.start_job(self.measurement_job)
 
-            self.susi_shutter_close()
+    def finished_text(self):
+        import sessions
+        if isinstance(self.measurement_error, sessions.ReplayError):
+            return "stopped, the replay differs from the recorded session\n{}".format(self.measurement_error)
+        if self.measurement_error:
+            return "stopped by an error\n{}: {}".format(type(self.measurement_error).__name__, self.measurement_error)
+        if self.stop_latency is None:
+            return "done"
+        return "stopped\nhardware safe after {:.0f} ms".format(self.stop_latency)
 
-            if self.is_jv_measurement or self.is_recipe:
-                try:
-                    self.fix_jv_chars_for_save()
-                except:
-                    pass
-                self.dis_enable_widgets(False, "jv")
-                self.popup_message("JV measurement done")
+    def measurement_finished(self):
+        if self.is_jv_measurement or self.is_recipe:
+            try:
+                self.fix_jv_chars_for_save()
+            except:
+                pass
+            self.dis_enable_widgets(False, "jv")
+            self.popup_message("JV measurement " + self.finished_text())
 
-            elif self.is_mpp_measurement:
-                self.dis_enable_widgets(False, "mpp")
-                self.popup_message("MPP measurement done")
+        elif self.is_mpp_measurement:
+            self.dis_enable_widgets(False, "mpp")
+            self.popup_message("MPP measurement " + self.finished_text())
 
-            self.save_data()
-            self.keithley.disable_source()
+        self.save_data()
 
-            self.is_meas_live = False
-            self.is_jv_measurement = False
-            self.is_recipe = False
-            self.is_mpp_measurement = False
+        self.is_meas_live = False
+        self.is_jv_measurement = False
+        self.is_recipe = False
+        self.is_mpp_measurement = False
 
     def collect_all_values_iv(self, voltage=[], current=[]):
         # Gather all measurements till now
@@ -1819,6 +1515,11 @@ class MainWindow(QtWidgets.QMainWindow):
         self.canvas.axes.axhline(0, color='black')
         self.canvas.axes.axvline(0, color='black')
         self._plot_ref = None
+        self.loop_lines = {}
+        self.trend_lines = {}
+        if self.trend_axes is not None:
+            self.trend_axes.remove()
+            self.trend_axes = None
 
     def reset_plot_mpp(self):
         self.canvas.axes.cla()
@@ -1864,32 +1565,31 @@ class MainWindow(QtWidgets.QMainWindow):
             name = "g_"
 
         return colli, colda, name
-    def plot_jv(self, voltage, current, mode, counter):
+    def plot_jv(self, voltage, current, mode, counter, first):
+        if self.is_loop and (counter, mode) in self.loop_lines:  # Repeated sweeps only show the latest curve
+            self.loop_lines[(counter, mode)].set_data(voltage, current)
+            self.center_plot(voltage, current)
+            self.canvas.draw_idle()
+            return
 
         colli, colda, name = self.plot_color_selection(counter)
 
         # Make plot
-        if self.is_first_plot:
+        if first:
             if "Light" in mode:
                 if "Forward" in mode:
                     self._plot_ref = self.canvas.axes.plot(voltage, current, color=colli, linestyle="-",
                                                            marker = ".", label=name + "Forward")
-                    self.is_first_plot = False
                 else:
                     self._plot_ref = self.canvas.axes.plot(voltage, current, color=colli, linestyle="--",
                                                            marker = "x",label=name + "Backward")
-                    self.is_first_plot = False
             else:
                 if "Forward" in mode:
                     self._plot_ref = self.canvas.axes.plot(voltage, current, linestyle='-.',
                                                            marker = ".",color=colda, label=name + "Dark For")
-                    self.is_first_plot = False
-
                 else:
                     self._plot_ref = self.canvas.axes.plot(voltage, current, linestyle=':',
                                                            marker = "x",color=colda, label=name + "Dark Back")
-                    self.is_first_plot = False
-
         else:
             if "Light" in mode:
                 if "Forward" in mode:
@@ -1902,6 +1602,9 @@ class MainWindow(QtWidgets.QMainWindow):
                 else:
                     self._plot_ref = self.canvas.axes.plot(voltage, current, marker = "x", linestyle=':',color=colda)
 
+        if self.is_loop:
+            self.loop_lines[(counter, mode)] = self.canvas.axes.lines[-1]
+
         self.canvas.axes.legend(fontsize="8")
 
         # volt, curr = self.collect_all_values_iv(voltage, current)
@@ -1910,6 +1613,27 @@ class MainWindow(QtWidgets.QMainWindow):
         # Draw plot
         self.canvas.draw_idle()
 
+    def plot_loop_trend(self, counter, direc, loop, pce):
+        # PCE of every loop in an inset, with one line per cell and direction that is extended in place
+        if self.trend_axes is None:
+            self.trend_axes = self.canvas.axes.inset_axes([0.08, 0.55, 0.35, 0.35])
+            self.trend_axes.set_xlabel("Loop", fontsize=7)
+            self.trend_axes.set_ylabel("PCE (%)", fontsize=7)
+            self.trend_axes.tick_params(labelsize=6)
+
+        colli, colda, name = self.plot_color_selection(counter)
+        key = (counter, direc)
+        if key not in self.trend_lines:
+            self.trend_lines[key], = self.trend_axes.plot([loop], [pce], color=colli, marker=".",
+                                                          linestyle="-" if direc == "Forward" else "--")
+        else:
+            line = self.trend_lines[key]
+            line.set_data(np.append(line.get_xdata(), loop), np.append(line.get_ydata(), pce))
+        self.trend_axes.relim()
+        self.trend_axes.autoscale_view()
+
+        self.canvas.draw_idle()
+
     def center_plot(self, voltage, current):
         if self.logyaxis.isChecked():
             current = [cu for cu in current if cu > 0]
@@ -1952,23 +1676,22 @@ class MainWindow(QtWidgets.QMainWindow):
             self.canvas.axes.set_ylim([-0.1, 0.1])
             self.canvas.axes.set_xlim([-0.1, 0.1])
 
-    def plot_mpp(self, counter, cell):
+    def plot_mpp(self, times, power, counter, cell, first):
         colli, colda, name = self.plot_color_selection(counter)
 
         # Make plot
-        if self.is_first_plot:
-            self._plot_ref = self.canvas.axes.plot(self.mpp_time, self.mpp_power, color=colli, linestyle="-",
+        if first:
+            self._plot_ref = self.canvas.axes.plot(times, power, color=colli, linestyle="-",
                                                            marker = ".", label="Power: cell "+cell)
-            self.is_first_plot = False
 
         else:
-            self._plot_ref = self.canvas.axes.plot(self.mpp_time, self.mpp_power, color=colli,
+            self._plot_ref = self.canvas.axes.plot(times, power, color=colli,
                                                    linestyle="-", marker=".")
 
         self.canvas.axes.legend(fontsize="8")
 
         # volt, curr = self.collect_all_values_iv(voltage, current)
-        self.center_plot(self.mpp_time, self.mpp_power)
+        self.center_plot(times, power)
 
         # Draw plot
         self.canvas.draw_idle()
@@ -1981,9 +1704,18 @@ class MainWindow(QtWidgets.QMainWindow):
                                      QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
         if reply == QMessageBox.Yes:
             print('Window closed')
+            self.is_meas_live = False
+            self.stop_event.set()
+            self.engine.wait()  # Let a running measurement stop before the instruments are switched off
+            if self.watcher:
+                self.watcher.stop()
             if self.keithley:
                 self.keithley.disable_source()
-            if self.is_susi:
+            for keithley in self.keithleys[1:]:
+                keithley.disable_source()
+            if self.acquisition:
+                self.acquisition.close()
+            elif self.is_susi:
                 self.susi.close()
             # if True:
             #     k8090.__del__
@@ -1994,6 +1726,24 @@ class MainWindow(QtWidgets.QMainWindow):
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # The acquisition server runs in a separate process
     app = QtWidgets.QApplication(sys.argv)
-    w = MainWindow()
+    if "--simulate" in sys.argv:
+        import simulation
+        simulation.from_arguments(sys.argv)
+    if "--record" in sys.argv or "--replay" in sys.argv:
+        import sessions
+        sessions.from_arguments(sys.argv)
+    if "--stations" in sys.argv:
+        import stations
+        station_ports = stations.load_stations(sys.argv[sys.argv.index("--stations") + 1])
+        windows = [MainWindow(station=name, ports=ports) for name, ports in station_ports.items()]
+        overview = stations.StationOverview(windows)
+    else:
+        windows = [MainWindow()]
+    if "--api" in sys.argv:  # Local remote control, one port per station
+        import api
+        following = sys.argv[sys.argv.index("--api") + 1:]
+        api_port = int(following[0]) if following and following[0].isdigit() else api.DEFAULT_PORT
+        remotes = [api.RemoteApi(window, api_port + number) for number, window in enumerate(windows)]
     app.exec_()
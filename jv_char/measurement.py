@@ -0,0 +1,1244 @@
+"""
+Measurement logic of a station, shared by the window (main.py) and the batch runner (batch.py) without any widget.
+"""
+__author__ = "Edgar R. Nandayapa"
+
+import os
+import sys
+import threading
+from time import time, strftime, gmtime, perf_counter, sleep
+from itertools import zip_longest
+import numpy as np
+import pandas as pd
+import sweeps
+import instruments
+import sessions
+
+STOP_POLL_MS = 50  # Longest blocking read while a STOP may arrive
+
+
+class Station:
+    """
+    Instruments, sweeps, MPP tracking and saving of one measurement station.
+
+    Nothing here touches a widget: the settings come from the snapshot in self.settings, and everything the user
+    has to see goes through the engine signals (engine.MeasurementEngine). The subclasses set up the state (see
+    MainWindow.__init__ and BatchRunner.__init__) and provide gather_all_metadata.
+    """
+    def open_devices(self):
+        self.ports = self.station_ports or self.find_devices()  # Port of every instrument
+        self.nplc_calibrations = {}  # Auto speed profile results of these instruments, see auto_speed_setup
+
+        # The instruments can belong to a separate acquisition process instead
+        self.acquisition = self.start_acquisition_server(self.ports) if "--server" in sys.argv else None
+
+        #  Keithley configuration
+        try:
+            device = self.ports["keithley"][0]  # The first keithley found
+            self.keithley = instruments.ShadowKeithley(self.open_device("keithley", device))  # Only changes are sent
+            self.is_tsp = sweeps.command_set(self.keithley) == "TSP"
+            if not self.is_tsp:
+                self.keithley.wires = 4
+        except:
+            device = None
+            self.keithley = None
+            self.is_tsp = False
+
+        # Further Keithleys can measure groups of cells in parallel
+        self.keithleys = [self.keithley] if self.keithley and not self.is_tsp else []
+        if self.keithleys and not self.acquisition:
+            self.keithleys += self.find_extra_keithleys(self.ports["keithley"][1:])
+
+        # Relay card configuration
+        try:
+            relays = self.open_device("relays", self.ports["relays"])
+            self.relays = [instruments.ShadowRelay(relay) for relay in relays]  # States kept for reconnections
+            self.is_relay = True
+        except:
+            self.is_relay = False
+            print("relay not found")
+
+        # SUSI configuration
+        try:
+            self.susi = self.open_device("susi", self.ports["susi"])
+            self.is_susi = True
+            self.is_shutter_open = False
+
+        except:
+            self.is_susi = False
+            self.is_shutter_open = False
+
+        # Arduino temperature sensor configuration
+        try:
+            self.senseTemp = self.open_device("temperature", self.ports["temperature"])
+            self.is_temperature_sensor = True
+        except:
+            self.is_temperature_sensor = False
+
+    def start_watcher(self):
+        connected = {"keithley": self.ports["keithley"][0] if self.keithley else None,
+                     "relays": self.ports["relays"] if self.is_relay else None,
+                     "susi": self.ports["susi"] if self.is_susi else None,
+                     "temperature": self.ports["temperature"] if self.is_temperature_sensor else None}
+        ports = {name: port for name, port in connected.items() if port}
+        if ports:
+            import connection
+            self.watcher = connection.ConnectionWatcher(ports, self.reconnect_device, self.connection_changed)
+            self.watcher.start()
+
+    def reconnect_device(self, name, port):
+        # Runs on the watcher thread, the reopened device gets its previous configuration back
+        if name == "keithley":
+            try:
+                self.keithley.adapter.close()
+            except:
+                pass
+            self.keithley.reconnect(instruments.open_keithley(port))
+        elif name == "relays":
+            for relay, new_relay in zip(self.relays, instruments.open_relays(port)):
+                relay.reconnect(new_relay)
+        elif name == "susi":
+            try:
+                self.susi.close()
+            except:
+                pass
+            self.susi = instruments.open_susi(port)
+            if self.susi_intensity_message:
+                self.susi.write(self.susi_intensity_message)
+            self.susi.write(b'S0' if self.is_shutter_open else b'S1')
+        elif name == "temperature":
+            with self.temperature_lock:
+                try:
+                    self.senseTemp.close()
+                except:
+                    pass
+                self.senseTemp = instruments.open_temperature_sensor(port)
+
+    def connection_changed(self, name, connected):
+        device = {"keithley": "Keithley", "relays": "Relay card", "susi": "SuSi",
+                  "temperature": "Temperature sensor"}[name]
+        if connected:
+            self.engine.status.emit(device + " reconnected, its settings were restored", 10000)
+        else:
+            self.engine.status.emit("##    " + device + " disconnected, waiting for it to come back    ##", 0)
+
+    def device_call(self, name, action, *args):
+        # A failed access pauses the measurement until the device is reconnected, returns None after a STOP
+        while True:
+            try:
+                return action(*args)
+            except sessions.ReplayError:  # Not a lost device, the replay ends the measurement
+                raise
+            except Exception:
+                if self.watcher is None or name not in self.watcher.ports:
+                    raise
+                self.watcher.mark_lost(name)
+                if not self.watcher.wait_reconnected(name, self.stop_event):
+                    return None
+
+    def find_devices(self):
+        if sessions.player:  # The instruments of the replayed session
+            self.discovery_thread = None
+            return sessions.player.ports()
+        if "--simulate" in sys.argv:  # Simulated instruments instead of the setup
+            self.discovery_thread = None
+            import simulation
+            return simulation.ports(self.station or "1")
+
+        # Known ports are only checked, the full search for the next start-up then runs in the background
+        import discovery
+        cached = discovery.load_cache()
+        if cached:
+            self.discovery_thread = threading.Thread(target=self.refresh_devices, daemon=True)
+            return discovery.verify(cached)
+
+        self.discovery_thread = None
+        ports = discovery.discover()
+        discovery.save_cache(ports)
+
+        return ports
+
+    def refresh_devices(self):
+        if self.is_temperature_sensor and not self.acquisition:  # Listening takes seconds, so it is checked here
+            for _ in range(3):
+                try:
+                    self.read_temperature_sensor()
+                    break
+                except:
+                    pass
+            else:
+                self.is_temperature_sensor = False
+
+        connected = {"keithley": self.ports["keithley"][:len(self.keithleys) or 1] if self.keithley else [],
+                     "relays": self.ports["relays"] if self.is_relay else None,
+                     "susi": self.ports["susi"] if self.is_susi else None,
+                     "temperature": self.ports["temperature"] if self.is_temperature_sensor else None}
+        in_use = connected["keithley"] + [port for port in connected.values() if isinstance(port, str)]
+        import discovery
+        found = discovery.discover(skip=in_use)
+
+        ports = {name: connected[name] or found[name] for name in connected}
+        ports["keithley"] = connected["keithley"] + found["keithley"]
+        discovery.save_cache(ports)
+
+        new = [name for name in connected if found[name] and not connected[name]]
+        if new:
+            self.engine.status.emit("Found " + ", ".join(new) + " on a new port, restart the program to use it", 0)
+
+    def start_acquisition_server(self, ports):
+        ports = {"keithley": (ports["keithley"] or [None])[0], "relays": ports["relays"], "susi": ports["susi"],
+                 "temperature": ports["temperature"]}
+        import acquisition
+        server = acquisition.AcquisitionClient(ports)
+        self.engine.status.emit("Acquisition server started, viewers can attach to: " + server.ring.name, 0)
+
+        return server
+
+    def open_device(self, name, port):
+        # Opened here, or only a handle when the acquisition server owns the device
+        if port is None:
+            raise IOError(name + " not found")
+        if self.acquisition:
+            return self.acquisition.instrument(name)
+        return instruments.DEVICE_OPENERS[name](port)
+
+    def find_extra_keithleys(self, devices):
+        extra = []
+        for device in devices:
+            try:
+                keithley = instruments.ShadowKeithley(self.open_device("keithley", device))
+                if sweeps.command_set(keithley) == "SCPI":
+                    keithley.wires = 4
+                    extra.append(keithley)
+            except:
+                pass
+
+        return extra
+
+    def pause(self, seconds, stoppable=True):
+        # The worker thread waits until the time is over or STOP (the whole time if not stoppable, e.g. for the
+        # hardware to reach its safe state)
+        if sessions.player:
+            seconds = sessions.player.scaled(seconds)
+        if stoppable:
+            self.stop_event.wait(max(seconds, 0))
+        else:
+            sleep(max(seconds, 0))
+
+    def set_four_wire(self, four_wire):
+        for keithley in self.keithleys:
+            if four_wire:
+                keithley.write("SENS:CURR:RSEN ON")
+            else:
+                keithley.write("SENS:CURR:RSEN OFF")
+
+    def fix_jv_chars_for_save(self):
+        names = ["Voc (V)", "Jsc (mA/cm2)", "FF (%)", "PCE (%)", "V_mpp (V)", "J_mpp (mA/cm2)", "P_mpp (mW/cm2)",
+                 "R_series (Ohm cm2)", "R_shunt (Ohm cm2)", "Temperature (°C)", "Time"]
+        names_f = [na.replace(" ", "") for na in names]
+        # names_t = [na.replace(" ","\n") for na in names]
+        # empty = ["","","","","","","","",""]
+
+        self.jv_chars_results = self.jv_chars_results.T
+        self.jv_chars_results.columns = names_f
+
+    def check_filename(self, type, name="", count=0):
+        if type == "jv":
+            tag = "JV_"
+        elif type == "mpp":
+            tag = "MPP_"
+        else:
+            tag = "Recipe_"
+        if self.is_jv_measurement:
+            file_name = self.folder + tag + self.sample + ".txt"
+        elif self.is_mpp_measurement:
+            file_name = self.folder + tag + self.sample + "_" + name + ".txt"
+        else:
+            file_name = file_name = self.folder + "test_" + self.sample + ".txt"
+
+        while os.path.exists(file_name):
+            count += 1
+            if self.is_mpp_measurement:
+                file_name = self.folder + tag + self.sample + "_" + name + "-" + str(count) + ".txt"
+            else:
+                file_name = self.folder + tag + self.sample + "-" + str(count) + ".txt"
+        else:
+            return file_name
+
+    def save_jv(self):
+        #self.is_mpp_bool = False
+        self.gather_all_metadata()
+
+        metadata = pd.DataFrame.from_dict(self.meta_dict, orient='index')
+        empty = pd.DataFrame(data={"": ["--"]})
+        filename = self.check_filename("jv")
+        # print("  " + filename)
+        metadata.to_csv(filename, index=True, header=False, sep="\t")
+        empty.to_csv(filename, mode="a", index=False, header=False, lineterminator='\n', sep="\t")
+        try:
+            self.jv_chars_results.T.to_csv(filename, mode="a", index=True, header=True, sep="\t")
+            empty.to_csv(filename, mode="a", index=False, header=False, lineterminator='\n', sep="\t")
+        except:
+            pass
+        self.curr_volt_results.to_csv(filename, mode="a", index=False, header=True, sep="\t")
+        self.engine.status.emit("Data saved successfully to " + filename, 0)
+
+    def save_mpp(self, cell, mpp_data):
+        #self.is_mpp_bool = True
+        self.gather_all_metadata()
+        metadata = pd.DataFrame.from_dict(self.meta_dict, orient='index')
+
+        filename = self.check_filename("mpp", cell)
+
+        metadata.to_csv(filename, header=False, sep="\t")
+        mpp_data.to_csv(filename, mode="a", index=False, sep="\t")
+
+        self.engine.status.emit("Data saved successfully", 5000)
+
+    def keithley_startup_setup(self): # TODO keithley configuration
+        if self.is_tsp:  # Only the MPP script can be used, and it configures the Keithley itself
+            return
+        self.set_four_wire(self.settings["four_wire"])
+        curr_limit = float(self.settings["curr_lim"])
+        nplc, auto_zero = self.speed_profile_settings()
+        for keithley in self.keithleys:  # All Keithleys share the same configuration
+            keithley.apply_voltage(compliance_current = curr_limit / 1000)
+            # keithley.apply_voltage(voltage_range=2, compliance_current = curr_limit / 1000)
+            keithley.measure_current(nplc=nplc, current=curr_limit / 1000, auto_range=False)
+            sweeps.set_auto_zero(keithley, auto_zero)
+
+        self.speed_settings = {"NPLC": nplc, "Current range (A)": curr_limit / 1000, "Auto zero": auto_zero}
+
+    def speed_profile_settings(self):
+        profile = self.settings["speed_profile"]
+
+        if profile == "Manual":
+            nplc = float(self.settings["int_time"]) * sweeps.line_frequency(self.keithley)
+            return min(max(nplc, 0.01), 10), "ONCE"
+        elif profile == "Auto":  # Starting point, tuned before every sweep and MPP tracking (see auto_speed_setup)
+            return sweeps.NPLC_STEPS[0], "ONCE"
+        else:
+            return sweeps.SPEED_PROFILES[profile]
+
+    def auto_speed_setup(self, volt_0, average_points, area, ilum):
+        # Fixed range from the previous sweep with the same illumination, then the fastest NPLC meeting the target
+        curr_limit = float(self.settings["curr_lim"]) / 1000
+        span = self.last_current_span.get(ilum, curr_limit)
+        curr_range = sweeps.pick_current_range(span, curr_limit)
+
+        if curr_range != self.speed_settings.get("Current range (A)") or "Noise (A)" not in self.speed_settings:
+            self.keithley.current_range = curr_range
+            target = float(self.settings["ave_target"]) * area / 1000
+            key = (curr_range, volt_0, target, average_points, ilum)  # Calibrated once per session and settings
+            if key not in self.nplc_calibrations:
+                self.keithley.source_voltage = volt_0
+                calibration = sweeps.calibrate_nplc(self.keithley, target, average_points,
+                                                    should_stop=self.stop_event.is_set)
+                if self.stop_event.is_set():  # Cut short, not kept
+                    return
+                self.nplc_calibrations[key] = calibration
+            nplc, auto_zero, noise = self.nplc_calibrations[key]
+            sweeps.set_nplc(self.keithley, nplc)
+            sweeps.set_auto_zero(self.keithley, auto_zero)
+            self.speed_settings.update({"NPLC": nplc, "Current range (A)": curr_range, "Auto zero": auto_zero,
+                                        "Noise (A)": float(noise)})
+            for keithley in self.keithleys[1:]:  # Same settings on the other Keithleys
+                keithley.current_range = curr_range
+                sweeps.set_nplc(keithley, nplc)
+                sweeps.set_auto_zero(keithley, auto_zero)
+
+        if self.speed_settings["Auto zero"] == "ONCE":
+            for keithley in self.keithleys:  # Fresh zero reference for every sweep, without the time cost
+                sweeps.set_auto_zero(keithley, "ONCE")
+
+    def find_nearest(self, array, value):
+        array = np.asarray(array)
+        idx = (np.abs(array - value)).argmin()
+        return idx
+
+    def jv_chars_calculation(self, volt, curr):
+        # Find Isc (find voltage value closest to 0 Volts)
+        volt = np.array(volt)
+        curr = np.array(curr)
+
+        # if reverse measurement, flip it around
+        if volt[0] > volt[-1]:
+            volt = np.flip(volt)
+            curr = np.flip(curr)
+
+        v0 = np.argmin(abs(volt))  # Find voltage closest to zero
+
+        # Fit datapoint around Jsc to get Shunt(parallel) resistance
+        lr_volt = 0.2
+        p_pos = int(self.find_nearest(volt, value=lr_volt))
+        n_pos = int(self.find_nearest(volt, value=-lr_volt))
+        m_i = np.polyfit(volt[n_pos: p_pos], curr[n_pos: p_pos], 1)[0]  # Slope of a linear fit
+
+        if volt[v0] <= 0.0001:  # If voltage is equal to zero
+            isc = curr[v0]
+        else:  # Otherwise calculate from slope
+            b_i = -curr[v0] - m_i * volt[v0]
+            isc = -b_i
+
+        # For Voc, find closest current values to 0
+        i1 = np.where(curr < 0, curr, -np.inf).argmax()
+        i2 = np.where(curr > 0, curr, np.inf).argmin()
+
+        c1 = curr[i1]
+        c2 = curr[i2]
+
+        # Get Voc by finding x-intercept (y=mx+b)
+        v1 = volt[i1]
+        v2 = volt[i2]
+        m_v = (c2 - c1) / (v2 - v1)
+        b_v = c1 - m_v * v1
+        voc = -b_v / m_v
+
+        # Calculate resistances, parallel and series
+        r_par = abs(1 / m_i) * 1000 # 1000 factor to make it Ohms (since using mA)
+        r_ser = abs(1 / m_v) * 1000
+
+        # Find mpp values
+        mpp = np.argmax(-volt * curr)
+
+        mpp_v = volt[mpp]
+        mpp_c = curr[mpp]
+        mpp_p = mpp_v * mpp_c
+
+        # Calculate FF
+        ff = mpp_v * mpp_c / (voc * isc) * 100
+
+        # Calculate PCE (this is wrong, it needs correct P_in)
+        # pin = 75#mW/cm²
+        pin = float(self.settings["pow_dens"])  # mW/cm²
+        pce = abs(voc * isc * ff) / pin
+
+        uhrzeit = strftime("%d.%m.%Y %H:%M:%S", gmtime())
+
+        temper = self.read_temperature_sensor()
+
+        jv_char = [voc, isc, ff, pce, mpp_v, mpp_c, mpp_p, r_ser, r_par, temper, uhrzeit]
+
+        return jv_char
+
+    def read_temperature_sensor(self):
+        if self.is_temperature_sensor and self.acquisition:  # Kept up to date by the acquisition server
+            temp_sensor = self.acquisition.ring.temperature
+        elif self.is_temperature_sensor and not (self.watcher and self.watcher.is_lost("temperature")):
+            try:
+                with self.temperature_lock:
+                    temp_bin = self.senseTemp.readline().strip()   # read a byte
+            except OSError:  # Unplugged, the watcher reconnects it
+                if self.watcher is None:
+                    raise
+                self.watcher.mark_lost("temperature")
+                return np.nan
+            temp_sensor = float(temp_bin[-5:])
+        else:
+            temp_sensor = np.nan
+
+        return temp_sensor
+
+    def set_intensity_susim(self, intensity):
+
+        # print(intensity)
+        # self.susi_start_intensity = int(intensity)
+        intensity = int(intensity * 10)
+        value = "{:04d}".format(intensity)
+        message = "P=" + value
+        # print(message)
+
+        self.susi_intensity_message = message.encode('utf-8')
+        self.susi.write(self.susi_intensity_message)  # Set light intensity
+
+    def susim_check(self):
+        if self.is_susi:
+            self.susi.write(b'FS')  # Read data
+            susi_ans = self.susi.read_until(b"END\r\n")
+
+            return susi_ans
+
+    def start_shutter(self, opened):
+        # The shutter moves in the background, actions.wait("shutter") must come before measuring
+        if self.is_susi and self.is_shutter_open != opened:
+            self.is_shutter_open = opened
+            self.actions.start("shutter", self.move_shutter, opened, True)
+
+    def move_shutter(self, opened, confirm=False):
+        if opened:
+            self.susi.write(b'S0')  # Shutter Open
+            self.engine.shutter.emit("SuSi Shutter (Opened)")
+        else:
+            self.susi.write(b'S1')  # Shutter Closed
+            self.engine.shutter.emit("SuSi Shutter (Closed)")
+        self.pause(3, stoppable=opened)  # A STOP does not cut short the closing, it is part of the safe state
+        self.is_shutter_open = opened
+
+        if confirm and (self.is_meas_live or not opened) and (b"SHUTTER=0" in self.susim_check()) != opened:
+            raise RuntimeError("SuSi shutter did not " + ("open" if opened else "close"))
+
+    def read_measurement_variables(self):
+        # area = float(self.sam_area.text())
+        area = self.get_areas()
+
+        # JV variables
+        volt_begin = float(self.settings["volt_start"])
+        volt_end = float(self.settings["volt_end"])
+        volt_step = float(self.settings["volt_step"])
+        ap = int(self.settings["ave_pts"])
+        time = float(self.settings["set_time"])
+
+        # MPP Variables
+        mpp_total_time = float(self.settings["mpp_ttime"]) * 60
+        mpp_int_time = float(self.settings["mpp_inttime"])
+        mpp_step = float(self.settings["mpp_stepSize"])
+        mpp_voltage = float(self.settings["mpp_voltage"])
+
+        jv_variables = [volt_begin, volt_end, volt_step, ap, time, area]
+        mpp_variables = [mpp_total_time, mpp_int_time, mpp_step, mpp_voltage, area]
+
+        return jv_variables, mpp_variables
+
+    def empty_results_arrays(self):
+        if self.is_jv_measurement or self.is_recipe:
+            self.res_fwd_curr = []
+            self.res_fwd_volt = []
+            self.res_bkw_curr = []
+            self.res_bkw_volt = []
+            self.jv_chars_results = pd.DataFrame()
+            self.curr_volt_results = pd.DataFrame()
+            self.last_voc = {}  # Voc of the previous light sweep of each cell (only within this run)
+            self.last_current_span = {}  # Largest current (A) of the previous sweep, per illumination
+            self.loop_curves = {}  # Running statistics of repeated sweeps, per cell and curve type
+            self.loop_latest = {}
+        elif self.is_mpp_measurement:
+            self.mpp_current = []
+            self.res_mpp_voltage = []
+            self.mpp_power = []
+            self.mpp_time = []
+            self.mpp_zeit = []
+        else:
+            pass
+
+    def get_areas(self):
+        if self.is_multiplex:
+            area = []
+            multi = ["area_a", "area_b", "area_c", "area_d", "area_e", "area_f"]
+
+            for m in multi:
+                area.append(float(self.settings[m]))
+
+        else:
+            area = float(self.settings["sam_area"])
+
+        self.real_area = area
+
+        return area
+
+    def read_measurement_type(self):
+        self.empty_results_arrays()
+        self.soaking_process()
+        self.is_loop = False
+
+        if self.is_recipe:
+            meas_process = self.recipe_list
+            self.jv_multiplex_setup(meas_process)
+        elif self.is_jv_measurement:
+            check_box_buttons = ["for_bmD", "rev_bmD", "for_bmL", "rev_bmL"]
+
+            meas_process = []
+            for ck, cbb in enumerate(check_box_buttons):
+                if self.settings[cbb]:
+                    if ck == 0:
+                        meas_process.append("FD")
+                    elif ck == 1:
+                        meas_process.append("RD")
+                    elif ck == 2:
+                        meas_process.append("FL")
+                    elif ck == 3:
+                        meas_process.append("RL")
+                    else:
+                        pass
+
+            self.loop_total = max(int(self.settings["loop_count"]), 1)
+            self.is_loop = self.loop_total > 1
+            self.loop_steps = len(meas_process)
+            self.jv_multiplex_setup(meas_process * self.loop_total)
+            if self.is_loop:
+                self.store_loop_results()
+        elif self.is_mpp_measurement:
+            self.mpp_multiplex_setup()
+        else:
+            print("read_measurement_type not found")
+
+    def jv_multiplex_setup(self, meas_process):
+        jv_variables, _ = self.read_measurement_variables()
+        volt_begin, volt_end, volt_step, ap, time, area = jv_variables
+
+        forwa_vars = [volt_begin, volt_end + volt_step * 0.95, volt_step]
+        rever_vars = [volt_end, volt_begin - volt_step * 0.95, -volt_step]
+        fixed_vars = [time, ap, area]
+
+        if self.is_multiplex:
+            cell_list = [self.settings[c] for c in ["cell_a", "cell_b", "cell_c", "cell_d", "cell_e", "cell_f"]]
+            cell_name = ["a", "b", "c", "d", "e", "f"]
+        else:
+            cell_list = [self.settings["cell_g"]]
+            cell_name = [""]
+
+        groups = self.smu_cell_groups(cell_list) if self.is_multiplex else []
+
+        if len(groups) > 1:
+            areas = self.get_areas()
+            # Every round connects the next cell of each group to its own Keithley, and measures them together
+            for round_cells in zip_longest(*groups):
+                channels = [(keithley, cn) for keithley, cn in zip(self.keithleys, round_cells) if cn is not None]
+                if not self.is_meas_live:
+                    break
+                self.illumination_setup(meas_process[0])  # Moves while the relays switch
+                for _, cn in channels:
+                    self.relays[cn].on()
+                self.parallel_jv_perform_measurement(meas_process, forwa_vars, rever_vars, fixed_vars, cell_name,
+                                                     channels, areas)
+                for _, cn in channels:
+                    self.relays[cn].off()
+            self.is_meas_live = False
+
+        elif self.is_multiplex:
+            areas = self.get_areas()
+            for cn, cell in enumerate(cell_list):
+                fixed_vars[-1] = areas[cn]
+                if cell and self.is_meas_live:
+                    self.illumination_setup(meas_process[0])  # Moves while the relay switches
+                    self.relays[cn].on()
+                    self.jv_perform_measurement(meas_process, forwa_vars, rever_vars, fixed_vars, cell_name, cn, cell)
+                    self.relays[cn].off()
+                elif not self.is_meas_live:
+                    self.relays[cn].off()
+                    break
+            self.is_meas_live = False
+
+        else:
+            self.jv_perform_measurement(meas_process, forwa_vars, rever_vars, fixed_vars, cell_name)
+            self.is_meas_live = False
+
+    def smu_cell_groups(self, cell_list):
+        # Checked cells of every Keithley from e.g. "abc,def", cells missing in the text go to the first Keithley
+        names = "abcdef"
+        groups = [[names.index(c) for c in group if c in names]
+                  for group in self.settings["smu_cells"].lower().replace(" ", "").split(",") if group]
+        if len(groups) > len(self.keithleys):
+            self.engine.status.emit("Only {} Keithley found, measuring the cells one by one"
+                                    .format(len(self.keithleys)), 10000)
+            return []
+        listed = sum(groups, [])
+        if len(listed) != len(set(listed)):
+            self.engine.status.emit("A cell is listed more than once in the Keithley cells, measuring the cells "
+                                    "one by one", 10000)
+            return []
+        if groups:
+            groups[0] += [cn for cn in range(len(names)) if cn not in sum(groups, [])]
+
+        return [[cn for cn in group if cell_list[cn]] for group in groups]
+
+    def mpp_multiplex_setup(self):
+        self.engine.status.emit("Tracking Maximum Power Point", 0)
+        # self.reset_plot_mpp()
+        _, mpp_variables = self.read_measurement_variables()
+        areas = self.get_areas()
+
+        if self.is_multiplex:
+            cell_list = [self.settings[c] for c in ["cell_a", "cell_b", "cell_c", "cell_d", "cell_e", "cell_f"]]
+            cell_name = ["a", "b", "c", "d", "e", "f"]
+        else:
+            cell_list = [self.settings["cell_g"]]
+            cell_name = [""]
+
+        self.start_shutter(True)
+
+        while self.is_meas_live:
+            if self.is_multiplex:
+                for cn, cell in enumerate(cell_list):
+                    mpp_variables[-1] = areas[cn]
+                    self.mpp_time = []
+                    self.mpp_zeit = []
+                    self.mpp_current = []
+                    self.res_mpp_voltage = []
+                    self.mpp_power = []
+
+                    if cell and self.is_meas_live:
+                        #print(cn, cell_name[cn])
+                        self.device_call("relays", self.relays[cn].on)
+                        self.mpp_perform_measurement(mpp_variables, cell_name, cn, cell)
+                        self.device_call("relays", self.relays[cn].off)
+                        self.engine.mpp_done.emit(cell_name[cn], self.mpp_data())  # Saved during the next cell
+            else:
+                self.mpp_perform_measurement(mpp_variables, cell_name)
+                self.engine.mpp_done.emit('', self.mpp_data())
+
+            self.is_meas_live = False
+        self.start_shutter(False)
+
+    def mpp_point(self, voltage, settle, area):
+        self.keithley.source_voltage = voltage
+        # Wait for stabilized measurement
+        self.pause(settle)
+        # Measure current density
+        return self.keithley.current * 1000 / area
+
+    def mpp_data(self):
+        return pd.DataFrame({"Elapsed (min)": self.mpp_time, "Date/Time":self.mpp_zeit,
+                             "Voltage (V)": self.res_mpp_voltage, "Current (mA/cm²)": self.mpp_current,
+                             "Power (mW/cm²)": self.mpp_power})
+
+    def soaking_process(self):
+        light = int(self.settings["light_soak"])  # Read values
+        bias = float(self.settings["bias_soak"])
+        self.start_shutter(True)
+        for keithley in self.keithleys:
+            keithley.source_voltage = bias  # Set the wanted bias
+        self.actions.wait("shutter")  # Soaking starts with the shutter open
+        self.pause(light)
+
+    def sweep_settings(self, mpr, forwa_vars, rever_vars, cell):
+        ilum = "Dark" if "D" in mpr else "Light"
+
+        if "F" in mpr:  # if it is forward
+            direc = "Forward"
+            sweep_vars = forwa_vars
+        else:
+            direc = "Reverse"
+            sweep_vars = rever_vars
+
+        # Reverse sweeps start just above the previous Voc of this cell. Forward sweeps find Voc live,
+        # except buffered ones, which cannot be stopped halfway and use the previous Voc as well
+        if self.settings["early_stop"] and ilum == "Light" and cell in self.last_voc:
+            if direc == "Reverse" or self.settings["sweep_mode"].startswith("Buffered"):
+                sweep_vars = sweeps.sweep_window(*sweep_vars, self.last_voc[cell], float(self.settings["voc_margin"]))
+
+        return ilum, direc, list(sweep_vars)
+
+    def is_dual_pair(self, meas_process, ck):
+        # Two consecutive steps with the same illumination and opposite directions can run as one dual sweep
+        if self.settings["sweep_mode"] != "Buffered dual" or ck + 1 >= len(meas_process):
+            return False
+        this, following = meas_process[ck], meas_process[ck + 1]
+
+        return ("D" in this) == ("D" in following) and ("F" in this) != ("F" in following)
+
+    def jv_perform_measurement(self, meas_process, forwa_vars, rever_vars, fixed_vars, cell_name, cn=0, cell=""):
+        #self.soaking_process()
+        dual_curves = {}  # Second halves of dual sweeps, by process step
+        for ck, mpr in enumerate(meas_process):
+            # print(mpr)
+            if not self.is_meas_live:
+                break
+            self.is_first_plot = True
+            self.illumination_setup(mpr)
+
+            ilum, direc, sweep_vars = self.sweep_settings(mpr, forwa_vars, rever_vars, cell_name[cn])
+            all_vars = sweep_vars + fixed_vars + [ilum + direc]
+            self.actions.wait("shutter")  # No sweep before the shutter is in place
+
+            if self.settings["speed_profile"] == "Auto" and ck not in dual_curves:
+                self.auto_speed_setup(sweep_vars[0], fixed_vars[1], fixed_vars[2], ilum)
+
+            if ck in dual_curves:  # Already measured together with the previous step
+                volt, curr, self.curve_extras = dual_curves.pop(ck)
+            elif self.is_dual_pair(meas_process, ck):
+                _, next_direc, next_vars = self.sweep_settings(meas_process[ck + 1], forwa_vars, rever_vars,
+                                                               cell_name[cn])
+                next_all_vars = next_vars + fixed_vars + [ilum + next_direc]
+                first, second = self.dual_curr_volt_measurement(all_vars, next_all_vars, cn)
+                volt, curr, self.curve_extras = first
+                dual_curves[ck + 1] = second
+            else:
+                volt, curr = self.curr_volt_measurement(all_vars, cn)
+
+            self.collect_jv_results(ck, cn, cell_name, direc, ilum, volt, curr, fixed_vars[2])
+
+    def parallel_jv_perform_measurement(self, meas_process, forwa_vars, rever_vars, fixed_vars, cell_name, channels,
+                                        areas):
+        # Same steps as jv_perform_measurement, with one cell on every (keithley, cell) channel
+        for ck, mpr in enumerate(meas_process):
+            if not self.is_meas_live:
+                break
+            self.is_first_plot = True
+            self.illumination_setup(mpr)
+
+            all_vars = {}
+            for _, cn in channels:
+                ilum, direc, sweep_vars = self.sweep_settings(mpr, forwa_vars, rever_vars, cell_name[cn])
+                all_vars[cn] = sweep_vars + fixed_vars[:2] + [areas[cn], ilum + direc]
+            self.actions.wait("shutter")  # No sweep before the shutter is in place
+
+            if self.settings["speed_profile"] == "Auto":
+                first = channels[0][1]
+                self.auto_speed_setup(all_vars[first][0], fixed_vars[1], areas[first], ilum)
+
+            if self.settings["sweep_mode"].startswith("Buffered"):  # Dual pairs run as two separate sweeps
+                curves = self.buffered_channels_measurement(channels, all_vars)
+            else:
+                curves = self.stepped_curr_volt_measurement(channels, all_vars)
+
+            for _, cn in channels:
+                volt, curr, self.curve_extras = curves[cn]
+                self.collect_jv_results(ck, cn, cell_name, direc, ilum, volt, curr, areas[cn])
+
+    def illumination_setup(self, mpr):
+        if "D" in mpr:  # if it is a dark measurement
+            if self.is_susi and self.is_shutter_open and self.is_meas_live:
+                self.start_shutter(False)
+        else:
+            if self.is_susi and not self.is_shutter_open:
+                self.start_shutter(True)
+
+    def collect_jv_results(self, ck, cn, cell_name, direc, ilum, volt, curr, area):
+        if len(curr) > 0:
+            self.last_current_span[ilum] = np.max(np.abs(curr)) * area / 1000
+
+        if self.is_loop:
+            loop = ck // self.loop_steps + 1
+            m_name = cell_name[cn] + "-" + str(loop) if self.is_multiplex else str(loop)
+        elif self.is_recipe:
+            if not self.is_multiplex:
+                m_name = str(ck)
+            else:
+                m_name = cell_name[cn] + "-" + str(ck)
+            # rep_count += 1
+        else:
+            m_name = cell_name[cn]
+
+        if self.is_meas_live and ilum == "Light":
+            chars = self.jv_chars_calculation(volt, curr)
+            self.jv_chars_results["{0}_{1}_{2}".format(m_name, direc, ilum)] = chars
+            if np.isfinite(chars[0]) and min(volt) < chars[0] < max(volt):
+                self.last_voc[cell_name[cn]] = chars[0]
+            self.engine.jv_chars.emit(self.jv_chars_results.copy())
+            if self.is_loop:
+                self.engine.loop_trend.emit(cn, direc, loop, chars[3])
+
+        if self.is_loop:  # Only the statistics and the latest curve are kept
+            key = (cell_name[cn], direc, ilum)
+            self.loop_curves.setdefault(key, sweeps.RunningCurve()).add(volt, curr)
+            self.loop_latest[key] = (volt, curr, self.curve_extras)
+            self.engine.status.emit("Repeated sweeps: loop {} of {}".format(loop, self.loop_total), 0)
+        else:
+            self.store_curve_results(m_name, direc, ilum, volt, curr)
+
+    def store_loop_results(self):
+        # Mean curve and spread of the repeated sweeps, and the last sweep, of every cell and curve type
+        for (cell, direc, ilum), stats in self.loop_curves.items():
+            prefix = cell + "-" if cell else ""
+            self.curve_extras = {"Loop Std Dev(mA/cm²)": stats.std_curve(), "Sweeps": stats.count}
+            self.store_curve_results(prefix + "mean", direc, ilum, stats.voltage, stats.mean_curve())
+
+            volt, curr, self.curve_extras = self.loop_latest[(cell, direc, ilum)]
+            self.store_curve_results(prefix + "last", direc, ilum, volt, curr)
+
+    def store_curve_results(self, m_name, direc, ilum, volt, curr):
+        # Curves can have different lengths (adaptive grid, stopped sweeps), so columns are joined side by side
+        tag = "_" + m_name + "_" + direc + "_" + ilum
+        columns = {"Voltage (V)" + tag: volt, "Current Density(mA/cm²)" + tag: curr}
+        for label, values in self.curve_extras.items():  # Per point values, e.g. standard deviation
+            columns[label + tag] = values
+
+        curve = pd.DataFrame({key: pd.Series(val, dtype=float) for key, val in columns.items()})
+        self.curr_volt_results = pd.concat([self.curr_volt_results, curve], axis=1)
+
+    def mpp_perform_measurement(self, mpp_variables,cell_name, cn=0, cell=''):
+        self.actions.wait("shutter")  # No tracking before the shutter is open
+        if self.is_tsp:  # The PC tracking needs SCPI, and the Keithley was not set up for it
+            if self.settings["mpp_mode"] != "Keithley (TSP)":
+                self.engine.status.emit("Keithley is in TSP mode, tracking on the Keithley instead", 10000)
+            return self.tsp_mpp_perform_measurement(mpp_variables, cell_name, cn)
+        if self.settings["mpp_mode"] == "Keithley (TSP)":
+            self.engine.status.emit("Keithley is not in TSP mode, tracking from the PC instead", 10000)
+
+        self.is_first_plot = True
+        mpp_total_time, mpp_int_time, mpp_step, mpp_voltage, area = mpp_variables
+
+        if self.settings["speed_profile"] == "Auto":  # Single readings at the starting voltage
+            self.auto_speed_setup(mpp_voltage, 1, area, "Light")
+
+        # areas = self.get_areas()
+        max_voltage = mpp_voltage
+        time_c = sessions.clock()  # Replayed sessions track as many points as the recorded one
+        tc = 0
+
+        #print(0, mpp_total_time / 3, mpp_int_time / 1000)
+        for i in np.arange(0, mpp_total_time / 3, mpp_int_time / 1000):
+            voltage_test = [max_voltage - mpp_step, max_voltage, max_voltage + mpp_step]
+            # print(voltage_test)
+            mpp_test_current = []
+            mpp_test_voltage = []
+            mpp_test_power = []
+
+            for v in voltage_test:
+                # A lost Keithley pauses the tracking here until it is back
+                m_current = self.device_call("keithley", self.mpp_point, v, mpp_int_time / 1000, area) \
+                    if self.is_meas_live else None
+                if m_current is not None and self.is_meas_live:
+                    m_voltage = v  # self.keithley.voltage
+
+                    mpp_test_current.append(m_current)
+                    mpp_test_voltage.append(m_voltage)
+                    mpp_test_power.append(abs(m_voltage * m_current))
+                else:
+                    mpp_test_current.append(np.nan)
+                    mpp_test_voltage.append(np.nan)
+                    mpp_test_power.append(np.nan)
+                    break
+            if not self.is_meas_live:
+                break
+
+            index_max = mpp_test_power.index(max(mpp_test_power))
+            self.mpp_current.append(mpp_test_current[index_max])
+            max_voltage = mpp_test_voltage[index_max]
+            self.res_mpp_voltage.append(max_voltage)
+
+            self.engine.live_voltage.emit(max_voltage, True)
+            self.engine.live_current.emit(mpp_test_current[index_max], True)
+
+            self.mpp_power.append(mpp_test_power[index_max])
+
+            if i == 0:
+                tc = sessions.clock() - time_c
+                elapsed_t = 0
+            else:
+                elapsed_t = (sessions.clock() - time_c - tc)
+
+            self.mpp_time.append(elapsed_t / 60)
+            uhrzeit = strftime("%d.%m.%Y %H:%M:%S", gmtime())
+            self.mpp_zeit.append(uhrzeit)
+            self.engine.mpp_curve.emit(list(self.mpp_time), list(self.mpp_power), cn, cell_name[cn],
+                                       self.is_first_plot)
+            self.is_first_plot = False
+
+            if elapsed_t > mpp_total_time:
+                break
+
+        self.engine.live_current.emit(0, False)
+        self.engine.live_voltage.emit(0, False)
+
+    def tsp_mpp_perform_measurement(self, mpp_variables, cell_name, cn=0):
+        # The tracking loop runs on the Keithley, here the printed points are only collected and plotted
+        from pyvisa.errors import VisaIOError  # Loaded with the Keithley
+
+        self.is_first_plot = True
+        mpp_total_time, mpp_int_time, mpp_step, mpp_voltage, area = mpp_variables
+        curr_limit = float(self.settings["curr_lim"]) / 1000
+        wires = 4 if self.settings["four_wire"] else 2
+
+        connection = self.keithley.adapter.connection
+        old_timeout = connection.timeout
+        connection.timeout = STOP_POLL_MS  # Short reads, so a STOP is seen while waiting for the next point
+
+        try:  # On errors the script is stopped by safe_state
+            sweeps.start_tsp_mpp(self.keithley, mpp_voltage, mpp_step, mpp_int_time / 1000, mpp_total_time,
+                                 curr_limit, wires=wires)
+            while self.is_meas_live:
+                try:
+                    point = sweeps.read_tsp_mpp(self.keithley)
+                except (VisaIOError, ValueError):  # Nothing printed yet, or the end of a line cut by the timeout
+                    continue
+                if point is None:  # The script reached the total time
+                    break
+                elapsed_t, voltage, current = point
+
+                m_current = current * 1000 / area
+                self.mpp_current.append(m_current)
+                self.res_mpp_voltage.append(voltage)
+                self.mpp_power.append(abs(voltage * m_current))
+                self.mpp_time.append(elapsed_t / 60)
+                self.mpp_zeit.append(strftime("%d.%m.%Y %H:%M:%S", gmtime()))
+
+                self.engine.live_voltage.emit(voltage, True)
+                self.engine.live_current.emit(m_current, True)
+                self.engine.mpp_curve.emit(list(self.mpp_time), list(self.mpp_power), cn, cell_name[cn],
+                                           self.is_first_plot)
+                self.is_first_plot = False
+
+            if not self.is_meas_live:  # Stopped by the user before the script finished
+                sweeps.stop_tsp_mpp(self.keithley)
+        finally:
+            connection.timeout = old_timeout
+        self.engine.live_current.emit(0, False)
+        self.engine.live_voltage.emit(0, False)
+
+    def curr_volt_measurement(self, variables, counter):
+        if self.settings["sweep_mode"].startswith("Buffered"):
+            return self.buffered_curr_volt_measurement(variables, counter)
+        if self.acquisition and self.settings["sweep_mode"] == "Stepped" and self.settings["settle_mode"] == "Fixed" \
+                and self.settings["average_mode"] == "PC":
+            return self.server_curr_volt_measurement(variables, counter)
+
+        voltage, current, self.curve_extras = self.stepped_curr_volt_measurement([(self.keithley, counter)],
+                                                                                 {counter: variables})[counter]
+
+        return voltage, current
+
+    def server_curr_volt_measurement(self, variables, counter):
+        # The whole sweep runs in the acquisition server, the points are read from the shared ring as they arrive
+        volt_0, volt_f, step, time_s, average_points, area, mode = variables
+        stop_args = None
+        if self.settings["early_stop"]:
+            voc_margin = float(self.settings["voc_margin"]) if "Light" in mode else None  # Dark curves cross at 0 V
+            stop_args = (area, step, voc_margin, float(self.settings["curr_lim"]) / area)
+        first_plot = [self.is_first_plot]
+        voltage, current = [], []
+
+        def show(samples):
+            voltage.extend(samples[:, 2].tolist())
+            current.extend((samples[:, 3] * 1000 / area).tolist())
+            self.engine.live_current.emit(current[-1], True)
+            self.engine.live_voltage.emit(voltage[-1], True)
+            self.engine.jv_curve.emit(list(voltage), list(current), mode, counter, first_plot[0])
+            first_plot[0] = False
+
+        samples = self.acquisition.sweep(np.arange(volt_0, volt_f, step), time_s, average_points, stop_args, show)
+        self.keithley.forget("SOUR:VOLT")  # Changed by the server behind the mirror
+
+        voltage = [float(v) for v in samples[:, 2]]
+        current = [float(c) * 1000 / area for c in samples[:, 3]]
+        self.curve_extras = {"Std Dev(mA/cm²)": [float(c) * 1000 / area for c in samples[:, 4]],
+                             "Settling time (s)": [time_s] * len(voltage), "Samples": [average_points] * len(voltage)}
+        self.engine.live_current.emit(0, False)
+        self.engine.live_voltage.emit(0, False)
+
+        return voltage, current
+
+    def stepped_curr_volt_measurement(self, channels, variables):
+        """
+        Sweep every (keithley, cell) channel in step, each with its own variables (by cell).
+
+        All channels share the settling wait of every point, so measuring with several Keithleys
+        takes about the time of a single sweep. Returns the voltage, current and extra columns by cell.
+        """
+        time_s, average_points = variables[channels[0][1]][3:5]
+        ave_curr = 0
+
+        keithley_average = self.settings["average_mode"] == "Keithley"
+        if keithley_average:
+            for keithley, _ in channels:
+                sweeps.set_measure_count(keithley, average_points)
+
+        early_stop = self.settings["early_stop"]
+        adaptive_settle = self.settings["settle_mode"] == "Adaptive"
+        drift_tol = float(self.settings["settle_tol"]) / 100
+
+        curves = {}
+        sweep_voltages = {}
+        for _, cn in channels:
+            volt_0, volt_f, step = variables[cn][:3]
+            voltage, current = [], []
+            curves[cn] = (voltage, current, {"Std Dev(mA/cm²)": [], "Settling time (s)": [], "Samples": []})
+            if self.settings["sweep_mode"] == "Adaptive grid":
+                sweep_voltages[cn] = sweeps.adaptive_voltages(volt_0, volt_f, step, voltage, current)
+            else:
+                sweep_voltages[cn] = iter(np.arange(volt_0, volt_f, step))
+        first_plot = {cn: self.is_first_plot for _, cn in channels}
+
+        def measure_points(points):
+            for keithley, _, v in points:
+                keithley.source_voltage = v
+            if adaptive_settle:  # Wait until the current stops drifting, time_s is the maximum
+                settled = sweeps.settle_currents([keithley for keithley, _, _ in points], time_s, drift_tol,
+                                                 floor=float(self.settings["curr_lim"]) / 1000 * sweeps.SETTLE_FLOOR,
+                                                 wait=self.pause, should_stop=lambda: not self.is_meas_live,
+                                                 clock=sessions.clock)
+            else:
+                self.pause(time_s) #Settling time
+                settled = [time_s] * len(points)
+
+            return settled, self.read_points_current([keithley for keithley, _, _ in points], average_points,
+                                                     [variables[cn][5] for _, cn, _ in points])
+
+        active = list(channels)
+        while active and self.is_meas_live:
+            points = []
+            for keithley, cn in active:
+                v = next(sweep_voltages[cn], None)
+                if v is not None:
+                    points.append((keithley, cn, v))
+            if not points:
+                break
+
+            # A lost Keithley pauses the sweep, and the whole point is measured again once it is back
+            measured = self.device_call("keithley", measure_points, points)
+            if measured is None:  # Stopped while waiting for it
+                break
+            settled, readings = measured
+
+            for (keithley, cn, v), settle, (ave_curr, std_curr, samples) in zip(points, settled, readings):
+                volt_0, volt_f, step, time_s, average_points, area, mode = variables[cn]
+                voltage, current, extras = curves[cn]
+
+                self.engine.live_current.emit(ave_curr, True)
+                self.engine.live_voltage.emit(v, True)
+                current.append(ave_curr)
+                voltage.append(float(v))
+                extras["Std Dev(mA/cm²)"].append(float(std_curr))
+                extras["Settling time (s)"].append(settle)
+                extras["Samples"].append(samples)
+
+                self.engine.jv_curve.emit(list(voltage), list(current), mode, cn, first_plot[cn])
+                first_plot[cn] = False
+
+                voc_margin = float(self.settings["voc_margin"]) if "Light" in mode else None  # Dark curves cross at 0 V
+                compliance = float(self.settings["curr_lim"]) / area  # mA/cm²
+                if early_stop and sweeps.is_sweep_done(voltage, current, step, voc_margin, compliance):
+                    active.remove((keithley, cn))
+
+        if keithley_average:
+            for keithley, _ in channels:
+                sweeps.set_measure_count(keithley, 1)
+
+        self.engine.live_current.emit(ave_curr, False)
+        self.engine.live_voltage.emit(0, False)
+
+        return curves
+
+    def read_points_current(self, keithleys, average_points, areas):
+        # Averaged current density of the present point of every Keithley, its standard deviation and readings
+        if self.settings["average_mode"] == "Keithley":  # All averaging points come back in a single query
+            results = [(mean_c, std_c, average_points)
+                       for mean_c, std_c in sweeps.bulk_read_currents(keithleys, average_points, self.pause,
+                                                                       self.stop_event.is_set)]
+        elif self.settings["average_mode"] == "Sequential":  # Stop reading once the point is precise enough
+            results = []
+            for keithley, area in zip(keithleys, areas):
+                target_error = float(self.settings["ave_target"]) * area / 1000  # Standard error of the mean, in A
+                results.append(sweeps.sequential_read_current(keithley, target_error, sweeps.SEQ_MIN_POINTS,
+                                                              average_points, self.stop_event.is_set))
+        else:
+            results = [(np.mean(meas_currents), sweeps.sample_std(meas_currents), average_points)
+                       for meas_currents in sweeps.read_currents(keithleys, average_points, self.stop_event.is_set)]
+
+        return [(mean_c * 1000 / area, std_c * 1000 / area, samples)
+                for (mean_c, std_c, samples), area in zip(results, areas)]
+
+    def buffered_curr_volt_measurement(self, variables, counter):
+        voltage, current, self.curve_extras = self.buffered_channels_measurement([(self.keithley, counter)],
+                                                                                 {counter: variables})[counter]
+
+        return voltage, current
+
+    def buffered_channels_measurement(self, channels, variables):
+        # Every channel runs its own buffered sweep, all of them at the same time
+        time_s, average_points, _, mode = variables[channels[0][1]][3:]
+        self.engine.status.emit("Running buffered " + mode + " sweep on the Keithley", 0)
+        self.engine.live_voltage.emit(variables[channels[0][1]][0], True)
+
+        voltage_lists = [sweeps.voltage_list(*variables[cn][:3]) for _, cn in channels]
+        # A lost Keithley pauses the measurement, and the sweep runs again once it is back
+        results = self.device_call("keithley", lambda: sweeps.parallel_buffered_sweep(
+            [keithley for keithley, _ in channels], voltage_lists, time_s, average_points, wait=self.pause,
+            should_stop=lambda: not self.is_meas_live)) or [([], [], [])] * len(channels)
+
+        curves = {}
+        for (_, cn), (source, meas_curr, std_curr) in zip(channels, results):
+            area = variables[cn][5]
+            voltage = [float(v) for v in source]
+            current = [float(c) * 1000 / area for c in meas_curr]
+            curves[cn] = (voltage, current, {"Std Dev(mA/cm²)": [float(c) * 1000 / area for c in std_curr]})
+            if voltage:
+                self.engine.jv_curve.emit(voltage, current, mode, cn, True)
+
+        self.engine.live_current.emit(0, False)
+        self.engine.live_voltage.emit(0, False)
+
+        return curves
+
+    def dual_curr_volt_measurement(self, first_vars, second_vars, counter):
+        # Both voltage lists run back to back as one instrument program, so there is no idle gap between them
+        volt_0, volt_f, step, time_s, average_points, area, mode = first_vars
+        first = sweeps.voltage_list(volt_0, volt_f, step)
+        second = sweeps.voltage_list(*second_vars[:3])
+        self.engine.status.emit("Running buffered dual " + mode + "/" + second_vars[-1] + " sweep on the Keithley", 0)
+
+        voltage, current, std_current = self.run_buffered_sweep(np.concatenate([first, second]), time_s,
+                                                                average_points, area)
+
+        curves = []
+        for part, part_mode in ((slice(0, len(first)), mode), (slice(len(first), None), second_vars[-1])):
+            curve = (voltage[part], current[part], {"Std Dev(mA/cm²)": std_current[part]})
+            if curve[0]:
+                self.engine.jv_curve.emit(curve[0], curve[1], part_mode, counter, True)
+            curves.append(curve)
+
+        return curves
+
+    def run_buffered_sweep(self, voltages, time_s, average_points, area):
+        self.engine.live_voltage.emit(voltages[0], True)
+
+        source, meas_curr, std_curr = self.device_call("keithley", lambda: sweeps.buffered_voltage_sweep(
+            self.keithley, voltages, time_s, average_points, wait=self.pause,
+            should_stop=lambda: not self.is_meas_live)) or ([], [], [])
+
+        voltage = [float(v) for v in source]
+        current = [float(c) * 1000 / area for c in meas_curr]
+        std_current = [float(c) * 1000 / area for c in std_curr]
+
+        self.engine.live_current.emit(0, False)
+        self.engine.live_voltage.emit(0, False)
+
+        return voltage, current, std_current
+
+    def measurement_job(self):
+        # Runs on the worker thread, see measurement_finished for what follows on the GUI
+        self.measurement_error = None
+        self.start_shutter(True)  # Every measurement starts with light soaking, the Keithleys are set meanwhile
+        try:
+            self.keithley_startup_setup()
+            for keithley in self.keithleys:
+                keithley.enable_source()
+            self.read_measurement_type() #This starts the measurement process
+        except Exception as error:  # A device that failed for good, the points measured so far are still saved
+            self.measurement_error = error
+            if isinstance(error, sessions.ReplayError):
+                self.engine.status.emit("Replay stopped, it differs from the recorded session: {}".format(error), 0)
+            else:
+                self.engine.status.emit("Measurement stopped by an error, {}: {}".format(type(error).__name__,
+                                                                                         error), 0)
+        finally:
+            self.safe_state()
+
+        if self.stop_event.is_set():  # Time from pressing STOP until the hardware is safe
+            self.stop_latency = (perf_counter() - self.stop_time) * 1000
+            print("Stopped by the user, hardware safe after {:.0f} ms".format(self.stop_latency))
+        else:
+            self.stop_latency = None
+
+    def safe_state(self):
+        # Shutter closed, 0 V and output off on every Keithley, and then all cells disconnected. Every step is
+        # tried and its errors reported here, nothing may escape (this runs in the finally of measurement_job)
+        self.start_shutter(False)
+        self.actions.start("smu", self.keithleys_safe_state)
+        if self.is_relay:
+            self.actions.start("relays", self.relays_off, after=("smu",))  # No switching under bias
+        for name in list(self.actions.threads):
+            try:
+                self.actions.wait(name)
+            except Exception as error:
+                print("{} could not be set to a safe state: {}".format(name.capitalize(), error))
+
+    def keithleys_safe_state(self):
+        for keithley in self.keithleys:
+            try:
+                keithley.source_voltage = 0
+                keithley.disable_source()
+            except:
+                print("Keithley could not be set to a safe state")
+        if self.is_tsp:  # Not in self.keithleys, it only understands TSP and may still run the MPP script
+            try:
+                sweeps.stop_tsp_mpp(self.keithley)
+            except:
+                print("Keithley could not be set to a safe state")
+
+    def relays_off(self):
+        for relay in self.relays:
+            try:
+                relay.off()
+            except Exception as error:  # The other relays are still switched off
+                print("Relay could not be switched off: {}".format(error))
@@ -0,0 +1,424 @@
+"""
+Recording and replay of instrument sessions (start main.py or batch.py with --record <file> or --replay <file>).
+
+While recording, every access to the Keithleys, relays, SuSi and temperature sensor (command, answer and how
+long it took) is written to a compact binary session file. Replaying opens the recorded instruments instead of
+the real ones: each access gets the recorded answer after the recorded time, divided by the speed given after
+the file (--replay session.jvs 10 replays ten times faster, 0 without waiting), and so do the waits of the
+program. The clock reads that decide how a measurement goes on (see clock) are recorded as well, so a replay at
+any speed measures the same points. A summary of a session file, with the time spent per device and command, is
+printed by: python sessions.py session.jvs
+"""
+__author__ = "Edgar R. Nandayapa"
+
+import sys
+import struct
+import atexit
+import numbers
+import threading
+from collections import deque, defaultdict
+from time import time, perf_counter, sleep
+
+MAGIC = b"JVSESSION2\n"
+OLD_MAGIC = b"JVSESSION1\n"  # Without keyword arguments
+# Records: a kind byte followed by
+NAME, OPEN, ACCESS = 0, 1, 2  # Name id and text / device, kind and port names / one access, see Recorder.log
+CALL, GET, SET = 0, 1, 2  # Kinds of access
+# Values: a type byte followed by
+NONE, FLOAT, INT, TEXT, NAMED, BYTES, FLOATS, ERROR, BOOL = range(9)
+SEARCH = 50  # Recorded accesses a replayed device may skip to find the one asked for
+REPEATED = ("temperature",)  # Devices that keep answering after the recording ended (with the last answer)
+CLOCK = "clock"  # Device name of the clock reads
+
+recorder = None
+player = None
+
+
+def record(path):
+    global recorder
+    recorder = Recorder(path)
+    atexit.register(recorder.close)
+
+
+def replay(path, speed=1.0):
+    global player
+    player = Player(path, speed)
+
+
+def from_arguments(argv):
+    # "--record <file>" or "--replay <file> [speed]"
+    if "--record" in argv:
+        record(argv[argv.index("--record") + 1])
+    if "--replay" in argv:
+        following = argv[argv.index("--replay") + 1:] + [""]
+        try:
+            speed = float(following[1])
+        except ValueError:
+            speed = 1.0
+        replay(following[0], speed)
+
+
+def clock():
+    """
+    Time (s) for the decisions of a measurement, e.g. when MPP tracking ends. It is part of a recorded session,
+    so a replay takes the same decisions whatever its speed.
+    """
+    if player:
+        return player.clock()
+    now = time()
+    if recorder:
+        recorder.log(CLOCK, GET, "time", (), {}, now, perf_counter(), 0.0)
+    return now
+
+
+def present_ports():
+    # Replayed ports never disappear
+    return set(player.ports_opened) if player else set()
+
+
+class ReplayError(RuntimeError):
+    # The replayed program did something else than the recorded one
+    pass
+
+
+class Recorder:
+    """
+    Writes the session file. Names (devices, commands and their text arguments) are stored once and then
+    referred to by number, numbers are stored as binary values.
+    """
+    def __init__(self, path):
+        self.file = open(path, "wb", buffering=1 << 20)
+        self.file.write(MAGIC)
+        self.start = perf_counter()
+        self.names = {}
+        self.lock = threading.Lock()
+
+    def name(self, text):
+        # Id of a name, written the first time it is used (lock held)
+        if text not in self.names:
+            self.names[text] = len(self.names)
+            data = text.encode()
+            self.file.write(struct.pack("<BIH", NAME, self.names[text], len(data)) + data)
+        return self.names[text]
+
+    def value(self, value, named=False):
+        if value is None:
+            return struct.pack("<B", NONE)
+        if isinstance(value, bool):
+            return struct.pack("<B?", BOOL, value)
+        if isinstance(value, numbers.Integral):
+            return struct.pack("<Bq", INT, int(value))
+        if isinstance(value, numbers.Real):
+            return struct.pack("<Bd", FLOAT, float(value))
+        if isinstance(value, str):
+            if named:  # Commands repeat, answers hardly
+                return struct.pack("<BI", NAMED, self.name(value))
+            data = value.encode()
+            return struct.pack("<BI", TEXT, len(data)) + data
+        if isinstance(value, (bytes, bytearray)):
+            return struct.pack("<BI", BYTES, len(value)) + bytes(value)
+        if isinstance(value, BaseException):
+            return struct.pack("<BI", ERROR, self.name("{}: {}".format(type(value).__name__, value)))
+        try:
+            values = [float(v) for v in value]
+            return struct.pack("<BI{}d".format(len(values)), FLOATS, len(values), *values)
+        except (TypeError, ValueError):
+            return struct.pack("<B", NONE)  # Not replayable, e.g. an object
+
+    def open(self, device, kind, port):
+        with self.lock:
+            self.file.write(struct.pack("<BIII", OPEN, self.name(device), self.name(kind), self.name(port)))
+
+    def log(self, device, access, attribute, arguments, keywords, result, start, duration):
+        with self.lock:
+            record = [struct.pack("<BdfIBIBB", ACCESS, start - self.start, duration, self.name(device), access,
+                                  self.name(attribute), len(arguments), len(keywords))]
+            record += [self.value(argument, named=True) for argument in arguments]
+            for keyword in sorted(keywords):
+                record += [struct.pack("<I", self.name(keyword)), self.value(keywords[keyword], named=True)]
+            record.append(self.value(result))
+            self.file.write(b"".join(record))
+
+    def wrap(self, kind, port, device):
+        # Relay cards are opened as a list of relays, every relay is a device
+        if isinstance(device, list):
+            return [self.wrap(kind, port + "#{}".format(n), relay) for n, relay in enumerate(device)]
+        name = kind + "@" + port
+        self.open(name, kind, port)
+        return RecordedDevice(self, name, device)
+
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.close()
+
+
+class RecordedDevice:
+    """
+    Passes everything on to the device and logs the calls (with their keyword arguments) and values that go
+    through.
+    """
+    def __init__(self, recorder, name, device):
+        object.__setattr__(self, "recorder", recorder)
+        object.__setattr__(self, "name", name)
+        object.__setattr__(self, "device", device)
+
+    def __getattr__(self, attribute):
+        start = perf_counter()
+        try:
+            value = getattr(self.device, attribute)
+        except Exception as error:
+            self.recorder.log(self.name, GET, attribute, (), {}, error, start, perf_counter() - start)
+            raise
+        if callable(value):
+            return lambda *arguments, **keywords: self.call(attribute, value, arguments, keywords)
+        if isinstance(value, (numbers.Number, str, bytes)) or value is None:
+            self.recorder.log(self.name, GET, attribute, (), {}, value, start, perf_counter() - start)
+        return value  # Other objects (the VISA adapter) are not recorded
+
+    def __setattr__(self, attribute, value):
+        start = perf_counter()
+        try:
+            setattr(self.device, attribute, value)
+        except Exception as error:
+            self.recorder.log(self.name, SET, attribute, (value,), {}, error, start, perf_counter() - start)
+            raise
+        self.recorder.log(self.name, SET, attribute, (value,), {}, None, start, perf_counter() - start)
+
+    def call(self, attribute, method, arguments, keywords):
+        start = perf_counter()
+        try:
+            result = method(*arguments, **keywords)
+        except Exception as error:
+            self.recorder.log(self.name, CALL, attribute, arguments, keywords, error, start, perf_counter() - start)
+            raise
+        self.recorder.log(self.name, CALL, attribute, arguments, keywords, result, start, perf_counter() - start)
+        return result
+
+
+def read_session(path):
+    """
+    Read a session file: returns the opened devices [(device, kind, port)] and the accesses
+    [(start s, duration s, device, access, attribute, arguments, result, keywords)] in the order they ended.
+    """
+    with open(path, "rb") as file:
+        data = file.read()
+    if not data.startswith((MAGIC, OLD_MAGIC)):
+        raise ValueError(path + " is not a session file")
+    has_keywords = data.startswith(MAGIC)
+
+    names = {}
+    opened = []
+    accesses = []
+    position = len(MAGIC)
+
+    def value():
+        nonlocal position
+        kind = data[position]
+        position += 1
+        if kind == NONE:
+            return None
+        if kind in (FLOAT, INT, BOOL):
+            form = {FLOAT: "<d", INT: "<q", BOOL: "<?"}[kind]
+            result = struct.unpack_from(form, data, position)[0]
+            position += struct.calcsize(form)
+            return result
+        size = struct.unpack_from("<I", data, position)[0]
+        position += 4
+        if kind in (NAMED, ERROR):
+            return names[size] if kind == NAMED else ReplayedError(names[size])
+        if kind == FLOATS:
+            result = list(struct.unpack_from("<{}d".format(size), data, position))
+            position += 8 * size
+            return result
+        result = data[position:position + size]
+        position += size
+        return result.decode() if kind == TEXT else result
+
+    try:
+        while position < len(data):
+            kind = data[position]
+            if kind == NAME:
+                number, size = struct.unpack_from("<IH", data, position + 1)
+                position += 7
+                names[number] = data[position:position + size].decode()
+                position += size
+            elif kind == OPEN:
+                opened.append(tuple(names[n] for n in struct.unpack_from("<III", data, position + 1)))
+                position += 13
+            else:
+                start, duration, device, access, attribute, count = struct.unpack_from("<dfIBIB", data, position + 1)
+                position += 23
+                keyword_count = 0
+                if has_keywords:
+                    keyword_count = data[position]
+                    position += 1
+                arguments = tuple(value() for _ in range(count))
+                keywords = {}
+                for _ in range(keyword_count):
+                    keyword = names[struct.unpack_from("<I", data, position)[0]]
+                    position += 4
+                    keywords[keyword] = value()
+                accesses.append((start, duration, names[device], access, names[attribute], arguments, value(),
+                                 keywords))
+    except (struct.error, IndexError, KeyError):  # Cut off, e.g. the program was killed while recording
+        pass
+
+    return opened, accesses
+
+
+class ReplayedError(OSError):
+    # An access that failed while recording fails again
+    pass
+
+
+class Player:
+    """
+    Answers the accesses of the program with those of a session file, device by device and in order.
+
+    A replayed device may skip a few recorded accesses (e.g. a status polled more often while recording), but
+    an access that cannot be found raises ReplayError: the program did not do what it did while recording.
+    """
+    def __init__(self, path, speed=1.0):
+        self.speed = speed
+        self.opened, accesses = read_session(path)
+        self.queues = defaultdict(deque)
+        self.methods = defaultdict(set)
+        for access in accesses:
+            self.queues[access[2]].append(access)
+            if access[3] == CALL:  # Per kind of device, e.g. all relays
+                self.methods[access[2].split("@")[0]].add(access[4])
+        self.last = {}
+        self.lock = threading.Lock()
+        self.ports_opened = [port.split("#")[0] for _, _, port in self.opened]
+
+    def ports(self):
+        # Port map (as discovery.discover returns it) of the recorded instruments
+        found = {"keithley": [], "relays": None, "susi": None, "temperature": None}
+        for _, kind, port in self.opened:
+            port = port.split("#")[0]
+            if kind == "keithley":
+                if port not in found["keithley"]:
+                    found["keithley"].append(port)
+            else:
+                found[kind] = port
+        return found
+
+    def open_device(self, kind, port):
+        name = kind + "@" + port
+        relays = {recorded for recorded, _, _ in self.opened if recorded.startswith(name + "#")}
+        if relays:  # Relay card, as a list of relays
+            return [ReplayedDevice(self, relay) for relay in sorted(relays, key=lambda r: int(r.split("#")[1]))]
+        if not any(recorded == name for recorded, _, _ in self.opened):
+            raise IOError(name + " is not in the recorded session")
+        return ReplayedDevice(self, name)
+
+    def take(self, device, access, attribute, arguments, keywords=None):
+        # Next recorded access of the device that matches, after its recorded duration
+        keywords = keywords or {}
+        with self.lock:
+            queue = self.queues[device]
+            for n, recorded in enumerate(list(queue)[:SEARCH]):
+                if recorded[3] == access and recorded[4] == attribute and (access == GET or (
+                        same(recorded[5], arguments) and same_keywords(recorded[7], keywords))):
+                    for _ in range(n + 1):
+                        queue.popleft()
+                    break
+            else:
+                if not queue and device.split("@")[0] in REPEATED and (device, attribute) in self.last:
+                    recorded = self.last[device, attribute]
+                elif not queue:
+                    raise ReplayError("{}: the recorded session ended".format(device))
+                else:
+                    keyword_arguments = tuple("{}={!r}".format(*item) for item in sorted(keywords.items()))
+                    raise ReplayError("{}: {} {} is not the next recorded access".format(
+                        device, attribute, arguments + keyword_arguments))
+            self.last[device, attribute] = recorded
+
+        sleep(self.scaled(recorded[1]))
+        if isinstance(recorded[6], ReplayedError):
+            raise ReplayedError(str(recorded[6]))
+        return recorded[6]
+
+    def scaled(self, seconds):
+        # Recorded durations and waits of the program, at the speed of the replay
+        return seconds / self.speed if self.speed > 0 else 0
+
+    def clock(self):
+        if CLOCK not in self.queues:  # Recorded without clock reads
+            return time()
+        return self.take(CLOCK, GET, "time", ())
+
+
+def same(recorded, arguments):
+    if len(recorded) != len(arguments):
+        return False
+    for old, new in zip(recorded, arguments):
+        if isinstance(old, float) and isinstance(new, numbers.Real):
+            if abs(old - float(new)) > 1e-12 * max(abs(old), 1):
+                return False
+        elif old != (bytes(new) if isinstance(new, bytearray) else new):
+            return False
+    return True
+
+
+def same_keywords(recorded, keywords):
+    names = sorted(keywords)
+    return sorted(recorded) == names and same([recorded[name] for name in names], [keywords[name] for name in names])
+
+
+class ReplayedAdapter:
+    # VISA adapter and connection of a replayed Keithley, not part of the session
+    def __init__(self):
+        self.connection = self
+        self.timeout = 2000
+
+    def clear(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ReplayedDevice:
+    """
+    Stands in for a recorded device: methods, properties and settings are answered by the player.
+    """
+    def __init__(self, player, name):
+        object.__setattr__(self, "player", player)
+        object.__setattr__(self, "name", name)
+        object.__setattr__(self, "adapter", ReplayedAdapter())
+
+    def __getattr__(self, attribute):
+        if attribute.startswith("__"):
+            raise AttributeError(attribute)
+        if attribute in self.player.methods[self.name.split("@")[0]]:
+            return lambda *arguments, **keywords: self.player.take(self.name, CALL, attribute, arguments, keywords)
+        return self.player.take(self.name, GET, attribute, ())
+
+    def __setattr__(self, attribute, value):
+        self.player.take(self.name, SET, attribute, (value,))
+
+
+def summary(path):
+    """
+    Time spent per device and command in a session file.
+    """
+    opened, accesses = read_session(path)
+    total = defaultdict(float)
+    count = defaultdict(int)
+    for start, duration, device, access, attribute, arguments, result, keywords in accesses:
+        command = attribute
+        if attribute in ("write", "ask", "values") and arguments and isinstance(arguments[0], str):
+            command += " " + arguments[0].split(" ")[0]  # SCPI header
+        total[device, command] += duration
+        count[device, command] += 1
+
+    length = accesses[-1][0] + accesses[-1][1] if accesses else 0
+    print("{}: {} devices, {} accesses in {:.1f} s".format(path, len(opened), len(accesses), length))
+    for (device, command), seconds in sorted(total.items(), key=lambda item: -item[1]):
+        print("  {:<36}{:<28}{:8d}{:10.3f} s".format(device, command, count[device, command], seconds))
+
+
+if __name__ == "__main__":
+    summary(sys.argv[1])
@@ -0,0 +1,564 @@
+"""
+Simulated instruments, to run the program without the setup (start main.py or batch.py with --simulate).
+
+Every simulated setup ("bench") has a Keithley 2450 (SCPI command set) measuring solar cells described by the
+single-diode model of Test/fit_test.py, a K8090 relay card that connects the cells, a SuSi lamp that lights them
+and an Arduino temperature sensor. The instruments take the time of the real ones: a latency per command, the
+integration time of every reading and the moving shutter. Their ports look like "SIM::<bench>::<device>", so
+they can also be given in a stations file. The simulation can be tuned with a JSON file, e.g.:
+
+    python main.py --simulate simulation.json
+
+    {"keithley": {"latency": 0.005, "noise": 1e-6, "hysteresis": 0.1},
+     "cells": [{"jsc": 22, "voc": 1.12, "rs": 2, "rsh": 3000}, {"jsc": 18, "voc": 1.05}],
+     "devices": ["keithley", "relays"]}
+
+See CONFIG for every parameter. Instruments of a bench that are "unplugged" (see unplug) fail like a device
+that dropped off USB, and their port is missing from present_ports until they are plugged again.
+"""
+__author__ = "Edgar R. Nandayapa"
+
+import json
+import zlib
+import threading
+from time import perf_counter, sleep
+import numpy as np
+
+PREFIX = "SIM::"
+BOLTZMANN = 8.6173e-5  # eV/K
+CELL = {"jsc": 22.0,  # mA/cm² at 1 sun
+        "voc": 1.10,  # V at 1 sun
+        "n": 1.5,  # Ideality factor
+        "rs": 3.0,  # Ωcm²
+        "rsh": 2000.0,  # Ωcm²
+        "area": 0.16}  # cm²
+CONFIG = {
+    "devices": ["keithley", "relays", "susi", "temperature"],  # Instruments found on every bench
+    "keithleys": 1,  # Further Keithleys measure one cell each (cell b, c...), without relays
+    "keithley": {"latency": 0.002,  # s per command
+                 "noise": 2e-7,  # A, standard deviation of a reading at 1 NPLC (it falls with sqrt(NPLC))
+                 "hysteresis": 0.05,  # Fraction of the lag of the ions added to the junction voltage
+                 "hysteresis_time": 2.0,  # s, time constant of the ion lag
+                 "line_frequency": 50},
+    "cells": [CELL],  # Cells a to f, missing values are taken from CELL and missing cells from the last one
+    "cell_spread": 0.02,  # Relative spread of jsc and voc between the cells
+    "relays": {"latency": 0.01},
+    "susi": {"latency": 0.005, "shutter_time": 0.3, "one_sun": 90.5},  # one_sun: intensity (%) giving 1 sun
+    "temperature": {"start": 24.0, "heating": 4.0, "heating_time": 60.0, "noise": 0.03},
+    "temperature_kelvin": 300.0,
+}
+CELLS = 6  # Cells a to f
+benches = {}  # Bench name: Bench
+benches_lock = threading.Lock()
+
+
+def configure(path):
+    # Parameters of the simulation file replace those of CONFIG (per section), for benches created afterwards
+    with open(path) as file:
+        config = json.load(file)
+    for name, value in config.items():
+        if name not in CONFIG:
+            raise ValueError("Unknown simulation parameter: " + name)
+        if isinstance(CONFIG[name], dict):
+            CONFIG[name] = dict(CONFIG[name], **value)
+        else:
+            CONFIG[name] = value
+
+
+def from_arguments(argv):
+    # "--simulate" can be followed by a simulation file
+    following = argv[argv.index("--simulate") + 1:]
+    if following and following[0].endswith(".json"):
+        configure(following[0])
+
+
+def is_simulated(port):
+    return isinstance(port, str) and port.startswith(PREFIX)
+
+
+def ports(bench="1"):
+    """
+    Port map (as discovery.discover returns it) of a simulated bench.
+    """
+    devices = CONFIG["devices"]
+    port = PREFIX + bench + "::"
+    keithleys = [port + "KEITHLEY{}".format(n + 1) for n in range(CONFIG["keithleys"] if "keithley" in devices else 0)]
+    return {"keithley": keithleys, "relays": port + "RELAYS" if "relays" in devices else None,
+            "susi": port + "SUSI" if "susi" in devices else None,
+            "temperature": port + "TEMPERATURE" if "temperature" in devices else None}
+
+
+def get_bench(port):
+    name = port[len(PREFIX):].split("::")[0]
+    with benches_lock:
+        if name not in benches:
+            benches[name] = Bench(name)
+        return benches[name]
+
+
+def open_device(name, port):
+    """
+    Simulated counterpart of the instruments.open_* functions.
+    """
+    bench = get_bench(port)
+    device = port.split("::")[-1]
+    bench.check(device)
+    if name == "keithley":
+        return SimulatedKeithley(bench, device, int(device[len("KEITHLEY"):]) - 1)
+    if name == "relays":
+        bench.relay_card = SimulatedRelayCard(bench)
+        return bench.relay_card.relays
+    if name == "susi":
+        bench.susi = SimulatedSusi(bench)
+        return bench.susi
+    if name == "temperature":
+        return SimulatedTemperatureSensor(bench)
+    raise ValueError("No simulation for " + name)
+
+
+def present_ports():
+    # Ports of the plugged simulated instruments, as the watcher of the connections lists them
+    present = set()
+    with benches_lock:
+        for bench in benches.values():
+            bench_ports = ports(bench.name)
+            for port in bench_ports["keithley"] + [bench_ports[name] for name in ("relays", "susi", "temperature")]:
+                if port and port.split("::")[-1] not in bench.unplugged:
+                    present.add(port)
+    return present
+
+
+def unplug(port):
+    get_bench(port).unplugged.add(port.split("::")[-1])
+
+
+def plug(port):
+    get_bench(port).unplugged.discard(port.split("::")[-1])
+
+
+class DiodeCell:
+    """
+    Solar cell of the single-diode model: I = I0 (exp((V - I Rs) / (n kT)) - 1) + (V - I Rs) / Rsh - Iph
+
+    I is the current into the cell (A), as the Keithley measures it, so the photocurrent is negative.
+    """
+    def __init__(self, jsc, voc, n, rs, rsh, area, temperature):
+        self.area = area
+        self.jsc = jsc / 1000 * area  # A at 1 sun
+        self.thermal = n * BOLTZMANN * temperature
+        self.i0 = self.jsc / (np.exp(voc / self.thermal) - 1)
+        self.rs = rs / area
+        self.rsh = rsh / area
+
+    def current(self, voltage, suns):
+        # Newton steps on the implicit equation, for every voltage at once
+        voltage = np.asarray(voltage, dtype=float)
+        photo = self.jsc * suns
+        current = np.clip(self.i0 * (np.exp(np.minimum(voltage / self.thermal, 60)) - 1) + voltage / self.rsh - photo,
+                          -1, 1)
+        for _ in range(50):
+            junction = voltage - current * self.rs
+            exp = np.exp(np.minimum(junction / self.thermal, 60))
+            error = self.i0 * (exp - 1) + junction / self.rsh - photo - current
+            slope = -self.rs * (self.i0 * exp / self.thermal + 1 / self.rsh) - 1
+            current = current - error / slope
+            if np.all(np.abs(error) < 1e-12):
+                break
+        return current
+
+
+class Bench:
+    """
+    State shared by the simulated instruments of one setup: cells, light, temperature and connections.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.unplugged = set()
+        self.relay_card = None
+        self.susi = None
+        self.start = perf_counter()
+        self.temperature = CONFIG["temperature"]["start"]
+        self.temperature_time = self.start
+
+        rng = np.random.default_rng(zlib.crc32(name.encode()))  # Same cells every time for a bench
+        given = CONFIG["cells"]
+        spread = CONFIG["cell_spread"]
+        self.cells = []
+        for n in range(CELLS):
+            cell = dict(CELL, **given[min(n, len(given) - 1)])
+            self.cells.append(DiodeCell(cell["jsc"] * (1 + rng.normal(0, spread)),
+                                        cell["voc"] * (1 + rng.normal(0, spread / 4)), cell["n"], cell["rs"],
+                                        cell["rsh"], cell["area"], CONFIG["temperature_kelvin"]))
+
+    def check(self, device):
+        if device in self.unplugged:
+            raise OSError("Simulated " + device + " is unplugged")
+
+    def suns(self):
+        if "susi" not in CONFIG["devices"]:  # Lamp without remote control, always on
+            return 1.0
+        if self.susi is None:
+            return 0.0
+        return self.susi.light()
+
+    def connected_cells(self, keithley):
+        # The first Keithley measures the cells switched on by the relay card, or cell a without relay card
+        if keithley > 0:
+            return [self.cells[keithley % CELLS]]
+        if "relays" not in CONFIG["devices"]:
+            return [self.cells[0]]
+        if self.relay_card is None:
+            return []
+        return [cell for cell, relay in zip(self.cells, self.relay_card.relays) if relay.is_on]
+
+    def current(self, voltage, keithley):
+        suns = self.suns()
+        current = np.asarray(voltage, dtype=float) / 1e12  # Open circuit
+        for cell in self.connected_cells(keithley):
+            current = current + cell.current(voltage, suns)
+        return current
+
+    def read_temperature(self):
+        # Warms up under the lamp and cools down without it
+        settings = CONFIG["temperature"]
+        now = perf_counter()
+        target = settings["start"] + settings["heating"] * self.suns()
+        self.temperature += (target - self.temperature) * (1 - np.exp(-(now - self.temperature_time) /
+                                                                      settings["heating_time"]))
+        self.temperature_time = now
+        return self.temperature + np.random.normal(0, settings["noise"])
+
+
+class SimulatedAdapter:
+    # Stands in for the pymeasure adapter and its pyvisa connection
+    def __init__(self):
+        self.connection = self
+        self.timeout = 2000
+
+    def clear(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SimulatedKeithley:
+    """
+    Keithley 2450 with the pymeasure properties and the SCPI subset of sweeps.py.
+
+    Readings take their integration time (doubled with auto zero on) and list sweeps run on a simulated
+    trigger model, so the program waits as long as with the real instrument. The hysteresis comes from the ions
+    of the cell lagging behind the applied voltage.
+    """
+    def __init__(self, bench, device, index):
+        self.bench = bench
+        self.device = device
+        self.index = index
+        self.settings = CONFIG["keithley"]
+        self.adapter = SimulatedAdapter()
+        self.output = False
+        self.voltage = 0.0
+        self.ion_voltage = 0.0
+        self.ion_time = perf_counter()
+        self.count = 1
+        self.nplc = 1.0
+        self.auto_zero = True
+        self.wires = 2
+        self.source_mode = "voltage"
+        self.source_voltage_range = 20
+        self.compliance_current = 0.105
+        self.range = None  # Auto range
+        self.voltages = []
+        self.buffer = []  # (Time available, source voltage, reading)
+        self.trigger_end = 0.0
+        self.pending = None  # (Time available, reading) of :READ?
+
+    # Properties of pymeasure
+    @property
+    def source_voltage(self):
+        return self.voltage
+
+    @source_voltage.setter
+    def source_voltage(self, voltage):
+        self.command()
+        self.ion_lag(perf_counter())
+        self.voltage = float(voltage)
+
+    @property
+    def current_nplc(self):
+        return self.nplc
+
+    @current_nplc.setter
+    def current_nplc(self, nplc):
+        self.command()
+        self.nplc = float(nplc)
+
+    @property
+    def current_range(self):
+        return self.range
+
+    @current_range.setter
+    def current_range(self, current_range):
+        self.command()
+        self.range = float(current_range)
+
+    @property
+    def current(self):
+        self.command()
+        sleep(self.reading_time())
+        now = perf_counter()
+        self.ion_lag(now)
+        return float(self.readings([self.voltage])[0])
+
+    # Model
+    def command(self):
+        self.bench.check(self.device)
+        sleep(self.settings["latency"])
+
+    def reading_time(self):
+        return self.nplc / self.settings["line_frequency"] * (2 if self.auto_zero else 1)
+
+    def ion_lag(self, now):
+        lag = np.exp(-(now - self.ion_time) / self.settings["hysteresis_time"])
+        self.ion_voltage = self.voltage + (self.ion_voltage - self.voltage) * lag
+        self.ion_time = now
+
+    def readings(self, voltages):
+        # Currents at the given voltages, starting from the present ion state
+        voltages = np.asarray(voltages, dtype=float)
+        if not self.output:
+            currents = np.zeros(voltages.shape)
+        else:
+            junction = voltages + self.settings["hysteresis"] * (voltages - self.ion_voltage)
+            currents = self.bench.current(junction, self.index)
+        noise = self.settings["noise"] / np.sqrt(self.nplc)
+        currents = currents + np.random.normal(0, noise, currents.shape)
+        limit = self.compliance_current if self.range is None else min(self.compliance_current, self.range * 1.05)
+        return np.clip(currents, -limit, limit)
+
+    # SCPI
+    def write(self, command):
+        self.command()
+        for part in command.split(";"):
+            self.execute(part.strip())
+
+    def execute(self, command):
+        header, _, value = command.partition(" ")
+        header = header.upper().lstrip(":")
+        now = perf_counter()
+        if header == "SENS:COUN":
+            self.count = int(value)
+        elif header == "SENS:CURR:NPLC":
+            self.nplc = float(value)
+        elif header == "SENS:CURR:AZER":
+            self.auto_zero = value.strip().upper() in ("ON", "1")
+        elif header == "SENS:CURR:RANG:AUTO":
+            self.range = None
+        elif header == "SENS:CURR:RSEN":
+            self.wires = 4 if value.strip().upper() in ("ON", "1") else 2
+        elif header == "OUTPUT":
+            self.ion_lag(now)
+            self.output = value.strip().upper() in ("ON", "1")
+        elif header == "SOUR:LIST:VOLT":
+            self.voltages = [float(v) for v in value.split(",")]
+        elif header == "SOUR:LIST:VOLT:APP":
+            self.voltages += [float(v) for v in value.split(",")]
+        elif header == "SOUR:SWE:VOLT:LIST":
+            self.sweep_delay = float(value.split(",")[1])
+        elif header == "INIT":
+            self.start_sweep(now)
+        elif header == "ABOR":
+            self.trigger_end = min(self.trigger_end, now)
+            self.buffer = [reading for reading in self.buffer if reading[0] <= now]
+        elif header == "TRAC:CLE":
+            self.buffer = []
+        elif header == "TRAC:TRIG":  # Readings at the present voltage, available once integrated
+            self.ion_lag(now)
+            step = self.reading_time()
+            currents = self.readings([self.voltage] * self.count)
+            self.buffer += [(now + step * (n + 1), self.voltage, current) for n, current in enumerate(currents)]
+        elif header == "READ?":
+            self.ion_lag(now)
+            self.pending = now + self.reading_time(), float(self.readings([self.voltage])[0])
+
+    def start_sweep(self, now):
+        # The whole list is computed now, each reading becomes available at the time it is taken
+        self.ion_lag(now)
+        step = getattr(self, "sweep_delay", 0) + self.count * self.reading_time()
+        times, voltages, currents = [], [], []
+        ion = self.ion_voltage
+        for n, voltage in enumerate(self.voltages):
+            ion = voltage + (ion - voltage) * np.exp(-step / self.settings["hysteresis_time"])
+            self.ion_voltage = ion
+            self.voltage = voltage
+            point = self.readings([voltage] * self.count)
+            for m, current in enumerate(point):
+                times.append(now + step * n + getattr(self, "sweep_delay", 0) + (m + 1) * self.reading_time())
+                voltages.append(voltage)
+                currents.append(current)
+        self.buffer = list(zip(times, voltages, currents))
+        self.trigger_end = now + step * len(self.voltages)
+        self.ion_time = self.trigger_end
+
+    def available(self):
+        now = perf_counter()
+        return [reading for reading in self.buffer if reading[0] <= now]
+
+    def ask(self, command):
+        self.command()
+        header = command.strip().split(" ")[0].upper().lstrip(":")
+        if header == "*IDN?":
+            return "KEITHLEY INSTRUMENTS,MODEL 2450,SIM{},1.0".format(self.index + 1)
+        if header == "*LANG?":
+            return "SCPI"
+        if header == "SENS:COUN?":
+            return str(self.count)
+        if header == "SYST:LFR?":
+            return str(self.settings["line_frequency"])
+        if header == "TRIG:STAT?":
+            return "RUNNING;" if perf_counter() < self.trigger_end else "IDLE;"
+        if header == "TRAC:ACT?":
+            return str(len(self.available()))
+        return "0"
+
+    def values(self, command):
+        self.command()
+        if command.upper().startswith(":TRAC:DATA?"):
+            fields = [field.strip().upper() for field in command.split("?", 1)[1].split(",")]
+            start, end = int(fields[0]), int(fields[1])
+            if self.buffer:  # Waits for the readings still being taken, as *WAI does
+                sleep(max(0, self.buffer[min(end, len(self.buffer)) - 1][0] - perf_counter()))
+            data = []
+            for _, voltage, current in self.buffer[start - 1:end]:
+                data += [voltage, current] if "SOUR" in fields else [current]
+            return data
+        return [float(self.ask(command))]
+
+    def read(self):
+        self.bench.check(self.device)
+        if self.pending is None:
+            raise OSError("Simulated Keithley: nothing to read")
+        ready, current = self.pending
+        self.pending = None
+        sleep(max(0, ready - perf_counter()))
+        return "{:.6e}".format(current)
+
+
+class SimulatedRelay:
+    def __init__(self, card, number):
+        self.card = card
+        self.number = number
+        self.is_on = False
+
+    def on(self):
+        self.card.switch(self, True)
+
+    def off(self):
+        self.card.switch(self, False)
+
+
+class SimulatedRelayCard:
+    """
+    K8090 card with 8 relays, opened with all of them off. The state byte is kept as the card reports it.
+    """
+    def __init__(self, bench):
+        self.bench = bench
+        self.relays = [SimulatedRelay(self, n) for n in range(8)]
+        self.switched = 0  # Switching operations, to follow the wear of the relays
+
+    def switch(self, relay, on):
+        self.bench.check("RELAYS")
+        sleep(CONFIG["relays"]["latency"])
+        if relay.is_on != on:
+            self.switched += 1
+        relay.is_on = on
+
+    @property
+    def state(self):
+        return sum(1 << relay.number for relay in self.relays if relay.is_on)
+
+
+class SimulatedSerial:
+    # What the program uses of serial.Serial
+    def __init__(self, bench, device):
+        self.bench = bench
+        self.device = device
+        self.output = b""
+        self.is_open = True
+        self.timeout = 1
+
+    def check(self):
+        if not self.is_open:
+            raise OSError("Simulated " + self.device + " is closed")
+        self.bench.check(self.device)
+
+    def read_until(self, expected=b"\n", size=None):
+        self.check()
+        end = self.output.find(expected)
+        end = len(self.output) if end < 0 else end + len(expected)
+        answer, self.output = self.output[:end], self.output[end:]
+        return answer
+
+    def readline(self):
+        return self.read_until(b"\n")
+
+    def close(self):
+        self.is_open = False
+
+
+class SimulatedSusi(SimulatedSerial):
+    """
+    SuSi lamp: C1/C0 cooling, L1/L0 lamp, S0/S1 shutter open/closed, P=xxxx intensity (per mille), FS status.
+    """
+    def __init__(self, bench):
+        super(SimulatedSusi, self).__init__(bench, "SUSI")
+        self.cooling = False
+        self.lamp = False
+        self.shutter_open = False
+        self.shutter_time = 0.0  # When the shutter finished its last move
+        self.power = 905
+
+    def write(self, message):
+        self.check()
+        sleep(CONFIG["susi"]["latency"])
+        message = bytes(message).strip()
+        if message in (b"C0", b"C1"):
+            self.cooling = message == b"C1"
+        elif message in (b"L0", b"L1"):
+            self.lamp = message == b"L1"
+        elif message in (b"S0", b"S1"):
+            if self.shutter_open != (message == b"S0"):
+                self.shutter_time = perf_counter() + CONFIG["susi"]["shutter_time"]
+            self.shutter_open = message == b"S0"
+        elif message.startswith(b"P="):
+            self.power = int(message[2:])
+        elif message == b"FS":
+            self.output += "LAMP={:d}\r\nSHUTTER={:d}\r\nPOWER={:04d}\r\nCOOLING={:d}\r\nEND\r\n".format(
+                self.lamp, not self.shutter_open, self.power, self.cooling).encode()
+        return len(message)
+
+    def light(self):
+        # Suns on the cells, the shutter lets the light in gradually while it moves
+        if not self.lamp:
+            return 0.0
+        moving = min(max((self.shutter_time - perf_counter()) / max(CONFIG["susi"]["shutter_time"], 1e-9), 0), 1)
+        opened = 1 - moving if self.shutter_open else moving
+        return opened * self.power / 10 / CONFIG["susi"]["one_sun"]
+
+
+class SimulatedTemperatureSensor(SimulatedSerial):
+    """
+    Arduino that prints the temperature every second, read line by line (old lines wait in the buffer).
+    """
+    def __init__(self, bench):
+        super(SimulatedTemperatureSensor, self).__init__(bench, "TEMPERATURE")
+        self.opened = perf_counter()
+        self.lines_read = 0
+
+    def readline(self):
+        self.check()
+        printed = int(perf_counter() - self.opened)
+        if self.lines_read >= printed:  # Wait for the next line
+            sleep(self.opened + self.lines_read + 1 - perf_counter())
+        self.lines_read += 1
+        return "{:.2f}\r\n".format(self.bench.read_temperature()).encode()
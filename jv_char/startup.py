@@ -0,0 +1,97 @@
+"""
+Start-up time report of the JV characteristics program.
+
+main.py times its own imports (per top-level package) and every phase of the window initialization. The
+report is printed once the instruments are connected: a summary line, or the whole breakdown when the window
+took longer than WINDOW_LIMIT to appear (or main.py was started with --startup-report). With --startup-check
+the program quits once the report is printed, with exit code 1 when the window took longer than WINDOW_LIMIT, so
+start-up regressions can be caught by a script (e.g. python main.py --simulate --startup-check).
+"""
+__author__ = "Edgar R. Nandayapa"
+
+import sys
+import builtins
+from time import perf_counter
+
+WINDOW_LIMIT = 2.0  # s, from the first import until the window is shown
+SHOWN_LIMIT = 0.005  # s, shorter imports are left out of the report
+
+START = perf_counter()
+imports = {}  # Top-level package: s
+phases = []  # (Phase, s), in order
+last_lap = START
+reported = False
+_import = builtins.__import__
+depth = 0
+
+
+def timed_import(name, *args, **kwargs):
+    # Imports made by another import are counted in the outer one
+    global depth
+    if depth:
+        return _import(name, *args, **kwargs)
+    depth += 1
+    start = perf_counter()
+    try:
+        return _import(name, *args, **kwargs)
+    finally:
+        depth -= 1
+        package = name.split(".")[0] or "(relative)"
+        imports[package] = imports.get(package, 0) + perf_counter() - start
+
+
+def time_imports():
+    builtins.__import__ = timed_import
+
+
+def end_imports():
+    builtins.__import__ = _import
+    lap("Imports")
+
+
+def lap(phase):
+    # Time since the previous lap
+    global last_lap
+    now = perf_counter()
+    phases.append((phase, now - last_lap))
+    last_lap = now
+
+
+def elapsed(phase):
+    # Time from the start until the end of a phase
+    total = 0
+    for name, seconds in phases:
+        total += seconds
+        if name == phase:
+            return total
+    return None
+
+
+def report(window_phase="Window shown"):
+    # Only once, the first window to be ready reports when several stations start
+    global reported
+    if reported:
+        return None
+    reported = True
+    window_time = elapsed(window_phase)
+    total = perf_counter() - START
+    slow = window_time is not None and window_time > WINDOW_LIMIT
+
+    print("Start-up: window after {:.2f} s, ready after {:.2f} s".format(window_time or 0, total))
+    if slow:
+        print("Start-up is slower than the {:.1f} s limit of the window".format(WINDOW_LIMIT))
+    if slow or "--startup-report" in sys.argv:
+        print("  Imports:")
+        for package, seconds in sorted(imports.items(), key=lambda item: -item[1]):
+            if seconds >= SHOWN_LIMIT:
+                print("    {:<24}{:8.3f} s".format(package, seconds))
+        print("  Phases:")
+        for phase, seconds in phases:
+            print("    {:<24}{:8.3f} s".format(phase, seconds))
+
+    return window_time, total
+
+
+def exit_code(window_time):
+    # Result of --startup-check: 0 within WINDOW_LIMIT, otherwise 1 (also when the window time is unknown)
+    return 0 if window_time is not None and window_time <= WINDOW_LIMIT else 1
@@ -0,0 +1,98 @@
+"""
+Several measurement stations from one program (start main.py with --stations <file>).
+
+Every station is a window of its own, with its instruments, measurement thread and plots. The stations file
+gives the ports of each station, e.g.:
+
+    {"Station 1": {"keithley": ["USB0::0x05E6::0x2450::04401234::INSTR"], "relays": "COM3", "susi": "COM4",
+                   "temperature": "COM5"},
+     "Station 2": {"keithley": ["USB0::0x05E6::0x2450::04405678::INSTR"], "relays": null, "susi": "COM7",
+                   "temperature": null}}
+"""
+__author__ = "Edgar R. Nandayapa"
+
+import json
+from PyQt5.QtWidgets import QWidget, QVBoxLayout, QTableWidget, QTableWidgetItem, QHeaderView
+from PyQt5.QtCore import QTimer
+
+DEVICES = ["keithley", "relays", "susi", "temperature"]
+DATA_FOLDER = "C:/Data/"  # Shared by all stations, each one saves into its own subfolder
+REFRESH_MS = 500
+
+
+def load_stations(path):
+    """
+    Read the stations file: station name and port map (as discovery.discover returns it) of every station.
+    """
+    with open(path) as file:
+        stations = json.load(file)
+
+    for name, ports in stations.items():
+        unknown = set(ports) - set(DEVICES)
+        if unknown:
+            raise ValueError("Unknown devices for " + name + ": " + ", ".join(sorted(unknown)))
+        keithleys = ports.get("keithley") or []
+        stations[name] = {"keithley": [keithleys] if isinstance(keithleys, str) else list(keithleys),
+                          "relays": ports.get("relays"), "susi": ports.get("susi"),
+                          "temperature": ports.get("temperature")}
+
+    return stations
+
+
+class StationOverview(QWidget):
+    """
+    Combined status of all stations: instruments found, running measurement and last status message.
+    """
+    COLUMNS = ["Station", "Instruments", "Measurement", "Status"]
+
+    def __init__(self, windows):
+        super(StationOverview, self).__init__()
+        self.setWindowTitle("JV Characteristics - Stations")
+        self.windows = windows
+
+        self.table = QTableWidget(len(windows), len(self.COLUMNS))
+        self.table.setHorizontalHeaderLabels(self.COLUMNS)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+        self.table.horizontalHeader().setStretchLastSection(True)
+        self.table.verticalHeader().setVisible(False)
+        self.table.setMinimumWidth(700)
+        layout = QVBoxLayout()
+        layout.addWidget(self.table)
+        self.setLayout(layout)
+
+        for row, window in enumerate(windows):
+            self.set_cell(row, 0, window.station)
+            window.statusBar().messageChanged.connect(lambda text, row=row: text and self.set_cell(row, 3, text))
+        self.refresh()
+
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(REFRESH_MS)
+        self.show()
+
+    def set_cell(self, row, column, text):
+        self.table.setItem(row, column, QTableWidgetItem(text))
+
+    def refresh(self):
+        for row, window in enumerate(self.windows):
+            self.set_cell(row, 1, self.instruments(window))
+            self.set_cell(row, 2, self.measurement(window))
+
+    def instruments(self, window):
+        if window.is_connecting:
+            return "Connecting..."
+        found = {"Keithley": window.keithley is not None, "relays": window.is_relay, "SuSi": window.is_susi,
+                 "temperature": window.is_temperature_sensor}
+        lost = window.watcher.lost if window.watcher else {}
+        names = [name + (" (lost)" if device in lost else "")
+                 for (name, ok), device in zip(found.items(), DEVICES) if ok]
+        return ", ".join(names) or "None found"
+
+    def measurement(self, window):
+        if not window.engine.isRunning():
+            return "Idle"
+        if window.is_recipe:
+            return "Recipe"
+        if window.is_mpp_measurement:
+            return "MPP"
+        return "JV"
@@ -0,0 +1,490 @@
+"""
+Instrument-side acquisition routines for the Keithley 2450.
+
+These functions talk SCPI directly through the pymeasure instrument (write/ask/values),
+so that a full voltage sweep can be programmed into the source-measure unit and
+collected with a single buffer transfer instead of one query per point.
+"""
+__author__ = "Edgar R. Nandayapa"
+
+import numpy as np
+from time import perf_counter
+
+BUFFER = '"defbuffer1"'
+LIST_CHUNK = 100  # Maximum number of values sent per :SOUR:LIST command
+GRID_COARSE = 5  # Largest adaptive step, as a multiple of the step size
+GRID_RESOLUTION = 0.05  # Wanted current change between adaptive points, as a fraction of the largest current
+SEQ_MIN_POINTS = 2  # Readings always taken by the sequential averaging
+COMPLIANCE_POINTS = 3  # Consecutive points in compliance after which a sweep is stopped
+COMPLIANCE_LEVEL = 0.995  # Fraction of the current limit considered to be in compliance
+SETTLE_FLOOR = 1e-5  # Current change always taken as settled, as a fraction of the current limit (A/A)
+MPP_SLOPE = 0.3  # Fraction of |J|/V above which the adaptive grid is considered to be at the MPP knee
+
+CURRENT_RANGES = [1e-8, 1e-7, 1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1.0]  # Keithley 2450 current ranges (A)
+NPLC_STEPS = [0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10]  # Integration times tried by the auto speed profile
+RANGE_HEADROOM = 1.5  # Margin between the previous current span and the chosen fixed range
+SPEED_PROFILES = {"Standard": (5, "ONCE"), "Fast": (0.1, "OFF"), "Precise": (10, "ON")}  # NPLC, auto zero
+
+# Perturb and observe MPP tracking that runs on the Keithley (TSP command set).
+# Every iteration tests v-step, v and v+step, keeps the one with the highest power and prints it.
+MPP_SCRIPT_NAME = "jvcharMPP"
+MPP_SCRIPT = """loadscript {name}
+smu.source.func = smu.FUNC_DC_VOLTAGE
+smu.source.ilimit.level = {limit:g}
+smu.measure.func = smu.FUNC_DC_CURRENT
+smu.measure.autorange = smu.OFF
+smu.measure.range = {limit:g}
+smu.measure.nplc = {nplc:g}
+smu.measure.sense = smu.SENSE_{wires}WIRE
+smu.source.level = {voltage:g}
+smu.source.output = smu.ON
+local v = {voltage:g}
+timer.cleartime()
+while timer.gettime() < {total:g} do
+    local best_v, best_i, best_p = v, 0, -1
+    for k = -1, 1 do
+        local vt = v + k * {step:g}
+        smu.source.level = vt
+        delay({settle:g})
+        local i = smu.measure.read()
+        if math.abs(vt * i) > best_p then
+            best_v, best_i, best_p = vt, i, math.abs(vt * i)
+        end
+    end
+    v = best_v
+    print(string.format("%.6f,%.6f,%.6e", timer.gettime(), best_v, best_i))
+end
+smu.source.output = smu.OFF
+print("END")
+endscript"""
+
+
+def voltage_list(volt_0, volt_f, step):
+    # Same grid as the stepped sweep, so both modes produce comparable data
+    return np.arange(volt_0, volt_f, step)
+
+
+def adaptive_voltages(volt_0, volt_f, step, voltage, current, coarse=GRID_COARSE, resolution=GRID_RESOLUTION):
+    """
+    Yield sweep voltages from volt_0 towards volt_f (excluded, as in np.arange) with a step that follows the curve.
+
+    "voltage" and "current" are the lists the caller fills while measuring. The next step is chosen so that the
+    current changes by about "resolution" times the largest current seen so far: flat regions are crossed with
+    up to "coarse" times the step size, while the knee and the zero crossing are measured with the step size.
+    """
+    direction = np.sign(step)
+    fine = abs(step)
+    size = fine
+    volt = volt_0
+
+    while (volt_f - volt) * direction > 0:
+        yield volt
+
+        if len(current) >= 2 and voltage[-1] != voltage[-2]:
+            slope = abs((current[-1] - current[-2]) / (voltage[-1] - voltage[-2]))
+            target = resolution * np.max(np.abs(current))
+
+            # Diode currents grow exponentially, so extrapolate how much the slope grows until the next point
+            if len(current) >= 3 and voltage[-2] != voltage[-3]:
+                slope_before = abs((current[-2] - current[-3]) / (voltage[-2] - voltage[-3]))
+                if slope_before > 0:
+                    slope = slope * max(slope / slope_before, 1)
+
+            if current[-1] * current[-2] <= 0:  # Crossing zero current (Voc), keep it fine
+                wanted = fine
+            elif voltage[-1] * current[-1] < 0 and slope * abs(voltage[-1]) > MPP_SLOPE * abs(current[-1]):
+                wanted = fine  # Approaching the MPP, where |dJ/dV| = |J|/V
+            elif slope > 0:
+                wanted = target / slope
+            else:
+                wanted = fine * coarse
+            size = min(max(wanted, fine), fine * coarse, size * 2)  # Grow at most twice per point
+
+        volt = volt + direction * size
+
+
+def sweep_window(volt_0, volt_f, step, voc, margin):
+    """
+    Trim a sweep range (as in forwa_vars/rever_vars) with a predicted Voc.
+
+    Forward sweeps end and reverse sweeps start "margin" volts above Voc, never outside the original range.
+    """
+    if voc is None or not np.isfinite(voc):
+        return volt_0, volt_f, step
+
+    if step > 0:
+        return volt_0, min(volt_f, voc + margin + step * 0.95), step
+    else:
+        return min(volt_0, voc + margin), volt_f, step
+
+
+def is_sweep_done(voltage, current, step, voc_margin, compliance):
+    """
+    Check whether a running sweep can stop before reaching its end voltage.
+
+    Forward sweeps stop "voc_margin" volts after the current crossed zero (use None to ignore Voc, e.g. in dark).
+    Any sweep stops once its last COMPLIANCE_POINTS points sat at the "compliance" current.
+    """
+    if len(current) >= COMPLIANCE_POINTS and \
+            all(abs(c) >= COMPLIANCE_LEVEL * compliance for c in current[-COMPLIANCE_POINTS:]):
+        return True
+
+    if voc_margin is not None and step > 0 and current[-1] > 0:
+        crossing = [n for n in range(1, len(current)) if current[n - 1] < 0 <= current[n]]
+        if crossing and voltage[-1] >= voltage[crossing[0]] + voc_margin:
+            return True
+
+    return False
+
+
+def load_voltage_list(keithley, voltages):
+    # Long lists are split, the first chunk replaces the old list and the rest are appended
+    voltages = list(voltages)
+    for n in range(0, len(voltages), LIST_CHUNK):
+        values = ",".join("{:.6g}".format(v) for v in voltages[n:n + LIST_CHUNK])
+        if n == 0:
+            keithley.write(":SOUR:LIST:VOLT " + values)
+        else:
+            keithley.write(":SOUR:LIST:VOLT:APP " + values)
+
+
+def set_measure_count(keithley, count):
+    keithley.write(":SENS:COUN {:d}".format(int(count)))
+
+
+def measure_count(keithley):
+    return int(float(keithley.ask(":SENS:COUN?")))
+
+
+def is_trigger_model_running(keithley):
+    # Answer looks like "RUNNING;..." or "IDLE;..."
+    state = keithley.ask(":TRIG:STAT?")
+    return state.strip().upper().startswith(("RUNNING", "WAITING", "BUILDING"))
+
+
+def buffer_count(keithley):
+    return int(float(keithley.ask(":TRAC:ACT? " + BUFFER)))
+
+
+def read_buffer(keithley, points):
+    # Single transfer of the source and reading values of the whole buffer
+    if points < 1:
+        return np.array([]), np.array([])
+    data = keithley.values(":TRAC:DATA? 1, {:d}, {}, SOUR, READ".format(int(points), BUFFER))
+    data = np.array(data, dtype=float)
+
+    return data[0::2], data[1::2]
+
+
+def sample_std(values, axis=None):
+    # Standard deviation of the mean readings (0 when only one reading is available)
+    values = np.asarray(values, dtype=float)
+    count = values.size if axis is None else values.shape[axis]
+    if count < 2:
+        return np.zeros_like(values.mean(axis=axis))
+    return values.std(axis=axis, ddof=1)
+
+
+class RunningCurve:
+    """
+    Running mean and variance (Welford) of repeated curves, on the voltage grid of the first curve.
+
+    Later curves are interpolated onto that grid, so the memory used does not grow with the number of sweeps.
+    """
+    def __init__(self):
+        self.voltage = None
+        self.count = None
+        self.mean = None
+        self.m2 = None
+
+    def add(self, voltage, current):
+        voltage = np.asarray(voltage, dtype=float)
+        current = np.asarray(current, dtype=float)
+        if voltage.size == 0:
+            return
+        if self.voltage is None:
+            self.voltage = voltage.copy()
+            self.count = np.zeros(voltage.size)
+            self.mean = np.zeros(voltage.size)
+            self.m2 = np.zeros(voltage.size)
+
+        order = np.argsort(voltage)
+        values = np.interp(self.voltage, voltage[order], current[order], left=np.nan, right=np.nan)
+        valid = np.isfinite(values)
+
+        self.count[valid] += 1
+        delta = values[valid] - self.mean[valid]
+        self.mean[valid] += delta / self.count[valid]
+        self.m2[valid] += delta * (values[valid] - self.mean[valid])
+
+    def mean_curve(self):
+        return np.where(self.count > 0, self.mean, np.nan)
+
+    def std_curve(self):
+        return np.where(self.count > 1, np.sqrt(self.m2 / np.maximum(self.count - 1, 1)), 0.0)
+
+
+def bulk_read_current(keithley, points, wait=None, should_stop=None, poll_time=0.01):
+    """
+    Take "points" current readings into the buffer and fetch them all with one query.
+
+    The measure count must already be set with set_measure_count. The buffer is polled until it is full, a stop
+    aborts the readings and only those already taken are fetched.
+    Returns the mean and standard deviation of the readings (A), NaN if there were none.
+    """
+    return bulk_read_currents([keithley], points, wait, should_stop, poll_time)[0]
+
+
+def bulk_read_currents(keithleys, points, wait=None, should_stop=None, poll_time=0.01):
+    # As bulk_read_current, all instruments are triggered before any buffer is fetched so they measure together
+    points = int(points)
+    for keithley in keithleys:
+        keithley.write(":TRAC:CLE {0};:TRAC:TRIG {0}".format(BUFFER))
+
+    stopped = False
+    while any(buffer_count(keithley) < points for keithley in keithleys):
+        if should_stop is not None and should_stop():
+            for keithley in keithleys:
+                keithley.write(":ABOR")
+            stopped = True
+            break
+        if wait is not None:
+            wait(poll_time)
+
+    results = []
+    for keithley in keithleys:
+        count = min(buffer_count(keithley), points) if stopped else points
+        if count < 1:
+            results.append((np.nan, 0.0))
+            continue
+        data = keithley.values(":TRAC:DATA? 1, {:d}, {}, READ".format(count, BUFFER))
+        data = np.array(data, dtype=float)
+        results.append((data.mean(), sample_std(data)))
+
+    return results
+
+
+def read_currents(keithleys, points, should_stop=None):
+    """
+    Take "points" single current readings on every instrument.
+
+    Every reading is requested from all instruments before any answer is collected, so they integrate together.
+    Returns an array with the readings (A) of each instrument, with fewer readings if stopped.
+    """
+    readings = np.zeros((len(keithleys), int(points)))
+    for p in range(int(points)):
+        for keithley in keithleys:
+            keithley.write(":READ?")
+        for n, keithley in enumerate(keithleys):
+            readings[n, p] = float(keithley.read())
+        if should_stop is not None and should_stop():
+            return readings[:, :p + 1]
+
+    return readings
+
+
+def sequential_read_current(keithley, target, min_points, max_points, should_stop=None):
+    """
+    Read the current until the standard error of the mean is below "target" (A).
+
+    At least "min_points" and at most "max_points" readings are taken, so precise points (high currents)
+    finish early while noisy points (close to J=0) get more readings.
+    Returns the mean, standard deviation (A) and the number of readings used.
+    """
+    max_points = max(int(max_points), 1)
+    min_points = min(int(min_points), max_points)
+    readings = []
+
+    while len(readings) < max_points:
+        readings.append(keithley.current)
+        if len(readings) >= min_points and sample_std(readings) / np.sqrt(len(readings)) <= target:
+            break
+        if should_stop is not None and should_stop():
+            break
+
+    return np.mean(readings), sample_std(readings), len(readings)
+
+
+def command_set(keithley):
+    # "SCPI" or "TSP" (changing it needs a restart of the Keithley)
+    return keithley.ask("*LANG?").strip().upper()
+
+
+def start_tsp_mpp(keithley, voltage, step, settle, total, limit, nplc=1, wires=2):
+    """
+    Load the MPP tracking script into the Keithley (TSP command set) and start it.
+
+    The script tracks for "total" seconds, holding each test voltage "settle" seconds,
+    and prints one "time,voltage,current" line per iteration (see read_tsp_mpp).
+    """
+    script = MPP_SCRIPT.format(name=MPP_SCRIPT_NAME, voltage=voltage, step=step, settle=settle, total=total,
+                               limit=limit, nplc=nplc, wires=wires)
+    for line in script.split("\n"):
+        keithley.write(line)
+    keithley.write(MPP_SCRIPT_NAME + ".run()")
+
+
+def read_tsp_mpp(keithley):
+    # Next tracked point as (elapsed s, voltage V, current A), or None once the script finished
+    line = keithley.read().strip()
+    if line == "END":
+        return None
+    elapsed, voltage, current = (float(val) for val in line.split(","))
+
+    return elapsed, voltage, current
+
+
+def stop_tsp_mpp(keithley):
+    # A device clear aborts the running script, then the Keithley goes to 0 V and the output is switched off
+    keithley.adapter.connection.clear()
+    keithley.write("abort")
+    keithley.write("smu.source.level = 0")
+    keithley.write("smu.source.output = smu.OFF")
+
+
+def line_frequency(keithley):
+    return float(keithley.ask(":SYST:LFR?"))
+
+
+def set_nplc(keithley, nplc):
+    keithley.write(":SENS:CURR:NPLC {:g}".format(min(max(nplc, 0.01), 10)))
+
+
+def set_auto_zero(keithley, policy):
+    # ON: zero every reading (slowest), OFF: never, ONCE: disable it and refresh the zero reference now
+    if policy == "ONCE":
+        keithley.write(":SENS:CURR:AZER OFF;:AZER:ONCE")
+    else:
+        keithley.write(":SENS:CURR:AZER " + policy)
+
+
+def pick_current_range(span, limit, headroom=RANGE_HEADROOM):
+    # Smallest range that fits the expected currents, never above the one needed for the current limit
+    for curr_range in CURRENT_RANGES:
+        if curr_range >= span * headroom or curr_range >= limit:
+            return curr_range
+
+    return CURRENT_RANGES[-1]
+
+
+def calibrate_nplc(keithley, target, average_points, readings=10, should_stop=None):
+    """
+    Find the fastest integration time and auto zero policy whose noise meets the target error of an averaged point.
+
+    "readings" are taken at the present bias for each NPLC_STEPS step, with the zero reference refreshed once and
+    with auto zero on every reading (about twice the time), in order of reading time, until the standard deviation
+    divided by sqrt(average_points) is below "target" (A). Returns the chosen NPLC, auto zero policy and the noise
+    (A) measured with them. The measure count is left as it was. A stop ends the search after the present step.
+    """
+    candidates = sorted([(nplc, policy) for nplc in NPLC_STEPS for policy in ("ONCE", "ON")],
+                        key=lambda candidate: candidate[0] * (2 if candidate[1] == "ON" else 1))
+    count = measure_count(keithley)
+    set_measure_count(keithley, readings)
+    for nplc, auto_zero in candidates:
+        set_nplc(keithley, nplc)
+        set_auto_zero(keithley, auto_zero)
+        _, noise = bulk_read_current(keithley, readings, should_stop=should_stop)
+        if noise / np.sqrt(max(average_points, 1)) <= target:
+            break
+        if should_stop is not None and should_stop():
+            break
+    set_measure_count(keithley, count)
+
+    return nplc, auto_zero, noise
+
+
+def settle_current(keithley, max_wait, tolerance, floor=0.0, interval=0.01, wait=None, should_stop=None,
+                   clock=perf_counter):
+    """
+    Read the current after a voltage step until it stops drifting (see settle_currents).
+    Returns the time (s) it took to settle.
+    """
+    return settle_currents([keithley], max_wait, tolerance, floor, interval, wait, should_stop, clock)[0]
+
+
+def settle_currents(keithleys, max_wait, tolerance, floor=0.0, interval=0.01, wait=None, should_stop=None,
+                    clock=perf_counter):
+    """
+    Read the currents after a voltage step until they stop drifting, on all instruments together.
+
+    An instrument is settled when two consecutive readings differ by less than "tolerance"
+    (relative) or "floor" (A), whichever is larger. The instruments still drifting are read together
+    (see read_currents), and waiting is capped at "max_wait" seconds of "clock".
+    Returns the time (s) every instrument took to settle.
+    """
+    start = clock()
+    previous = read_currents(keithleys, 1)[:, 0]
+    settled = [None] * len(keithleys)
+
+    while True:
+        drifting = [n for n, elapsed in enumerate(settled) if elapsed is None]
+        if wait is not None:
+            wait(interval)
+        present = read_currents([keithleys[n] for n in drifting], 1)[:, 0]
+        elapsed = clock() - start
+
+        for n, current in zip(drifting, present):
+            if abs(current - previous[n]) <= max(tolerance * abs(current), floor):
+                settled[n] = elapsed
+            previous[n] = current
+        if None not in settled:
+            break
+        if elapsed >= max_wait or (should_stop is not None and should_stop()):
+            break
+
+    return [elapsed if settle is None else settle for settle in settled]
+
+
+def start_buffered_sweep(keithley, voltages, delay, average_points=1):
+    keithley.write(":TRAC:CLE " + BUFFER)
+    set_measure_count(keithley, average_points)
+    load_voltage_list(keithley, voltages)
+    keithley.write(":SOUR:SWE:VOLT:LIST 1, {:g}, 1, OFF, {}".format(delay, BUFFER))
+    keithley.write(":INIT")
+
+
+def fetch_buffered_sweep(keithley, average_points=1):
+    points = buffer_count(keithley)
+    source, reading = read_buffer(keithley, points)
+    set_measure_count(keithley, 1)  # Leave single readings for the rest of the program
+
+    # Group the readings by sweep point (only complete points are kept)
+    steps = len(reading) // average_points
+    source = source[:steps * average_points].reshape(steps, average_points)
+    reading = reading[:steps * average_points].reshape(steps, average_points)
+
+    return source[:, 0], reading.mean(axis=1), sample_std(reading, axis=1)
+
+
+def buffered_voltage_sweep(keithley, voltages, delay, average_points=1, wait=None, should_stop=None,
+                           poll_time=0.05):
+    """
+    Run a list sweep on the instrument trigger model and fetch the reading buffer at once.
+
+    Each voltage is held for "delay" seconds and measured "average_points" times.
+    Returns the source voltages (V), mean current (A) and standard deviation (A) per point.
+    """
+    return parallel_buffered_sweep([keithley], [voltages], delay, average_points, wait, should_stop, poll_time)[0]
+
+
+def parallel_buffered_sweep(keithleys, voltage_lists, delay, average_points=1, wait=None, should_stop=None,
+                            poll_time=0.05):
+    """
+    Run one list sweep per instrument at the same time, see buffered_voltage_sweep.
+
+    Returns a list with the source voltages, mean current and standard deviation of every instrument.
+    """
+    average_points = max(int(average_points), 1)
+    for keithley, voltages in zip(keithleys, voltage_lists):
+        start_buffered_sweep(keithley, list(voltages), delay, average_points)
+
+    # Poll the trigger models instead of blocking on the VISA timeout, so the GUI keeps responding
+    while any(is_trigger_model_running(keithley) for keithley in keithleys):
+        if should_stop is not None and should_stop():
+            for keithley in keithleys:
+                keithley.write(":ABOR")
+            break
+        if wait is not None:
+            wait(poll_time)
+
+    return [fetch_buffered_sweep(keithley, average_points) for keithley in keithleys]
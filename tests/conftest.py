@@ -0,0 +1,46 @@
+"""
+Shared fixtures: the program runs on simulated instruments (see simulation.py), without a display.
+"""
+__author__ = "Edgar R. Nandayapa"
+
+import os
+import sys
+import time
+import pytest
+
+PROGRAM = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "jv_char")
+sys.path.insert(0, PROGRAM)  # The modules import each other as scripts
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+
+def wait_for(condition, timeout=60):
+    # Run the Qt events until condition() is true
+    from PyQt5.QtWidgets import QApplication
+    end = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < end, "Timed out"
+        QApplication.instance().processEvents()
+        time.sleep(0.005)
+
+
+@pytest.fixture(scope="session")
+def app():
+    from PyQt5.QtWidgets import QApplication
+    return QApplication.instance() or QApplication(sys.argv[:1])
+
+
+@pytest.fixture(scope="module")
+def window(app, tmp_path_factory):
+    # Main window on a simulated bench, connected and with the popups answered
+    folder = tmp_path_factory.mktemp("window")
+    previous = os.getcwd()
+    os.chdir(folder)  # The SuSi log is written to the working folder
+    sys.argv.append("--simulate")
+    import main
+    window = main.MainWindow()
+    window.popup_message = lambda text: None
+    wait_for(window.BStart.isEnabled)
+    window.LEfolder.setText(str(folder) + "/")
+    yield window
+    sys.argv.remove("--simulate")
+    os.chdir(previous)
@@ -0,0 +1,74 @@
+"""
+Acquisition server (acquisition.py): the shared-memory ring and requests during a sweep, on simulated instruments.
+"""
+__author__ = "Edgar R. Nandayapa"
+
+import threading
+from time import perf_counter
+import numpy as np
+import pytest
+import acquisition
+import simulation
+
+
+@pytest.fixture
+def ring():
+    ring = acquisition.SampleRing(capacity=4)
+    yield ring
+    ring.close(unlink=True)
+
+
+def samples(views):
+    return [int(row[0]) for view in views for row in view]
+
+
+def test_ring_read(ring):
+    assert ring.read(0) == ([], 0)
+    for n in range(3):
+        ring.write(n, 1, 0.1 * n, 1e-3, 0)
+    views, written = ring.read(0)
+    assert written == 3 and isinstance(written, int)
+    assert samples(views) == [0, 1, 2]
+    assert samples(ring.read(2)[0]) == [2]
+
+
+def test_ring_wraps_around(ring):
+    for n in range(6):
+        ring.write(n, 1, 0, 0, 0)
+    views, written = ring.read(3)
+    assert written == 6
+    assert len(views) == 2  # The end and the start of the memory
+    assert samples(views) == [3, 4, 5]
+    assert samples(ring.read(0)[0]) == [2, 3, 4, 5]  # Older samples were overwritten
+
+
+def test_ring_of_another_process(ring):
+    ring.write(7, 1, 0, 0, 0)
+    ring.set_temperature(25.5)
+    viewer = acquisition.SampleRing(ring.name)
+    try:
+        assert (viewer.capacity, viewer.written, viewer.temperature) == (4, 1, 25.5)
+        assert samples(viewer.read(0)[0]) == [7]
+    finally:
+        viewer.close()
+
+
+def test_requests_during_a_sweep():
+    ports = simulation.ports("test_acquisition")
+    client = acquisition.AcquisitionClient(dict(ports, keithley=ports["keithley"][0]), capacity=100)
+    try:
+        keithley = client.instrument("keithley")
+        relays = client.instrument("relays")
+        relays[0].on()
+        keithley.write(":OUTPUT ON")
+        sweep = threading.Thread(target=client.sweep, args=(np.arange(0, 1, 0.1), 0.2, 1))
+        start = perf_counter()
+        sweep.start()
+        while client.ring.written == 0:  # Sweep running
+            assert perf_counter() - start < 10
+        relays[0].off()  # Not held up by the Keithley
+        assert client.ring.written < 10
+        sweep.join()
+        assert client.ring.written == 10
+    finally:
+        client.close()
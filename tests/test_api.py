@@ -0,0 +1,179 @@
+"""
+Remote API (api.py) against localhost, with the window on simulated instruments.
+"""
+__author__ = "Edgar R. Nandayapa"
+
+import json
+import time
+import socket
+import threading
+import urllib.request
+import urllib.error
+import pytest
+from conftest import wait_for
+
+JV_SETTINGS = {"speed_profile": "Fast", "sweep_mode": "Buffered", "volt_step": "0.05", "set_time": "0.01",
+               "light_soak": "0", "bias_soak": "0", "loop_count": "1", "early_stop": False, "multiplex": True,
+               "cell_a": True, "cell_b": False, "cell_c": False, "cell_d": False, "cell_e": False, "cell_f": False,
+               "for_bmL": True, "rev_bmL": False, "for_bmD": False, "rev_bmD": False, "susi_intensity": "100"}
+
+
+@pytest.fixture(scope="module")
+def remote(window):
+    import api
+    remote = api.RemoteApi(window, 0)
+    yield remote
+    remote.close()
+
+
+def url(remote, path):
+    return "http://127.0.0.1:{}{}".format(remote.server.server_address[1], path)
+
+
+def http(remote, method, path, body=None):
+    # From a thread, while the Qt events (where the commands run) are processed here
+    result = {}
+
+    def send():
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(url(remote, path), data=data, method=method)
+        try:
+            with urllib.request.urlopen(request, timeout=30) as reply:
+                result["reply"] = reply.status, json.load(reply)
+        except urllib.error.HTTPError as error:
+            result["reply"] = error.code, json.load(error)
+
+    thread = threading.Thread(target=send)
+    thread.start()
+    wait_for(lambda: not thread.is_alive())
+    return result["reply"]
+
+
+def open_stream(remote, headers):
+    connection = socket.create_connection(("127.0.0.1", remote.server.server_address[1]), timeout=30)
+    connection.sendall(("GET /stream HTTP/1.1\r\nHost: localhost\r\n" + "".join(
+        "{}: {}\r\n".format(name, value) for name, value in headers.items()) + "\r\n").encode())
+    stream = connection.makefile("rb")
+    head = b""
+    while not head.endswith(b"\r\n\r\n"):
+        byte = stream.read(1)
+        if not byte:  # Closed by the server
+            break
+        head += byte
+    return connection, stream, head.decode()
+
+
+def read_websocket(stream, events):
+    while True:
+        opcode, size = stream.read(2)
+        size &= 127
+        if size == 126:
+            size = int.from_bytes(stream.read(2), "big")
+        elif size == 127:
+            size = int.from_bytes(stream.read(8), "big")
+        data = stream.read(size)
+        if opcode == 0x81:
+            events.append(json.loads(data))
+            if events[-1]["type"] == "finished":
+                return
+
+
+def read_events(stream, events):
+    for line in stream:
+        if line.startswith(b"data: "):
+            events.append(json.loads(line[6:]))
+            if events[-1]["type"] == "finished":
+                return
+
+
+def test_status(remote):
+    code, reply = http(remote, "GET", "/status")
+    assert code == 200
+    assert reply["running"] is False
+    assert reply["instruments"]["keithley"] is True
+
+
+def test_bad_commands(remote, window):
+    assert http(remote, "POST", "/start", {"measurement": "iv"})[0] == 400
+    assert http(remote, "POST", "/stop")[0] == 409
+    assert http(remote, "GET", "/nothing")[0] == 404
+
+
+def test_wrong_setting_changes_nothing(remote, window):
+    step = window.volt_step.text()
+    code, reply = http(remote, "POST", "/start", {"measurement": "jv",
+                                                  "settings": {"volt_step": "0.5", "no_such_field": "1"}})
+    assert code == 400
+    assert "no_such_field" in reply["error"]
+    assert window.volt_step.text() == step
+
+
+def test_websocket_without_key(remote):
+    connection, stream, head = open_stream(remote, {"Upgrade": "websocket", "Connection": "Upgrade"})
+    connection.close()
+    assert head.startswith("HTTP/1.1 400")
+
+
+def client_frame(opcode, data):
+    # Masked, as clients send them
+    mask = b"\x01\x02\x03\x04"
+    return bytes([0x80 | opcode, 0x80 | len(data)]) + mask + bytes(b ^ mask[n % 4] for n, b in enumerate(data))
+
+
+def test_websocket_ping_and_close(remote):
+    connection, stream, head = open_stream(remote, {"Upgrade": "websocket", "Connection": "Upgrade",
+                                                    "Sec-WebSocket-Key": "dGhlIHNhbXBsZSBub25jZQ=="})
+    assert head.startswith("HTTP/1.1 101")
+    wait_for(lambda: len(remote.subscribers) == 1)
+    connection.sendall(client_frame(0x9, b"hello"))
+    assert stream.read(7) == b"\x8a\x05hello"  # Pong with the same data
+    connection.sendall(client_frame(0x8, b"\x03\xe8"))
+    assert stream.read(4) == b"\x88\x02\x03\xe8"  # Close echoed with the status code
+    assert stream.read(1) == b""  # And the connection closed
+    connection.close()
+    wait_for(lambda: not remote.subscribers)
+
+
+def test_timed_out_command_is_cancelled(remote, app, monkeypatch):
+    import api
+    monkeypatch.setattr(api, "COMMAND_TIMEOUT", 0.1)
+    calls = []
+    monkeypatch.setattr(remote, "do_stop", lambda body: calls.append(body) or (202, {}), raising=False)
+    replies = []
+    thread = threading.Thread(target=lambda: replies.append(remote.request("stop", {})))
+    thread.start()
+    thread.join()  # No Qt events meanwhile: the window does not answer
+    for _ in range(3):  # Then the window gets the command
+        app.processEvents()
+        time.sleep(0.05)
+    assert replies[0][0] == 504
+    assert calls == []
+
+
+def test_measurement_stream(remote, window):
+    connection, stream, head = open_stream(remote, {"Upgrade": "websocket", "Connection": "Upgrade",
+                                                    "Sec-WebSocket-Key": "dGhlIHNhbXBsZSBub25jZQ==",
+                                                    "Sec-WebSocket-Version": "13"})
+    assert "s3pPLMBiTxaQ9kYGzzhZRbK+xOo=" in head
+    sse_connection, sse_stream, sse_head = open_stream(remote, {})
+    assert "text/event-stream" in sse_head
+    websocket_events, sse_events = [], []
+    readers = [threading.Thread(target=read_websocket, args=(stream, websocket_events)),
+               threading.Thread(target=read_events, args=(sse_stream, sse_events))]
+    for reader in readers:
+        reader.start()
+
+    code, reply = http(remote, "POST", "/start", {"measurement": "jv", "settings": JV_SETTINGS})
+    assert code == 202
+    assert http(remote, "POST", "/start", {"measurement": "jv"})[0] == 409  # Already running
+    wait_for(lambda: not any(reader.is_alive() for reader in readers), timeout=120)
+    connection.close()
+    sse_connection.close()
+
+    for events in (websocket_events, sse_events):
+        points = [event for event in events if event["type"] == "jv_points"]
+        assert sum(len(event["voltage"]) for event in points) == 29  # -0.2 V to 1.2 V in 0.05 V steps
+        chars = [event for event in events if event["type"] == "jv_chars"]
+        assert len(chars) == 1 and 0.9 < chars[0]["values"]["Voc (V)"] < 1.2
+        assert events[-1] == {"type": "finished", "stopped": False, "stop_latency_ms": None, "error": None}
+    wait_for(lambda: not window.is_meas_live)
@@ -0,0 +1,50 @@
+"""
+Benchmark results (benchmark.py): comparison with an earlier run and the time per stage.
+"""
+__author__ = "Edgar R. Nandayapa"
+
+import benchmark
+
+
+def results(**scenarios):
+    return {"requested": list(scenarios), "scenarios": scenarios}
+
+
+def scenario(wall_s=10.0, points_per_s=100.0, peak_memory_mb=150.0, plot=1.0):
+    return {"wall_s": wall_s, "curves": 4, "points": 1000, "points_per_s": points_per_s,
+            "peak_memory_mb": peak_memory_mb, "stages_s": {"acquire": 5.0, "plot": plot}}
+
+
+def test_compare_flags_what_got_worse():
+    old = results(jv=scenario(), mpp=scenario())
+    new = results(jv=scenario(wall_s=12, points_per_s=80, plot=0.5), mpp=scenario(wall_s=9))
+    assert sorted(benchmark.compare(old, new)) == [("jv", "points_per_s", 100, 80), ("jv", "wall_s", 10, 12)]
+
+
+def test_compare_ignores_small_changes():
+    old = results(jv=scenario(wall_s=0.1, peak_memory_mb=10))
+    new = results(jv=scenario(wall_s=0.115, peak_memory_mb=11.5))  # Over 10 %, but below MIN_CHANGE
+    assert benchmark.compare(old, new) == []
+    assert benchmark.compare(old, new, tolerance=0.5) == []
+
+
+def test_compare_stage_times():
+    old = results(jv=scenario(plot=1.0))
+    assert benchmark.compare(old, results(jv=scenario(plot=1.5))) == [("jv", "stages_s.plot", 1.0, 1.5)]
+
+
+def test_compare_failed_scenario():
+    old = results(jv=scenario(), mpp=scenario())
+    failed = {"requested": ["jv", "mpp"], "scenarios": {"jv": scenario()}}
+    assert benchmark.compare(old, failed) == [("mpp", None, None, None)]
+    not_run = {"requested": ["jv"], "scenarios": {"jv": scenario()}}
+    assert benchmark.compare(old, not_run) == []
+
+
+def test_acquire_not_counted_twice():
+    stages = benchmark.StageTimes()
+    acquire = benchmark.AcquireTimes(stages)
+    access = (None, "call", "write", (), {}, None, 0.0, 0.5)
+    acquire.log(*access)
+    stages.timed("save", lambda: acquire.log(*access))()
+    assert stages.seconds["acquire"] == 0.5
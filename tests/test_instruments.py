@@ -0,0 +1,51 @@
+"""
+Mirror of the Keithley settings (instruments.ShadowKeithley) on a simulated Keithley.
+"""
+__author__ = "Edgar R. Nandayapa"
+
+import pytest
+import simulation
+import sweeps
+from instruments import ShadowKeithley
+
+
+@pytest.fixture
+def keithley(request):
+    return ShadowKeithley(simulation.open_device("keithley", "SIM::{}::KEITHLEY1".format(request.node.name)))
+
+
+def test_same_setting_is_skipped(keithley):
+    keithley.write(":SENS:CURR:NPLC 2")
+    keithley.write("sens:curr:nplc 2")  # Same header, other spelling
+    keithley.current_range = 0.01
+    keithley.current_range = 0.01
+    assert (keithley.sent_writes, keithley.skipped_writes) == (2, 2)
+    keithley.write(":SENS:CURR:NPLC 5")
+    assert keithley.instrument.nplc == 5
+    assert keithley.sent_writes == 3
+
+
+def test_four_wire_with_and_without_colon(keithley):
+    keithley.write("SENS:CURR:RSEN ON")
+    keithley.write(":SENS:CURR:RSEN ON")
+    assert keithley.skipped_writes == 1
+    assert keithley.instrument.wires == 4
+
+
+def test_buffered_sweep_keeps_the_settings(keithley):
+    keithley.write(":SENS:CURR:NPLC 0.1")
+    keithley.source_voltage = 0.2
+    keithley.enable_source()
+    sweeps.buffered_voltage_sweep(keithley, [0, 0.1, 0.2], 0.001, average_points=2)
+    sweeps.bulk_read_currents([keithley], 1)
+    keithley.write(":SENS:CURR:NPLC 0.1")  # Trigger and buffer commands leave the mirror alone
+    assert keithley.skipped_writes == 1
+    keithley.source_voltage = 0.2  # But the sweep moved the source
+    assert keithley.skipped_writes == 1
+
+
+def test_unknown_command_forgets(keithley):
+    keithley.write(":SENS:CURR:NPLC 1")
+    keithley.write("*RST")
+    keithley.write(":SENS:CURR:NPLC 1")
+    assert (keithley.sent_writes, keithley.skipped_writes) == (3, 0)
@@ -0,0 +1,35 @@
+"""
+Measurement logic shared by the window and the batch runner (measurement.py), without instruments.
+"""
+__author__ = "Edgar R. Nandayapa"
+
+from types import MappingProxyType
+import pytest
+import engine
+import measurement
+
+
+class Station(measurement.Station):
+    def __init__(self, smu_cells, keithleys):
+        self.settings = MappingProxyType({"smu_cells": smu_cells})
+        self.keithleys = [object()] * keithleys
+        self.engine = engine.MeasurementEngine()
+        self.messages = []
+        self.engine.status.connect(lambda text, timeout: self.messages.append(text))
+
+
+ALL = [True] * 6
+
+
+@pytest.mark.parametrize("smu_cells, keithleys, checked, groups", [
+    ("abc,def", 2, ALL, [[0, 1, 2], [3, 4, 5]]),
+    ("ab, D", 2, ALL, [[0, 1, 2, 4, 5], [3]]),  # Cells left out go to the first Keithley
+    ("ace,bdf", 2, [True, False, True, True, False, True], [[0, 2], [3, 5]]),  # Unchecked cells are skipped
+    ("abcdef", 1, ALL, [[0, 1, 2, 3, 4, 5]]),
+    ("abc,def", 1, ALL, []),  # Not enough Keithleys
+    ("abc,cde", 2, ALL, []),  # Cell listed twice
+])
+def test_smu_cell_groups(smu_cells, keithleys, checked, groups):
+    station = Station(smu_cells, keithleys)
+    assert station.smu_cell_groups(checked) == groups
+    assert bool(station.messages) == (groups == [])
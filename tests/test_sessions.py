@@ -0,0 +1,84 @@
+"""
+Recording and replay of sessions (sessions.py): a plan measured on the simulated instruments by batch.py is
+replayed without waiting and measures the same points.
+"""
+__author__ = "Edgar R. Nandayapa"
+
+import os
+import sys
+import json
+import subprocess
+import pytest
+from conftest import PROGRAM
+import sessions
+
+PLAN = {"settings": {"set_time": "0.01", "speed_profile": "Fast", "sweep_mode": "Buffered", "volt_step": "0.05",
+                     "susi_intensity": "100"},
+        "runs": [{"sample": "jv", "measurement": "jv", "cells": "a"},
+                 {"sample": "mpp", "measurement": "mpp", "cells": "a",
+                  "settings": {"mpp_ttime": "0.1", "mpp_inttime": "50"}}]}
+
+
+def batch(folder, plan, *options):
+    plan = dict(plan, folder=str(folder / "data"))
+    (folder / "plan.json").write_text(json.dumps(plan))
+    return subprocess.run([sys.executable, os.path.join(PROGRAM, "batch.py"), "plan.json", "--simulate"] +
+                          list(options), cwd=folder, capture_output=True, text=True, timeout=300,
+                          env=dict(os.environ, QT_QPA_PLATFORM="offscreen"))
+
+
+def data(folder):
+    # Measured values of the saved files (without the date and time of the MPP points), by file
+    values = {}
+    for name in os.listdir(folder / "data"):
+        lines = (folder / "data" / name).read_text().splitlines()
+        values[name] = [[field for field in line.split("\t") if ":" not in field] for line in lines
+                        if line[:1].isdigit() or line[:1] == "-"]
+    return values
+
+
+@pytest.fixture(scope="module")
+def recorded(tmp_path_factory):
+    folder = tmp_path_factory.mktemp("recorded")
+    process = batch(folder, PLAN, "--record", "session.jvs")
+    assert process.returncode == 0, process.stdout + process.stderr
+    return folder
+
+
+def test_replay_without_waiting(recorded, tmp_path):
+    (tmp_path / "session.jvs").write_bytes((recorded / "session.jvs").read_bytes())
+    process = batch(tmp_path, PLAN, "--replay", "session.jvs", "0")
+    assert process.returncode == 0, process.stdout + process.stderr
+
+    before, after = data(recorded), data(tmp_path)
+    assert sorted(before) == ["JV_jv.txt", "MPP_mpp_a.txt"]
+    assert before["MPP_mpp_a.txt"]
+    assert after == before
+
+
+def test_replay_of_another_plan(recorded, tmp_path):
+    (tmp_path / "session.jvs").write_bytes((recorded / "session.jvs").read_bytes())
+    plan = dict(PLAN, settings=dict(PLAN["settings"], volt_step="0.1"))
+    process = batch(tmp_path, plan, "--replay", "session.jvs", "0")
+    assert process.returncode == 3, process.stdout + process.stderr
+    assert "differs from the recorded session" in process.stdout
+    assert "Stopped by the user" not in process.stdout
+
+
+class Device:
+    def measure(self, voltage, nplc=1):
+        return voltage * nplc
+
+
+def test_keyword_arguments(tmp_path):
+    recorder = sessions.Recorder(str(tmp_path / "session.jvs"))
+    device = recorder.wrap("keithley", "port", Device())
+    assert device.measure(0.5, nplc=4) == 2
+    recorder.close()
+
+    player = sessions.Player(str(tmp_path / "session.jvs"), speed=0)
+    replayed = player.open_device("keithley", "port")
+    assert replayed.measure(0.5, nplc=4) == 2
+    player = sessions.Player(str(tmp_path / "session.jvs"), speed=0)
+    with pytest.raises(sessions.ReplayError):
+        player.open_device("keithley", "port").measure(0.5, nplc=2)
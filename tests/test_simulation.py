@@ -0,0 +1,69 @@
+"""
+Simulated instruments (simulation.py): the cells of the diode model and an unplugged instrument.
+"""
+__author__ = "Edgar R. Nandayapa"
+
+import time
+import numpy as np
+import pytest
+import simulation
+
+
+def test_diode_cell():
+    cell = simulation.DiodeCell(jsc=22, voc=1.1, n=1.5, rs=3, rsh=2000, area=0.16, temperature=300)
+    short_circuit, below, above = cell.current([0, 1.08, 1.1], suns=1)
+    assert short_circuit * 1000 / 0.16 == pytest.approx(-22, rel=0.01)  # mA/cm²
+    assert below < 0 < above  # Open circuit voltage a little under voc, because of the shunt
+    assert cell.current([0.5], suns=0)[0] > 0  # In the dark the diode takes current
+
+
+def test_relays_connect_the_cells():
+    port = "SIM::test_relays::"
+    keithley = simulation.open_device("keithley", port + "KEITHLEY1")
+    relays = simulation.open_device("relays", port + "RELAYS")
+    bench = simulation.get_bench(port)
+    assert bench.current([0], keithley.index)[0] == pytest.approx(0, abs=1e-9)  # No cell connected
+    relays[0].on()
+    assert bench.connected_cells(keithley.index) == [bench.cells[0]]
+    relays[0].off()
+    assert bench.connected_cells(keithley.index) == []
+
+
+def test_unplugged_keithley():
+    port = "SIM::test_unplug::KEITHLEY1"
+    keithley = simulation.open_device("keithley", port)
+    assert port in simulation.present_ports()
+    simulation.unplug(port)
+    try:
+        assert port not in simulation.present_ports()
+        with pytest.raises(OSError):
+            keithley.ask("*IDN?")
+        with pytest.raises(OSError):
+            simulation.open_device("keithley", port)
+    finally:
+        simulation.plug(port)
+    assert port in simulation.present_ports()
+    assert keithley.ask("*IDN?").startswith("KEITHLEY")
+    assert np.isfinite(float(keithley.ask("SYST:LFR?")))
+
+
+def test_current_relaxes_with_the_ions(monkeypatch):
+    monkeypatch.setitem(simulation.CONFIG, "keithley", dict(simulation.CONFIG["keithley"], latency=0, noise=0,
+                                                            hysteresis_time=0.1))
+    port = "SIM::test_ions::"
+    keithley = simulation.open_device("keithley", port + "KEITHLEY1")
+    simulation.open_device("relays", port + "RELAYS")[0].on()
+    keithley.current_nplc = 0.01
+    keithley.write(":OUTPUT ON")
+    keithley.source_voltage = 1.2
+    time.sleep(1)  # Ions settled at 1.2 V
+    keithley.source_voltage = 0.9
+    currents = []
+    for _ in range(6):  # Reads of the property, as the stepped sweep takes them
+        currents.append(keithley.current)
+        time.sleep(0.03)
+    time.sleep(1)
+    steady = keithley.current
+    assert np.all(np.diff(currents) > 0)  # Drift toward the steady state
+    assert currents[0] < steady
+    assert currents[-1] == pytest.approx(steady, rel=0.05)
@@ -0,0 +1,281 @@
+"""
+Sweep and reading helpers (sweeps.py) on scripted and simulated instruments.
+"""
+__author__ = "Edgar R. Nandayapa"
+
+import time
+import numpy as np
+import pytest
+import simulation
+import sweeps
+
+
+class Keithley:
+    # Answers :READ? with the next of its currents, the commands of all instruments go to one log
+    def __init__(self, name, currents, log):
+        self.name = name
+        self.currents = list(currents)
+        self.log = log
+
+    def write(self, command):
+        self.log.append((self.name, command))
+
+    def read(self):
+        self.log.append((self.name, "read"))
+        return str(self.currents.pop(0) if len(self.currents) > 1 else self.currents[0])
+
+
+class Readings:
+    # Current property that gives the next of its values, as the pymeasure Keithley does
+    def __init__(self, currents):
+        self.currents = iter(currents)
+
+    @property
+    def current(self):
+        return next(self.currents)
+
+
+class Commands:
+    # Only keeps the commands written to it
+    def __init__(self):
+        self.commands = []
+
+    def write(self, command):
+        self.commands.append(command)
+
+
+class Noisy:
+    # Readings at 1 mA whose spread falls with sqrt(NPLC), all available as soon as they are triggered
+    def __init__(self, noise):
+        self.noise = noise
+        self.nplc = 1.0
+        self.count = 1
+        self.commands = []
+
+    def write(self, command):
+        for part in command.split(";"):
+            header, _, value = part.partition(" ")
+            if header == ":SENS:CURR:NPLC":
+                self.nplc = float(value)
+            elif header == ":SENS:COUN":
+                self.count = int(value)
+            self.commands.append(part)
+
+    def ask(self, command):
+        return str(self.count)  # :SENS:COUN? and :TRAC:ACT?
+
+    def values(self, command):
+        return list(1e-3 + np.resize([1, -1], self.count) * self.noise / np.sqrt(self.nplc))
+
+
+@pytest.fixture
+def keithley(request, monkeypatch):
+    # Simulated Keithley with cell a connected and lit (lamp without SuSi), on a bench of its own
+    monkeypatch.setitem(simulation.CONFIG, "devices", ["keithley", "relays"])
+    port = "SIM::{}::".format(request.node.name)
+    keithley = simulation.open_device("keithley", port + "KEITHLEY1")
+    simulation.open_device("relays", port + "RELAYS")[0].on()
+    keithley.write(":OUTPUT ON")
+    return keithley
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def wait(self, seconds):
+        self.now += seconds
+
+
+def test_settle_currents_together():
+    log = []
+    clock = Clock()
+    fast = Keithley("fast", [1e-3, 1.0001e-3], log)
+    slow = Keithley("slow", [1e-3, 2e-3, 2.5e-3, 2.501e-3], log)
+    settled = sweeps.settle_currents([fast, slow], 1, 0.01, wait=clock.wait, clock=clock)
+    assert settled == pytest.approx([0.01, 0.03])
+    assert log[:4] == [("fast", ":READ?"), ("slow", ":READ?"), ("fast", "read"), ("slow", "read")]
+    assert log.count(("fast", ":READ?")) == 2  # Not read any more once settled
+
+
+def test_settle_current_limits():
+    clock = Clock()
+    drifting = Keithley("drift", [n * 1e-3 for n in range(1000)], [])
+    assert sweeps.settle_current(drifting, 0.05, 0.01, wait=clock.wait, clock=clock) == pytest.approx(0.05)
+    noisy = Keithley("noise", [1e-9, 3e-9], [])  # Relative change large, but below the floor
+    assert sweeps.settle_current(noisy, 1, 0.01, floor=1e-8, wait=clock.wait, clock=clock) == pytest.approx(0.01)
+
+
+def test_voltage_list_commands():
+    keithley = Commands()
+    sweeps.load_voltage_list(keithley, np.arange(sweeps.LIST_CHUNK * 2 + 5) * 0.001)
+    assert len(keithley.commands) == 3  # Split in chunks, the first one replaces the old list
+    assert keithley.commands[0].startswith(":SOUR:LIST:VOLT 0,0.001,")
+    assert all(command.startswith(":SOUR:LIST:VOLT:APP ") for command in keithley.commands[1:])
+    values = [value for command in keithley.commands for value in command.split(" ")[1].split(",")]
+    assert len(values) == sweeps.LIST_CHUNK * 2 + 5 and values[-1] == "0.204"
+
+
+def test_buffered_sweep_commands():
+    keithley = Commands()
+    sweeps.start_buffered_sweep(keithley, [0, 0.5], 0.01, average_points=3)
+    assert keithley.commands == [":TRAC:CLE " + sweeps.BUFFER, ":SENS:COUN 3", ":SOUR:LIST:VOLT 0,0.5",
+                                 ":SOUR:SWE:VOLT:LIST 1, 0.01, 1, OFF, " + sweeps.BUFFER, ":INIT"]
+
+
+def test_buffered_sweep(keithley):
+    voltages = sweeps.voltage_list(-0.2, 1.2, 0.1)
+    source, current, std = sweeps.buffered_voltage_sweep(keithley, voltages, 0.001, average_points=2)
+    assert source == pytest.approx(voltages)
+    assert current[0] < 0 < current[-1]  # Through Voc
+    assert np.all(std > 0)
+    assert sweeps.measure_count(keithley) == 1  # Single readings again afterwards
+
+
+def test_bulk_read(keithley):
+    keithley.write(":SENS:CURR:NPLC 0.01")
+    sweeps.set_measure_count(keithley, 20)
+    mean, std = sweeps.bulk_read_current(keithley, 20)
+    assert mean < 0 and std > 0  # Short circuit current of the lit cell
+
+
+def test_bulk_read_stopped(keithley):
+    keithley.write(":SENS:CURR:NPLC 10")  # 0.4 s per reading
+    sweeps.set_measure_count(keithley, 20)
+    mean, std = sweeps.bulk_read_current(keithley, 20, should_stop=lambda: True)
+    assert np.isnan(mean) and std == 0  # Aborted before the first reading
+
+
+def test_settle_after_a_voltage_step(keithley):
+    keithley.settings = dict(keithley.settings, noise=0, hysteresis_time=0.2)
+    keithley.current_nplc = 0.01
+    keithley.source_voltage = 1.2
+    time.sleep(2)  # Ten time constants
+    assert sweeps.settle_current(keithley, 5, 1e-4, wait=time.sleep) < 0.05  # Already steady
+    keithley.source_voltage = 0.9
+    assert 0.1 < sweeps.settle_current(keithley, 5, 1e-4, wait=time.sleep) < 2  # Waits for the ions
+
+
+@pytest.mark.parametrize("volt_0, volt_f, step", [(-0.2, 1.2, 0.01), (1.2, -0.2, -0.01)])
+def test_adaptive_grid(volt_0, volt_f, step):
+    cell = simulation.DiodeCell(jsc=22, voc=1.1, n=1.5, rs=3, rsh=2000, area=0.16, temperature=300)
+    voltage, current = [], []
+    for v in sweeps.adaptive_voltages(volt_0, volt_f, step, voltage, current):
+        voltage.append(v)
+        current.append(cell.current([v], suns=1)[0])
+    voltage = np.array(voltage)
+    steps = np.diff(voltage) * np.sign(step)
+
+    assert voltage[0] == volt_0 and np.all((volt_f - voltage) * np.sign(step) > 0)
+    assert np.all(steps > 0.99 * abs(step)) and np.all(steps < sweeps.GRID_COARSE * abs(step) * 1.01)
+    assert np.all(steps[1:] <= steps[:-1] * 2 + 1e-9)  # The step grows at most twice per point
+    assert len(voltage) < 0.5 * len(sweeps.voltage_list(volt_0, volt_f, step))  # Coarse in the flat part
+    knee = (np.minimum(voltage[1:], voltage[:-1]) > 0.88) & (np.maximum(voltage[1:], voltage[:-1]) < 1.15)
+    assert np.all(steps[knee] < 1.01 * abs(step))  # Fine from the MPP past Voc
+
+
+def test_sequential_read_precise():
+    keithley = Readings([1e-3, 1e-3 + 1e-10] * 10)
+    mean, std, points = sweeps.sequential_read_current(keithley, 1e-9, 2, 20)
+    assert points == 2
+    assert mean == pytest.approx(1e-3)
+
+
+def test_sequential_read_noisy():
+    noisy = [1e-6, -1e-6] * 10
+    assert sweeps.sequential_read_current(Readings(noisy), 1e-9, 2, 7)[2] == 7  # Capped at max_points
+    mean, std, points = sweeps.sequential_read_current(Readings(noisy), 0.6e-6, 2, 20)
+    assert points == 4  # Standard error 0.67e-6 after 3 readings, 0.58e-6 after 4
+    assert (mean, std) == pytest.approx((0, np.std(noisy[:4], ddof=1)))
+
+
+def test_sequential_read_limits():
+    assert sweeps.sequential_read_current(Readings([1e-6, -1e-6] * 10), 1e-9, 2, 20,
+                                          should_stop=lambda: True)[2] == 1
+    assert sweeps.sequential_read_current(Readings([1e-3] * 10), 1, 5, 3)[2] == 3  # min_points above max_points
+
+
+def test_sweep_window():
+    assert sweeps.sweep_window(-0.2, 1.2, 0.02, None, 0.1) == (-0.2, 1.2, 0.02)
+    assert sweeps.sweep_window(-0.2, 1.2, 0.02, np.nan, 0.1) == (-0.2, 1.2, 0.02)
+    forward = sweeps.sweep_window(-0.2, 1.2, 0.02, 0.9, 0.1)
+    assert sweeps.voltage_list(*forward)[-1] == pytest.approx(1.0)  # Ends at the margin above Voc
+    assert sweeps.sweep_window(1.2, -0.2, -0.02, 0.9, 0.1) == pytest.approx((1.0, -0.2, -0.02))
+    # Never outside the range asked for
+    assert sweeps.sweep_window(-0.2, 1.2, 0.02, 1.15, 0.1)[1] == 1.2
+    assert sweeps.sweep_window(1.2, -0.2, -0.02, 1.15, 0.1)[0] == 1.2
+
+
+def test_sweep_done_past_voc():
+    voltage, current = [0.8, 0.9, 1.0, 1.05, 1.1], [-5, -1, 2, 4, 8]  # mA/cm², crossing zero at 1.0 V
+    assert not sweeps.is_sweep_done(voltage[:4], current[:4], 0.05, 0.08, 25)
+    assert sweeps.is_sweep_done(voltage, current, 0.05, 0.08, 25)
+    assert not sweeps.is_sweep_done(voltage, current, 0.05, None, 25)  # Dark sweeps ignore Voc
+    assert not sweeps.is_sweep_done(voltage[::-1], current[::-1], -0.05, 0.08, 25)  # Reverse sweeps end at their end
+
+
+def test_sweep_done_in_compliance():
+    current = [-20, -24.5, -24.95, -25]
+    assert not sweeps.is_sweep_done([0.1, 0.2, 0.3, 0.4], current, -0.1, None, 25)
+    assert sweeps.is_sweep_done([0.1, 0.2, 0.3, 0.4, 0.5], current + [-25], -0.1, None, 25)
+
+
+def test_calibrate_nplc():
+    keithley = Noisy(2e-7)
+    nplc, auto_zero, noise = sweeps.calibrate_nplc(keithley, 0.5e-7, 4)
+    # Spread of the readings 1.05 noise/sqrt(NPLC), halved by 4 averaged points. 2 NPLC with auto zero (as slow
+    # as 4 NPLC) is not enough, 5 NPLC with the zero taken once is the next fastest
+    assert (nplc, auto_zero) == (5, "ONCE")
+    assert noise == pytest.approx(2e-7 / np.sqrt(5) * np.sqrt(10 / 9))
+    assert ":SENS:CURR:AZER ON" in keithley.commands
+    assert keithley.count == 1  # Measure count as it was
+
+
+def test_calibrate_nplc_stopped():
+    keithley = Noisy(2e-7)
+    assert sweeps.calibrate_nplc(keithley, 1e-12, 1, should_stop=lambda: True)[:2] == (0.01, "ONCE")
+    assert keithley.count == 1
+
+
+def test_pick_current_range():
+    assert sweeps.pick_current_range(3e-3, 0.1) == 1e-2  # With the headroom
+    assert sweeps.pick_current_range(8e-3, 0.1) == 1e-1
+    assert sweeps.pick_current_range(3e-3, 1e-3) == 1e-3  # Never above the current limit
+    assert sweeps.pick_current_range(5.0, 10) == 1.0
+
+
+def test_dual_sweep(keithley):
+    # Forward and reverse as one list program (see Station.dual_curr_volt_measurement), loaded in several chunks
+    keithley.write(":SENS:CURR:NPLC 0.01")
+    forward, reverse = sweeps.voltage_list(-0.2, 1.2, 0.01), sweeps.voltage_list(1.2, -0.2, -0.01)
+    voltages = np.concatenate([forward, reverse])
+    assert len(voltages) > 2 * sweeps.LIST_CHUNK
+    source, current, _ = sweeps.buffered_voltage_sweep(keithley, voltages, 0, average_points=1)
+    assert source == pytest.approx(voltages)
+    assert current[0] < 0 < current[len(forward) - 1]
+    assert current[len(forward)] > 0 > current[-1]
+
+
+def test_running_curve():
+    voltage = np.linspace(0, 1, 11)
+    curves = [np.sin(voltage) + 0.01 * n for n in range(5)]
+    running = sweeps.RunningCurve()
+    running.add(voltage, curves[0])
+    assert running.std_curve() == pytest.approx(np.zeros(11))  # No spread from a single curve
+    for curve in curves[1:]:
+        running.add(voltage, curve)
+    running.add([], [])  # Stopped before the first point
+    assert running.mean_curve() == pytest.approx(np.mean(curves, axis=0))
+    assert running.std_curve() == pytest.approx(np.std(curves, axis=0, ddof=1))
+
+
+def test_running_curve_other_grid():
+    running = sweeps.RunningCurve()
+    running.add([0, 0.5, 1.0], [0, 1, 2])
+    running.add([0.75, 0.25, -0.25], [1.5, 0.5, -0.5])  # Reverse sweep, not reaching 1 V
+    assert running.mean_curve() == pytest.approx([0, 1, 2])  # Interpolated onto the first grid
+    assert list(running.count) == [2, 2, 1]
+    assert running.std_curve() == pytest.approx([0, 0, 0])